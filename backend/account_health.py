@@ -0,0 +1,299 @@
+"""Наблюдение за подключениями аккаунтов и самовосстановление.
+
+Монитор отслеживает по каждому запущенному аккаунту состояние клиента,
+время последнего входящего обновления и частоту ошибок обработки. Клиент без
+обновлений дольше stale_seconds проверяется легким запросом updates.GetState.
+Отключенные и не ответившие клиенты переподключаются с экспоненциальной
+задержкой и случайным разбросом; аккаунт, который не поднялся max_failures раз
+подряд или чья сессия отозвана, уходит в карантин со статусом error.
+Аккаунт, не запустившийся с первого раза (например, Telegram недоступен при
+старте), тоже переподключается с задержкой, а не остается в статусе error.
+
+Статусы аккаунтов пишутся пачкой (bulk_write) раз в status_flush_seconds:
+при частых изменениях в базу попадает только последнее.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pymongo import UpdateOne
+
+from models import AccountStatus, BotStatus, SystemNotification
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CONNECTED = "connected"
+HEALTH_RECONNECTING = "reconnecting"
+HEALTH_QUARANTINED = "quarantined"
+
+
+class AccountHealth:
+    """Состояние одного аккаунта"""
+
+    def __init__(self, error_window: int):
+        self.state = HEALTH_CONNECTED
+        self.last_update = time.monotonic()
+        self.failures = 0
+        self.reconnects = 0
+        self.retry_at = 0.0
+        self.last_error: Optional[str] = None
+        self.start_error: Optional[Exception] = None
+        self.errors: deque = deque()
+        self._error_window = error_window
+
+    def error_rate(self, now: float) -> int:
+        """Ошибки обработки за последние error_window секунд"""
+        while self.errors and now - self.errors[0] > self._error_window:
+            self.errors.popleft()
+        return len(self.errors)
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "state": self.state,
+            "idle_seconds": round(now - self.last_update),
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "retry_in_seconds": max(0, round(self.retry_at - now)),
+            "errors_per_window": self.error_rate(now),
+            "last_error": self.last_error,
+        }
+
+
+class AccountHealthMonitor:
+    """Фоновая проверка клиентов UserbotManager и пакетная запись статусов"""
+
+    def __init__(self, manager, check_interval: int = 30, stale_seconds: int = 300,
+                 probe_timeout: int = 15, backoff_base: float = 5, backoff_max: float = 600,
+                 max_failures: int = 6, quarantine_seconds: int = 3600,
+                 error_window: int = 300, status_flush_seconds: float = 2):
+        self.manager = manager
+        self.check_interval = check_interval
+        self.stale_seconds = stale_seconds
+        self.probe_timeout = probe_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_failures = max_failures
+        self.quarantine_seconds = quarantine_seconds
+        self.error_window = error_window
+        self.status_flush_seconds = status_flush_seconds
+        self.accounts: Dict[str, AccountHealth] = {}
+        self._pending_status: Dict[str, Dict] = {}
+        self._check_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    # События от UserbotManager
+
+    def track(self, account_id: str):
+        """Аккаунт запущен: начинаем наблюдение (или выходим из переподключения)"""
+        health = self.accounts.get(account_id)
+        if health is None:
+            self.accounts[account_id] = AccountHealth(self.error_window)
+        else:
+            health.state = HEALTH_CONNECTED
+            health.failures = 0
+            health.last_update = time.monotonic()
+        self._ensure_tasks()
+
+    def untrack(self, account_id: str):
+        self.accounts.pop(account_id, None)
+
+    def untrack_all(self):
+        """Бот остановлен: наблюдение снимается и с аккаунтов, ждущих повторного запуска"""
+        self.accounts.clear()
+
+    def record_update(self, account_id: str):
+        health = self.accounts.get(account_id)
+        if health:
+            health.last_update = time.monotonic()
+
+    def record_error(self, account_id: str, error: Exception):
+        health = self.accounts.get(account_id)
+        if health:
+            health.errors.append(time.monotonic())
+            health.last_error = f"{type(error).__name__}: {error}"
+
+    def record_start_failure(self, account_id: str, error: Exception):
+        """Ошибка запуска: при переподключении ее разбирает _reconnect, первый запуск повторяется"""
+        health = self.accounts.get(account_id)
+        if health is not None:
+            health.start_error = error
+            return
+        health = self.accounts[account_id] = AccountHealth(self.error_window)
+        health.start_error = error
+        self._schedule_reconnect(account_id, health, f"Start failed: {type(error).__name__}: {error}")
+
+    def set_status(self, account_id: str, status: AccountStatus, error_message: Optional[str] = None):
+        """Статус аккаунта в очередь на запись (последний статус заменяет предыдущие)"""
+        update_data = {"status": status, "last_active": datetime.utcnow()}
+        if error_message:
+            update_data["error_message"] = error_message
+        elif status == AccountStatus.CONNECTED:
+            update_data["error_message"] = None
+        self._pending_status[account_id] = update_data
+        self._ensure_tasks()
+
+    # Фоновые задачи
+
+    def _ensure_tasks(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._check_task is None and self.accounts:
+            self._check_task = asyncio.create_task(self._check_loop())
+
+    async def flush_statuses(self):
+        if not self._pending_status:
+            return
+        pending, self._pending_status = self._pending_status, {}
+        try:
+            await self.manager.db.telegram_accounts.bulk_write([
+                UpdateOne({"id": account_id}, {"$set": update_data})
+                for account_id, update_data in pending.items()
+            ], ordered=False)
+        except Exception:
+            # Повторим при следующей записи, если статус не успел смениться
+            for account_id, update_data in pending.items():
+                self._pending_status.setdefault(account_id, update_data)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.status_flush_seconds)
+            try:
+                await self.flush_statuses()
+            except Exception as e:
+                logger.error(f"Account status flush error: {e}")
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Account health check error: {e}")
+
+    async def check_all(self):
+        now = time.monotonic()
+        checks = []
+        for account_id, health in list(self.accounts.items()):
+            if health.state != HEALTH_CONNECTED:
+                if now >= health.retry_at:
+                    checks.append(self._reconnect(account_id, health))
+                continue
+
+            errors = health.error_rate(now)
+            if errors:
+                logger.warning(f"Account {account_id}: {errors} processing errors in {self.error_window}s, "
+                               f"last: {health.last_error}")
+
+            client = self.manager.clients.get(account_id)
+            if client is None or not client.is_connected:
+                self._schedule_reconnect(account_id, health, "client disconnected")
+            elif now - health.last_update > self.stale_seconds:
+                checks.append(self._probe(account_id, health, client))
+        if checks:
+            await asyncio.gather(*checks)
+
+    async def _probe(self, account_id: str, health: AccountHealth, client):
+        """Проверка живости клиента, от которого давно не было обновлений"""
+        from pyrogram import raw
+        from pyrogram.errors import Unauthorized
+
+        try:
+            await asyncio.wait_for(client.invoke(raw.functions.updates.GetState()), self.probe_timeout)
+            health.last_update = time.monotonic()
+        except Unauthorized as e:
+            await self._quarantine(account_id, health, f"Session revoked: {type(e).__name__}")
+        except Exception as e:
+            self._schedule_reconnect(account_id, health, f"Liveness probe failed: {type(e).__name__}: {e}")
+
+    def _schedule_reconnect(self, account_id: str, health: AccountHealth, reason: str):
+        health.state = HEALTH_RECONNECTING
+        health.last_error = reason
+        health.failures += 1
+        # Экспоненциальная задержка с разбросом, чтобы аккаунты не переподключались разом
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (health.failures - 1))
+        health.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.5)
+        self.set_status(account_id, AccountStatus.CONNECTING, reason)
+        logger.warning(f"Account {account_id} unhealthy ({reason}), reconnect attempt {health.failures}")
+
+    async def _reconnect(self, account_id: str, health: AccountHealth):
+        from pyrogram.errors import Unauthorized
+
+        if health.state == HEALTH_QUARANTINED:
+            logger.info(f"Account {account_id} leaves quarantine, reconnecting")
+            health.failures = 0
+
+        client = self.manager.clients.pop(account_id, None)
+        if client is not None:
+            try:
+                await client.stop()
+            except Exception as e:
+                logger.debug(f"Error stopping client {account_id} before reconnect: {e}")
+
+        # Аккаунт могли остановить, пока останавливался старый клиент
+        if self.accounts.get(account_id) is not health:
+            return
+        # Статус читаем из базы, а не из кэша настроек: бот могли остановить на
+        # другом узле, а в рабочем процессе аренд нет
+        settings = await self.manager.db.bot_settings.find_one({}, {"status": 1}) or {}
+        if settings.get("status", BotStatus.STOPPED) == BotStatus.STOPPED:
+            self.untrack(account_id)
+            return
+        leases = self.manager.leases
+        if leases and account_id not in leases.held:
+            # Аренда отдана: аккаунт запустит узел, который ее получит
+            self.untrack(account_id)
+            return
+        health.start_error = None
+        if await self.manager.start_userbot(account_id):
+            health.reconnects += 1
+            logger.info(f"Account {account_id} reconnected")
+            return
+
+        error = health.start_error
+        reason = f"{type(error).__name__}: {error}" if error else "Account not found or missing session"
+        if error is None:
+            # Аккаунт удален или без сессии: наблюдать больше нечего
+            self.untrack(account_id)
+        elif isinstance(error, Unauthorized) or health.failures + 1 >= self.max_failures:
+            await self._quarantine(account_id, health, reason)
+        else:
+            self._schedule_reconnect(account_id, health, reason)
+
+    async def _quarantine(self, account_id: str, health: AccountHealth, reason: str):
+        """Аккаунт больше не переподключается до истечения карантина"""
+        # Остановка через менеджер, чтобы аккаунт убрали из своих списков рабочий
+        # процесс и аренды; наблюдение после нее возобновляется
+        await self.manager.stop_userbot(account_id)
+        self.accounts[account_id] = health
+        health.state = HEALTH_QUARANTINED
+        health.last_error = reason
+        health.retry_at = time.monotonic() + self.quarantine_seconds
+        self.set_status(account_id, AccountStatus.ERROR, f"Quarantined: {reason}")
+        logger.error(f"Account {account_id} quarantined: {reason}")
+
+        notification = SystemNotification(
+            type="error",
+            title="Аккаунт отключен",
+            message=f"Аккаунт {account_id} не удалось переподключить: {reason}",
+            expires_at=datetime.utcnow() + timedelta(seconds=self.quarantine_seconds)
+        )
+        await self.manager.db.system_notifications.insert_one(notification.dict())
+        await self.manager.publish_status()
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Состояние всех наблюдаемых аккаунтов"""
+        now = time.monotonic()
+        return {account_id: health.to_dict(now) for account_id, health in self.accounts.items()}
+
+    async def stop(self):
+        """Остановка фоновых задач с записью накопленных статусов"""
+        for task in (self._check_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+        self._check_task = self._flush_task = None
+        await self.flush_statuses()
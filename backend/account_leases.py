@@ -0,0 +1,289 @@
+"""Аренда аккаунтов при работе нескольких узлов (реплик API).
+
+Каждый узел раз в несколько секунд пишет heartbeat в cluster_nodes и продлевает
+аренды своих аккаунтов в account_leases. Аренда - документ с владельцем и
+сроком действия; захват выполняется одним атомарным upsert по _id, поэтому
+достаточно одиночного mongod без транзакций. Узел держит не больше своей доли
+аккаунтов (поровну между живыми узлами) и при превышении отпускает лишние.
+Аккаунты упавшего узла подхватываются другими узлами после истечения аренды,
+то есть не позже чем через lease_seconds + renew_interval.
+
+Аккаунт, остановленный вручную, получает бессрочную аренду-паузу: его не
+запускает ни один узел, пока аккаунт не запустят явно (или весь бот).
+"""
+import asyncio
+import logging
+import math
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from pymongo.errors import DuplicateKeyError
+
+from models import BotStatus
+from worker_pool import HashRing
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_NODES = "cluster_nodes"
+ACCOUNT_LEASES = "account_leases"
+# Записи узлов, не присылавших heartbeat, удаляются через несколько сроков аренды
+NODE_RECORD_TTL_FACTOR = 10
+# Владелец аренды приостановленного аккаунта
+PAUSED_OWNER = "paused"
+PAUSED_UNTIL = datetime(9999, 12, 31)
+
+
+def default_node_id() -> str:
+    return os.environ.get("CLUSTER_NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseManager:
+    """Аренды аккаунтов текущего узла и их согласование с UserbotManager"""
+
+    def __init__(self, db, manager, node_id: Optional[str] = None, lease_seconds: int = 30):
+        self.db = db
+        self.manager = manager
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.renew_interval = max(1, lease_seconds // 3)
+        self.nodes = db[CLUSTER_NODES]
+        self.leases = db[ACCOUNT_LEASES]
+        # Аккаунты, аренда которых у этого узла и клиенты которых запущены
+        self.held: Set[str] = set()
+        self.started_at = datetime.utcnow()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def initialize(self):
+        await self.leases.create_index([("owner", 1), ("expires_at", 1)])
+        await self.nodes.create_index(
+            "heartbeat_at", expireAfterSeconds=self.lease_seconds * NODE_RECORD_TTL_FACTOR
+        )
+
+    # Узлы
+
+    async def heartbeat(self):
+        now = datetime.utcnow()
+        await self.nodes.update_one(
+            {"_id": self.node_id},
+            {
+                "$set": {"heartbeat_at": now, "held": len(self.held)},
+                "$setOnInsert": {
+                    "started_at": self.started_at,
+                    "hostname": socket.gethostname(),
+                    "pid": os.getpid(),
+                },
+            },
+            upsert=True
+        )
+
+    async def live_nodes(self) -> List[str]:
+        """Узлы с heartbeat моложе срока аренды (текущий узел всегда в списке)"""
+        since = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        nodes = await self.nodes.distinct("_id", {"heartbeat_at": {"$gte": since}})
+        return sorted(set(nodes) | {self.node_id})
+
+    # Аренды
+
+    async def acquire(self, account_id: str) -> bool:
+        """Захват свободной или истекшей аренды (или продление своей)"""
+        now = datetime.utcnow()
+        try:
+            await self.leases.update_one(
+                {
+                    "_id": account_id,
+                    "$or": [{"owner": self.node_id}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {
+                    "owner": self.node_id,
+                    "expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "renewed_at": now,
+                }},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Аренда действующая и принадлежит другому узлу
+            return False
+
+    async def renew(self) -> Set[str]:
+        """Продление своих действующих аренд; возвращает аккаунты, которые еще за узлом"""
+        now = datetime.utcnow()
+        await self.leases.update_many(
+            {"owner": self.node_id, "expires_at": {"$gte": now}},
+            {"$set": {"expires_at": now + timedelta(seconds=self.lease_seconds), "renewed_at": now}}
+        )
+        return set(await self.leases.distinct(
+            "_id", {"owner": self.node_id, "expires_at": {"$gte": now}}
+        ))
+
+    async def release(self, account_ids: Iterable[str]):
+        account_ids = list(account_ids)
+        if account_ids:
+            await self.leases.delete_many({"_id": {"$in": account_ids}, "owner": self.node_id})
+
+    async def pause(self, account_id: str):
+        """Аккаунт остановлен вручную: ни один узел не запускает его до resume.
+
+        Если аккаунт работал на другом узле, тот потеряет аренду при следующем
+        продлении и остановит клиент.
+        """
+        async with self._lock:
+            self.held.discard(account_id)
+            await self.leases.update_one(
+                {"_id": account_id},
+                {"$set": {"owner": PAUSED_OWNER, "expires_at": PAUSED_UNTIL, "renewed_at": datetime.utcnow()}},
+                upsert=True
+            )
+
+    async def resume(self, account_ids: Optional[Iterable[str]] = None):
+        """Снятие паузы с аккаунтов (со всех, если список не указан)"""
+        query = {"owner": PAUSED_OWNER}
+        if account_ids is not None:
+            query["_id"] = {"$in": list(account_ids)}
+        await self.leases.delete_many(query)
+
+    async def owner_of(self, account_id: str) -> Optional[str]:
+        lease = await self.leases.find_one(
+            {"_id": account_id, "expires_at": {"$gte": datetime.utcnow()}}, {"owner": 1}
+        )
+        return lease["owner"] if lease else None
+
+    # Распределение
+
+    async def claim_share(self, account_ids: List[str]) -> List[str]:
+        """Аккаунты, которые должен запустить этот узел: уже свои и новые в пределах доли.
+
+        Сначала захватываются аккаунты, которые консистентное хеширование
+        назначает этому узлу, чтобы размещение было стабильным.
+        """
+        await self.heartbeat()
+        nodes = await self.live_nodes()
+        owned = await self.renew()
+        wanted = set(account_ids)
+        share = math.ceil(len(wanted) / len(nodes))
+
+        ring = HashRing(nodes)
+        candidates = sorted(
+            wanted - owned,
+            key=lambda account_id: (ring.node_for(account_id) != self.node_id, account_id)
+        )
+        for account_id in candidates:
+            if len(owned & wanted) >= share:
+                break
+            if await self.acquire(account_id):
+                owned.add(account_id)
+        return sorted(owned & wanted)
+
+    async def reconcile(self):
+        """Один шаг согласования: продление, отдача лишнего, захват своей доли"""
+        async with self._lock:
+            await self.heartbeat()
+            owned = await self.renew()
+
+            # Аренды, потерянные из-за задержки продления, уже у других узлов
+            lost = self.held - owned
+            for account_id in lost:
+                logger.warning(f"Lease for account {account_id} lost, stopping client")
+                await self.manager.stop_userbot(account_id)
+            self.held -= lost
+
+            settings = await self.db.bot_settings.find_one() or {}
+            if settings.get("status", BotStatus.STOPPED) == BotStatus.STOPPED:
+                # Бот остановлен командой /bot/stop (на любом узле): отпускаем все
+                # аккаунты. Остановка или перезапуск узла статус не меняет
+                # (UserbotManager.shutdown), поэтому другие узлы продолжают работу
+                await self._stop_and_release(self.held | owned)
+                return
+
+            account_ids = [account.id async for account in self.manager.iter_active_accounts()]
+            active = set(account_ids)
+            nodes = await self.live_nodes()
+            share = math.ceil(len(active) / len(nodes))
+
+            # Неактивные аккаунты и превышение доли (например, после появления нового узла)
+            excess = sorted(owned - active)
+            keep = sorted(owned & active)
+            if len(keep) > share:
+                ring = HashRing(nodes)
+                keep.sort(key=lambda account_id: (ring.node_for(account_id) != self.node_id, account_id))
+                excess += keep[share:]
+            await self._stop_and_release(excess)
+
+            to_run = set(await self.claim_share(account_ids))
+            missing = sorted(to_run - self.held)
+            if missing:
+                await self.track_started(await self.manager.start_userbots(missing))
+                self.manager.is_running = True
+                await self.manager.publish_status()
+
+    async def track_started(self, results: Dict[str, bool]):
+        """Учет запущенных клиентов; аренды неудачных запусков отдаются другим узлам"""
+        self.held.update(account_id for account_id, success in results.items() if success)
+        await self.release(account_id for account_id, success in results.items() if not success)
+
+    async def _stop_and_release(self, account_ids: Iterable[str]):
+        account_ids = list(account_ids)
+        for account_id in account_ids:
+            if account_id in self.held:
+                await self.manager.stop_userbot(account_id)
+        self.held.difference_update(account_ids)
+        await self.release(account_ids)
+
+    async def release_all(self):
+        """Остановка клиентов узла и отказ от всех аренд"""
+        async with self._lock:
+            await self._stop_and_release(self.held)
+            await self.leases.delete_many({"owner": self.node_id})
+
+    async def placement(self) -> Dict:
+        """Размещение аккаунтов по узлам"""
+        now = datetime.utcnow()
+        since = now - timedelta(seconds=self.lease_seconds)
+        leases = await self.leases.find({"expires_at": {"$gte": now}}).to_list(None)
+        nodes = await self.nodes.find().to_list(None)
+
+        by_node: Dict[str, List[str]] = {}
+        for lease in leases:
+            by_node.setdefault(lease["owner"], []).append(lease["_id"])
+        return {
+            "node_id": self.node_id,
+            "lease_seconds": self.lease_seconds,
+            "paused": sorted(by_node.get(PAUSED_OWNER, [])),
+            "nodes": [
+                {
+                    "node_id": node["_id"],
+                    "hostname": node.get("hostname"),
+                    "pid": node.get("pid"),
+                    "started_at": node.get("started_at"),
+                    "heartbeat_at": node["heartbeat_at"],
+                    "alive": node["heartbeat_at"] >= since,
+                    "accounts": sorted(by_node.get(node["_id"], [])),
+                }
+                for node in sorted(nodes, key=lambda node: node["_id"])
+            ],
+        }
+
+    # Фоновая задача
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Lease reconcile error: {e}")
+            await asyncio.sleep(self.renew_interval)
+
+    async def stop(self):
+        """Остановка фоновой задачи и передача аккаунтов другим узлам"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.release_all()
+        await self.nodes.delete_one({"_id": self.node_id})
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# События, которые получают подписчики
+LOG_EVENT = "log"
+STATS_EVENT = "stats"
+STATS_DELTA_EVENT = "stats_delta"
+STATUS_EVENT = "status"
+
+
+class Subscription:
+    """Подписка одного клиента с ограниченной очередью событий"""
+
+    def __init__(self, queue_size: int):
+        self.queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue(maxsize=queue_size)
+        # Клиент не успевал читать, часть событий потеряна: нужно догнать по курсору
+        self.lagged = False
+        self.dropped = 0
+
+    def offer(self, event: str, data: Any) -> bool:
+        if self.lagged:
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait((event, data))
+            return True
+        except asyncio.QueueFull:
+            # Не копим события для медленного клиента: очищаем очередь,
+            # клиент сам дочитает пропущенные логи из базы
+            self.lagged = True
+            self.dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return False
+
+    async def get(self, timeout: float) -> Optional[Tuple[str, Any]]:
+        """Следующее событие или None по таймауту"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def resync(self):
+        """Сброс флага отставания после догоняющего чтения"""
+        self.lagged = False
+
+
+class ActivityHub:
+    """Рассылка событий активности подключенным клиентам внутри процесса.
+
+    Публикация не блокируется: каждый подписчик имеет свою очередь, и медленный
+    клиент не задерживает ни писателя логов, ни других клиентов.
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.queue_size = queue_size
+        self._subscribers: Set[Subscription] = set()
+        self._metrics = {"published": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data: Any):
+        """Отправка события всем подписчикам"""
+        self._metrics["published"] += 1
+        for subscription in self._subscribers:
+            if subscription.offer(event, data):
+                self._metrics["delivered"] += 1
+            else:
+                self._metrics["dropped"] += 1
+
+    def publish_logs(self, docs):
+        """Новые записи лога и изменения счетчиков"""
+        if not docs or not self._subscribers:
+            return
+        delta = {"total": 0, "success": 0, "failed": 0}
+        for doc in docs:
+            self.publish(LOG_EVENT, doc)
+            delta["total"] += 1
+            delta["success" if doc.get("success", True) else "failed"] += 1
+        self.publish(STATS_DELTA_EVENT, delta)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._metrics,
+            "subscribers": len(self._subscribers),
+            "lagged": sum(1 for subscription in self._subscribers if subscription.lagged),
+        }
@@ -0,0 +1,562 @@
+"""Хранение логов активности.
+
+Логи лежат в time-series коллекции MongoDB: время в поле t, аккаунт и правило
+в метаданных m, остальные поля под короткими именами, идентификатор - ObjectId.
+Наружу (API, агрегаты, экспорт) записи отдаются в развернутом виде с полями
+BotActivityLog.
+"""
+import asyncio
+import base64
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_LOGS = "activity_logs"
+# Коллекция со старым форматом (uuid-строки и полные имена полей)
+LEGACY_ACTIVITY_LOGS = "bot_activity_logs"
+# Блокировки переноса старых логов (по документу на старую коллекцию)
+LOG_MIGRATIONS = "activity_log_migrations"
+
+# Развернутое имя поля -> короткое имя в базе
+LOG_FIELDS = {
+    "timestamp": "t",
+    "account_id": "m.a",
+    "rule_id": "m.r",
+    "chat_id": "c",
+    "chat_type": "ct",
+    "user_id": "u",
+    "username": "un",
+    "first_name": "fn",
+    "message_text": "tx",
+    "action_taken": "ac",
+    "success": "ok",
+    "error_message": "er",
+}
+
+# Порядок выдачи логов: новые первыми, _id разрешает совпадения по времени
+LOG_SORT = [("t", -1), ("_id", -1)]
+LOG_SORT_ASCENDING = [("t", 1), ("_id", 1)]
+
+# Составные индексы под каждый вариант фильтра + сортировку LOG_SORT
+LOG_QUERY_INDEXES = [
+    [("t", -1), ("_id", -1)],
+    [("m.a", 1), ("t", -1)],
+    [("m.r", 1), ("t", -1)],
+    [("c", 1), ("t", -1)],
+    [("ok", 1), ("t", -1)],
+]
+
+MAX_PAGE_SIZE = 1000
+# Идентификатор меньше любого ObjectId (курсор "с момента времени")
+MIN_LOG_ID = "0" * 24
+
+
+def encode_log(log: Dict[str, Any]) -> Dict[str, Any]:
+    """Развернутая запись лога -> документ в базе"""
+    log_id = log.get("id")
+    doc = {
+        "_id": ObjectId(log_id) if log_id and ObjectId.is_valid(log_id) else ObjectId(),
+        "t": log["timestamp"],
+        "m": {"a": log["account_id"]},
+    }
+    if log.get("rule_id"):
+        doc["m"]["r"] = log["rule_id"]
+    for field, short in LOG_FIELDS.items():
+        if "." in short or field == "timestamp":
+            continue
+        value = log.get(field)
+        if value is not None:
+            doc[short] = value
+    return doc
+
+
+def decode_log(doc: Dict[str, Any], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Документ в базе -> развернутая запись лога (fields - только эти поля)"""
+    meta = doc.get("m") or {}
+    log = {
+        "id": str(doc["_id"]),
+        "timestamp": doc["t"],
+        "account_id": meta.get("a"),
+        "rule_id": meta.get("r"),
+    }
+    for field, short in LOG_FIELDS.items():
+        if "." in short or field == "timestamp":
+            continue
+        log[field] = doc.get(short)
+    if fields:
+        return {field: log[field] for field in fields if field in log}
+    return log
+
+
+def log_projection(fields: Optional[List[str]]) -> Optional[Dict[str, int]]:
+    """Проекция по развернутым именам полей (время и _id нужны всегда для курсора)"""
+    if not fields:
+        return None
+    projection = {"t": 1, "_id": 1}
+    for field in fields:
+        if field in LOG_FIELDS:
+            projection[LOG_FIELDS[field]] = 1
+    return projection
+
+
+def legacy_log_id(log: Dict[str, Any]) -> str:
+    """Стабильный ObjectId для записи старого формата (время + начало uuid)"""
+    try:
+        tail = bytes.fromhex(str(log["id"]).replace("-", ""))[:8]
+    except (KeyError, ValueError):
+        tail = ObjectId().binary[4:]
+    return str(ObjectId(ObjectId.from_datetime(log["timestamp"]).binary[:4] + tail.ljust(8, b"\0")))
+
+
+def encode_log_cursor(timestamp: datetime, log_id: str) -> str:
+    """Курсор на позицию после записи (timestamp, id)"""
+    payload = json.dumps([timestamp.isoformat(), log_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_log_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Разбор курсора (ValueError для некорректного значения)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, log_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(timestamp), ObjectId(log_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def build_log_filter(account_id: Optional[str] = None, rule_id: Optional[str] = None,
+                     chat_id: Optional[int] = None, success: Optional[bool] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, Any]:
+    """Фильтр логов активности"""
+    query: Dict[str, Any] = {}
+    if account_id:
+        query["m.a"] = account_id
+    if rule_id:
+        query["m.r"] = rule_id
+    if chat_id is not None:
+        query["c"] = chat_id
+    if success is not None:
+        query["ok"] = success
+    if since or until:
+        query["t"] = {}
+        if since:
+            query["t"]["$gte"] = since
+        if until:
+            query["t"]["$lt"] = until
+    return query
+
+
+def apply_log_cursor(query: Dict[str, Any], cursor: Optional[str], ascending: bool = False) -> Dict[str, Any]:
+    """Ограничение выборки записями строго после курсора (в порядке выдачи)"""
+    if not cursor:
+        return query
+    timestamp, log_id = decode_log_cursor(cursor)
+    op = "$gt" if ascending else "$lt"
+    after_cursor = {"$or": [
+        {"t": {op: timestamp}},
+        {"t": timestamp, "_id": {op: log_id}},
+    ]}
+    return {"$and": [query, after_cursor]} if query else after_cursor
+
+
+class ActivityLogStore:
+    """Запись и чтение логов активности в компактном формате"""
+
+    def __init__(self, db, name: str = ACTIVITY_LOGS):
+        self.db = db
+        self.name = name
+        self.collection = db[name]
+        self.is_timeseries = False
+
+    async def initialize(self):
+        """Создание time-series коллекции (или обычной, если сервер не поддерживает).
+
+        Индексы строятся отдельно (create_indexes), в фоне после запуска API.
+        """
+        try:
+            await self.db.create_collection(
+                self.name,
+                timeseries={"timeField": "t", "metaField": "m", "granularity": "minutes"}
+            )
+            logger.info(f"Created time-series collection {self.name}")
+        except CollectionInvalid:
+            pass  # уже существует
+        except OperationFailure as e:
+            logger.warning(f"Time-series collections are not supported, using a regular collection: {e}")
+
+        infos = await self.db.list_collections(filter={"name": self.name}).to_list(1)
+        self.is_timeseries = bool(infos) and infos[0].get("type") == "timeseries"
+
+    async def create_indexes(self):
+        await asyncio.gather(*(self.collection.create_index(index_keys) for index_keys in LOG_QUERY_INDEXES))
+
+    async def insert_many(self, logs: List[Dict[str, Any]]):
+        if logs:
+            await self.collection.insert_many([encode_log(log) for log in logs], ordered=False)
+
+    async def insert_one(self, log: Dict[str, Any]):
+        await self.collection.insert_one(encode_log(log))
+
+    async def fetch_page(self, limit: int = 100, cursor: Optional[str] = None,
+                         fields: Optional[List[str]] = None, skip: int = 0,
+                         **filters) -> Tuple[List[dict], Optional[str]]:
+        """Страница логов и курсор следующей страницы (None, если это последняя).
+
+        skip - смещение для старых клиентов; на глубоких страницах оно медленнее курсора.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query = apply_log_cursor(build_log_filter(**filters), cursor)
+
+        # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        docs = await self.collection.find(query, log_projection(fields)) \
+            .sort(LOG_SORT).skip(max(skip, 0)).limit(limit + 1).to_list(limit + 1)
+
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            next_cursor = encode_log_cursor(last["t"], str(last["_id"]))
+        return [decode_log(doc, fields) for doc in docs], next_cursor
+
+    async def fetch_after(self, cursor: str, limit: int = 100) -> List[dict]:
+        """Записи новее курсора в хронологическом порядке (для догоняющего чтения)"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query = apply_log_cursor({}, cursor, ascending=True)
+        docs = await self.collection.find(query).sort(LOG_SORT_ASCENDING).limit(limit).to_list(limit)
+        return [decode_log(doc) for doc in docs]
+
+    async def iter_batches(self, batch_size: int = 1000, after: Optional[str] = None,
+                           **filters) -> AsyncIterator[List[dict]]:
+        """Пачки логов в хронологическом порядке (после курсора, если он задан)"""
+        query = apply_log_cursor(build_log_filter(**filters), after, ascending=True)
+        cursor = self.collection.find(query) \
+            .sort(LOG_SORT_ASCENDING) \
+            .batch_size(batch_size)
+
+        batch = []
+        async for doc in cursor:
+            batch.append(decode_log(doc))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def oldest_timestamp(self, before: Optional[datetime] = None) -> Optional[datetime]:
+        query = {"t": {"$lt": before}} if before else {}
+        doc = await self.collection.find_one(query, {"t": 1}, sort=[("t", 1)])
+        return doc["t"] if doc else None
+
+    async def has_logs(self, before: Optional[datetime] = None) -> bool:
+        return await self.oldest_timestamp(before) is not None
+
+    async def delete_range(self, since: datetime, until: datetime) -> int:
+        """Удаление записей за интервал (в time-series удаляются целые бакеты)"""
+        result = await self.collection.delete_many({"t": {"$gte": since, "$lt": until}})
+        return result.deleted_count
+
+    async def set_expiration(self, expire_after_seconds: Optional[int], ttl_index_name: str):
+        """Автоудаление записей старше заданного возраста (None - хранить всегда)"""
+        if self.is_timeseries:
+            # У time-series коллекции срок хранения задается на уровне коллекции
+            await self.db.command(
+                "collMod", self.name,
+                expireAfterSeconds=expire_after_seconds if expire_after_seconds is not None else "off"
+            )
+            return
+
+        indexes = await self.collection.index_information()
+        current = indexes.get(ttl_index_name)
+        if expire_after_seconds is None:
+            if current is not None:
+                await self.collection.drop_index(ttl_index_name)
+            return
+        if current is None:
+            await self.collection.create_index([("t", 1)], name=ttl_index_name,
+                                               expireAfterSeconds=expire_after_seconds)
+        elif current.get("expireAfterSeconds") != expire_after_seconds:
+            await self.db.command("collMod", self.name, index={
+                "name": ttl_index_name, "expireAfterSeconds": expire_after_seconds
+            })
+
+    async def migrate_legacy(self, owner: str, legacy_name: str = LEGACY_ACTIVITY_LOGS,
+                             batch_size: int = 1000, lock_seconds: int = 120) -> int:
+        """Перенос логов старого формата; перенесенные записи удаляются из старой коллекции.
+
+        Переносит один узел - владелец блокировки (как в RollupBackfill), остальные
+        ждут, пока старая коллекция не опустеет или блокировка не истечет. Записи
+        сохраняют ID старых логов, поэтому повтор пачки после сбоя в обычной
+        коллекции не создает дублей; в time-series коллекции (без уникального
+        _id) повторно может попасть одна пачка.
+        """
+        legacy = self.db[legacy_name]
+        locks = self.db[LOG_MIGRATIONS]
+        migrated = 0
+        while await legacy.find_one({}, {"_id": 1}) is not None:
+            if not await self._lock_migration(locks, legacy_name, owner, lock_seconds):
+                await asyncio.sleep(lock_seconds / 4)
+                continue
+            while True:
+                batch = await legacy.find().limit(batch_size).to_list(batch_size)
+                if not batch:
+                    break
+                logs = [{**log, "id": legacy_log_id(log)} for log in batch]
+                try:
+                    await self.insert_many(logs)
+                except BulkWriteError as e:
+                    # Пачка, перенесенная до сбоя: уже записанные логи пропускаем
+                    if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                        raise
+                await legacy.delete_many({"_id": {"$in": [log["_id"] for log in batch]}})
+                migrated += len(batch)
+                if not await self._lock_migration(locks, legacy_name, owner, lock_seconds):
+                    logger.warning("Legacy log migration lock lost, another node continues")
+                    break
+
+        if migrated:
+            await legacy.drop()
+            logger.info(f"Migrated {migrated} activity logs from {legacy_name}")
+        await locks.delete_one({"_id": legacy_name, "owner": owner})
+        return migrated
+
+    @staticmethod
+    async def _lock_migration(locks, legacy_name: str, owner: str, lock_seconds: int) -> bool:
+        """Захват или продление блокировки переноса"""
+        now = datetime.utcnow()
+        try:
+            await locks.update_one(
+                {"_id": legacy_name, "$or": [{"owner": owner}, {"locked_until": {"$lt": now}}]},
+                {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=lock_seconds)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+
+# Агрегаты (rollups): счетчики по минутам, часам, дням и за все время
+ROLLUP_GRANULARITIES = ("minute", "hour", "day")
+ROLLUP_TOTAL = "total"
+# Для агрегата "за все время" bucket фиксирован, чтобы работал уникальный индекс
+ROLLUP_TOTAL_BUCKET = datetime(1970, 1, 1)
+# Поминутные агрегаты нужны только для свежих графиков и удаляются TTL-индексом
+# независимо от срока хранения логов (который по умолчанию выключен)
+MINUTE_ROLLUP_TTL_SECONDS = 7 * 24 * 3600
+
+ROLLUP_INDEXES = [
+    ([("granularity", 1), ("bucket", 1), ("account_id", 1), ("rule_id", 1)], {"unique": True}),
+    ([("granularity", 1), ("rule_id", 1), ("bucket", -1)], {}),
+    ([("granularity", 1), ("account_id", 1), ("bucket", -1)], {}),
+    ([("bucket", 1)], {
+        "name": "minute_rollup_ttl",
+        "expireAfterSeconds": MINUTE_ROLLUP_TTL_SECONDS,
+        "partialFilterExpression": {"granularity": "minute"},
+    }),
+]
+
+
+def rollup_bucket(timestamp: datetime, granularity: str) -> datetime:
+    """Начало интервала агрегата, в который попадает момент времени"""
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ROLLUP_TOTAL_BUCKET
+
+
+def build_rollup_updates(logs: Iterable[dict]) -> List[UpdateOne]:
+    """Upsert-операции агрегатов для пачки логов (одна операция на ключ)"""
+    increments: Dict[tuple, Dict[str, int]] = {}
+    for log in logs:
+        success = bool(log.get("success", True))
+        for granularity in ROLLUP_GRANULARITIES + (ROLLUP_TOTAL,):
+            key = (granularity, rollup_bucket(log["timestamp"], granularity),
+                   log.get("account_id"), log.get("rule_id"))
+            counters = increments.setdefault(key, {"total": 0, "success": 0, "failed": 0})
+            counters["total"] += 1
+            counters["success" if success else "failed"] += 1
+
+    return [
+        UpdateOne(
+            {"granularity": granularity, "bucket": bucket, "account_id": account_id, "rule_id": rule_id},
+            {"$inc": counters},
+            upsert=True
+        )
+        for (granularity, bucket, account_id, rule_id), counters in increments.items()
+    ]
+
+
+async def update_rollups(rollups_collection, logs: List[dict]):
+    """Обновление агрегатов после записи логов"""
+    updates = build_rollup_updates(logs)
+    if updates:
+        await rollups_collection.bulk_write(updates, ordered=False)
+
+
+def _sum_counters(docs: Iterable[dict], group_by: Optional[str] = None):
+    totals = {"total": 0, "success": 0, "failed": 0}
+    groups: Dict[Any, Dict[str, int]] = {}
+    for doc in docs:
+        for field in totals:
+            totals[field] += doc.get(field, 0)
+        if group_by:
+            group = groups.setdefault(doc.get(group_by), {"total": 0, "success": 0, "failed": 0})
+            for field in group:
+                group[field] += doc.get(field, 0)
+    return totals, groups
+
+
+async def read_activity_stats(rollups_collection, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Статистика активности по агрегатам (не зависит от объема логов)"""
+    now = now or datetime.utcnow()
+    total_docs = await rollups_collection.find({"granularity": ROLLUP_TOTAL}).to_list(None)
+    today_docs = await rollups_collection.find({
+        "granularity": "day", "bucket": rollup_bucket(now, "day")
+    }).to_list(None)
+
+    totals, _ = _sum_counters(total_docs)
+    today, _ = _sum_counters(today_docs)
+    _, by_rule = _sum_counters(total_docs, "rule_id")
+    _, by_account = _sum_counters(total_docs, "account_id")
+    _, today_by_rule = _sum_counters(today_docs, "rule_id")
+    _, today_by_account = _sum_counters(today_docs, "account_id")
+
+    def breakdown(groups, today_groups, key):
+        return sorted(
+            (
+                {key: group_key, **counters, "today": today_groups.get(group_key, {}).get("total", 0)}
+                for group_key, counters in groups.items()
+            ),
+            key=lambda item: item["total"],
+            reverse=True
+        )
+
+    return {
+        "total_responses": totals["total"],
+        "successful_responses": totals["success"],
+        "failed_responses": totals["failed"],
+        "success_rate": totals["success"] / totals["total"] * 100 if totals["total"] > 0 else 0,
+        "responses_today": today["total"],
+        "by_rule": breakdown(by_rule, today_by_rule, "rule_id"),
+        "by_account": breakdown(by_account, today_by_account, "account_id"),
+    }
+
+
+async def read_activity_series(rollups_collection, granularity: str, since: datetime,
+                               until: Optional[datetime] = None, account_id: Optional[str] = None,
+                               rule_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Временной ряд счетчиков по агрегатам"""
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise ValueError(f"Unsupported granularity: {granularity}")
+
+    query: Dict[str, Any] = {"granularity": granularity, "bucket": {"$gte": rollup_bucket(since, granularity)}}
+    if until:
+        query["bucket"]["$lt"] = until
+    if account_id:
+        query["account_id"] = account_id
+    if rule_id:
+        query["rule_id"] = rule_id
+
+    _, series = _sum_counters(await rollups_collection.find(query).to_list(None), "bucket")
+    return [{"bucket": bucket, **counters} for bucket, counters in sorted(series.items())]
+
+
+async def count_rule_triggers(rollups_collection, rule_id: str, day: Optional[datetime] = None) -> int:
+    """Количество срабатываний правила за день (по всем аккаунтам)"""
+    docs = await rollups_collection.find({
+        "granularity": "day",
+        "bucket": rollup_bucket(day or datetime.utcnow(), "day"),
+        "rule_id": rule_id
+    }).to_list(None)
+    return sum(doc.get("total", 0) for doc in docs)
+
+
+# Состояние заполнения агрегатов по логам, записанным до их появления
+ROLLUP_BACKFILL = "rollup_backfill"
+ROLLUP_BACKFILL_ID = "activity_logs"
+
+
+class RollupBackfill:
+    """Заполнение агрегатов по логам, записанным до их появления.
+
+    Состояние - один документ: граница until (более новые логи агрегирует сам
+    писатель), курсор последней учтенной пачки и блокировка с истечением. Пачки
+    обрабатывает только узел, взявший блокировку; после сбоя заполнение
+    продолжается с курсора. Пачка, учтенная в агрегатах, но не отмеченная в
+    курсоре из-за сбоя, будет посчитана повторно (не больше batch_size записей).
+    """
+
+    def __init__(self, db, store: ActivityLogStore, owner: str,
+                 batch_size: int = 1000, lock_seconds: int = 120):
+        self.state = db[ROLLUP_BACKFILL]
+        self.rollups = db.activity_rollups
+        self.store = store
+        self.owner = owner
+        self.batch_size = batch_size
+        self.lock_seconds = lock_seconds
+
+    async def initialize(self, until: datetime, needed: bool):
+        """Состояние при первом запуске (needed=False - агрегаты уже есть).
+
+        Вызывается до того, как писатель логов начнет обновлять агрегаты.
+        """
+        try:
+            await self.state.update_one(
+                {"_id": ROLLUP_BACKFILL_ID},
+                {"$setOnInsert": {"until": until, "cursor": None, "done": not needed}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass  # состояние одновременно создал другой узел
+
+    async def pending(self) -> bool:
+        return await self.state.find_one({"_id": ROLLUP_BACKFILL_ID, "done": False}) is not None
+
+    async def _lock(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.state.find_one_and_update(
+            {
+                "_id": ROLLUP_BACKFILL_ID,
+                "done": False,
+                "$or": [{"owner": self.owner}, {"locked_until": None}, {"locked_until": {"$lt": now}}],
+            },
+            {"$set": {"owner": self.owner, "locked_until": now + timedelta(seconds=self.lock_seconds)}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def run(self) -> int:
+        """Обработка оставшихся пачек; 0, если заполнение завершено или идет на другом узле"""
+        state = await self._lock()
+        if state is None:
+            return 0
+
+        processed = 0
+        async for batch in self.store.iter_batches(self.batch_size, after=state["cursor"], until=state["until"]):
+            await update_rollups(self.rollups, batch)
+            processed += len(batch)
+            last = batch[-1]
+            result = await self.state.update_one(
+                {"_id": ROLLUP_BACKFILL_ID, "owner": self.owner},
+                {"$set": {
+                    "cursor": encode_log_cursor(last["timestamp"], last["id"]),
+                    "locked_until": datetime.utcnow() + timedelta(seconds=self.lock_seconds),
+                }}
+            )
+            if result.matched_count == 0:
+                logger.warning("Rollup backfill lock lost, another node continues")
+                return processed
+
+        await self.state.update_one(
+            {"_id": ROLLUP_BACKFILL_ID, "owner": self.owner},
+            {"$set": {"done": True, "locked_until": None}}
+        )
+        return processed
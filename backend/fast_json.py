@@ -0,0 +1,95 @@
+"""Быстрый путь отдачи больших списков.
+
+Документы Mongo отдаются как есть (без построения pydantic-моделей и повторной
+проверки через response_model) и сериализуются orjson. Затраченное время
+передается в заголовке Server-Timing. Поля, которых нет в документах старых
+версий, дополняются значениями по умолчанию модели (fill_model_defaults).
+"""
+import copy
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Type
+
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTiming:
+    """Замеры этапов обработки запроса для заголовка Server-Timing"""
+
+    def __init__(self):
+        self.metrics: List[tuple] = []
+
+    @contextmanager
+    def measure(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metrics.append((name, (time.perf_counter() - start) * 1000))
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={duration:.1f}" for name, duration in self.metrics)
+
+
+def _default(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    return str(value)
+
+
+def select_fields(fields: Optional[str], model: Type[BaseModel],
+                  required: Iterable[str] = ("id",)) -> Optional[List[str]]:
+    """Список полей из параметра fields (None - все поля модели)"""
+    if not fields:
+        return None
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in model.model_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys([*required, *selected]))
+
+
+def model_defaults(model: Type[BaseModel], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Постоянные значения по умолчанию полей модели (без default_factory: id, даты)"""
+    defaults = {}
+    for name, field in model.model_fields.items():
+        if fields and name not in fields:
+            continue
+        if field.default_factory is None and not field.is_required():
+            defaults[name] = field.default
+    return defaults
+
+
+def fill_model_defaults(docs: List[dict], model: Type[BaseModel],
+                        fields: Optional[List[str]] = None) -> List[dict]:
+    """Дополнение документов отсутствующими полями модели"""
+    defaults = model_defaults(model, fields)
+    for doc in docs:
+        for name, value in defaults.items():
+            if name not in doc:
+                doc[name] = copy.deepcopy(value)
+    return docs
+
+
+def projection_for(fields: Optional[List[str]]) -> Dict[str, int]:
+    """Проекция Mongo: только запрошенные поля и без _id"""
+    projection = {field: 1 for field in fields} if fields else {}
+    projection["_id"] = 0
+    return projection
+
+
+def fast_json_response(content: Any, timing: ServerTiming, headers: Optional[Dict[str, str]] = None) -> Response:
+    """JSON-ответ через orjson с заголовком Server-Timing"""
+    with timing.measure("serialize"):
+        body = orjson.dumps(content, default=_default)
+    logger.debug(f"Fast JSON response: {len(body)} bytes, {timing.header()}")
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={**(headers or {}), "Server-Timing": timing.header()}
+    )
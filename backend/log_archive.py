@@ -0,0 +1,180 @@
+"""Срок хранения логов активности и архивирование в Parquet.
+
+Логи старше срока хранения выгружаются по суткам в сжатые Parquet-файлы на
+локальном диске и только после этого удаляются из базы. Автоудаление по
+времени (срок хранения time-series коллекции или TTL-индекс) с запасом
+удаляет записи, если архиватор пропустил запуск. Оно включается только после
+успешного прохода архиватора и снимается, если архивирование не удалось
+(нет места, каталог недоступен для записи), чтобы неархивированные логи не
+удалялись. Срок хранения по умолчанию 0 - логи хранятся всегда.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from activity_logs import ActivityLogStore
+from log_export import export_parquet
+
+logger = logging.getLogger(__name__)
+
+LOG_ARCHIVES = "log_archives"
+TTL_INDEX_NAME = "log_retention_ttl"
+# Запас TTL относительно срока хранения: архиватор успевает выгрузить сутки до удаления
+TTL_GRACE_DAYS = 2
+ARCHIVE_COMPRESSION = "zstd"
+
+
+def _day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _read_archive_counts(paths: List[str], since: Optional[datetime], until: Optional[datetime],
+                         account_id: Optional[str], rule_id: Optional[str]) -> Dict[str, Any]:
+    """Подсчет по архивным файлам (блокирующий, выполняется в потоке)"""
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    filters = []
+    if since:
+        filters.append(("timestamp", ">=", since))
+    if until:
+        filters.append(("timestamp", "<", until))
+    if account_id:
+        filters.append(("account_id", "=", account_id))
+    if rule_id:
+        filters.append(("rule_id", "=", rule_id))
+
+    totals = {"total": 0, "success": 0, "failed": 0}
+    by_day: Dict[str, Dict[str, int]] = {}
+    for path in paths:
+        table = pq.read_table(path, columns=["timestamp", "success"], filters=filters or None)
+        if table.num_rows == 0:
+            continue
+        days = pc.strftime(table["timestamp"], format="%Y-%m-%d")
+        grouped = table.append_column("day", days).group_by("day").aggregate([
+            ("success", "count"),
+            ("success", "sum"),
+        ])
+        for day, count, success in zip(grouped["day"].to_pylist(),
+                                       grouped["success_count"].to_pylist(),
+                                       grouped["success_sum"].to_pylist()):
+            success = success or 0
+            counters = by_day.setdefault(day, {"total": 0, "success": 0, "failed": 0})
+            counters["total"] += count
+            counters["success"] += success
+            counters["failed"] += count - success
+
+    for counters in by_day.values():
+        for field in totals:
+            totals[field] += counters[field]
+    return {
+        **totals,
+        "by_day": [{"day": day, **counters} for day, counters in sorted(by_day.items())],
+    }
+
+
+class LogArchiver:
+    """Архивирование и удаление логов активности старше срока хранения"""
+
+    def __init__(self, db, store: ActivityLogStore, archive_dir: str):
+        self.db = db
+        self.store = store
+        self.archive_dir = archive_dir
+        self._lock = asyncio.Lock()
+
+    async def ensure_ttl_index(self, retention_days: int):
+        """Автоудаление по timestamp: срок хранения + запас (0 - хранить всегда)"""
+        if retention_days <= 0:
+            await self.store.set_expiration(None, TTL_INDEX_NAME)
+            return
+        expire_after = int(timedelta(days=retention_days + TTL_GRACE_DAYS).total_seconds())
+        await self.store.set_expiration(expire_after, TTL_INDEX_NAME)
+
+    async def apply_retention(self, retention_days: int) -> int:
+        """Архивирование, затем автоудаление; при сбое архива автоудаление снимается"""
+        try:
+            archived = await self.archive_expired(retention_days)
+        except Exception:
+            await self.ensure_ttl_index(0)
+            raise
+        await self.ensure_ttl_index(retention_days)
+        return archived
+
+    async def archive_expired(self, retention_days: int, now: Optional[datetime] = None) -> int:
+        """Выгрузка и удаление логов старше срока хранения, по одним суткам за раз"""
+        if retention_days <= 0:
+            return 0
+
+        async with self._lock:
+            cutoff = _day_start(now or datetime.utcnow()) - timedelta(days=retention_days)
+            archived = 0
+            while True:
+                oldest = await self.store.oldest_timestamp(before=cutoff)
+                if oldest is None:
+                    break
+                day = _day_start(oldest)
+                archived += await self._archive_window(day, min(day + timedelta(days=1), cutoff))
+
+            # Поминутные агрегаты нужны только для свежих графиков (без срока
+            # хранения их удаляет TTL-индекс, см. ROLLUP_INDEXES)
+            await self.db.activity_rollups.delete_many({"granularity": "minute", "bucket": {"$lt": cutoff}})
+            return archived
+
+    async def _archive_window(self, since: datetime, until: datetime) -> int:
+        directory = os.path.join(self.archive_dir, since.strftime("%Y"), since.strftime("%m"))
+        os.makedirs(directory, exist_ok=True)
+        # Если в сутки позже попадут еще записи, они уйдут в отдельную часть
+        file_name = f"activity_logs_{since.strftime('%Y%m%d')}_{uuid.uuid4().hex[:8]}.parquet"
+        path = os.path.join(directory, file_name)
+        tmp_path = os.path.join(directory, f".tmp_{file_name}")
+
+        try:
+            rows = await export_parquet(
+                self.store, tmp_path, compression=ARCHIVE_COMPRESSION,
+                since=since, until=until
+            )
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        # Запись об архиве сохраняется до удаления логов: при сбое данные есть в обоих местах
+        await self.db[LOG_ARCHIVES].insert_one({
+            "id": str(uuid.uuid4()),
+            "since": since,
+            "until": until,
+            "path": path,
+            "rows": rows,
+            "file_size": os.path.getsize(path),
+            "archived_at": datetime.utcnow(),
+        })
+        deleted = await self.store.delete_range(since, until)
+        logger.info(f"Archived {rows} activity logs for {since.date()} to {path}, deleted {deleted}")
+        return rows
+
+    async def list_archives(self, since: Optional[datetime] = None,
+                            until: Optional[datetime] = None) -> List[dict]:
+        """Архивные окна, пересекающиеся с интервалом"""
+        query: Dict[str, Any] = {}
+        if since:
+            query["until"] = {"$gt": since}
+        if until:
+            query["since"] = {"$lt": until}
+        return await self.db[LOG_ARCHIVES].find(query, {"_id": 0}).sort("since", 1).to_list(None)
+
+    async def read_archived_stats(self, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                                  account_id: Optional[str] = None,
+                                  rule_id: Optional[str] = None) -> Dict[str, Any]:
+        """Статистика по архивным окнам (чтение Parquet вне event loop)"""
+        archives = await self.list_archives(since, until)
+        paths = [archive["path"] for archive in archives if os.path.exists(archive["path"])]
+        loop = asyncio.get_running_loop()
+        stats = await loop.run_in_executor(
+            None, _read_archive_counts, paths, since, until, account_id, rule_id
+        )
+        stats["archives"] = len(paths)
+        return stats
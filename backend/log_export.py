@@ -0,0 +1,135 @@
+"""Потоковая выгрузка логов активности (NDJSON, CSV, Parquet).
+
+Записи читаются курсором Motor пачками и сразу отдаются клиенту, поэтому
+память не зависит от объема выгрузки.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from activity_logs import ActivityLogStore
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("ndjson", "csv", "parquet")
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_BATCH_SIZE = 1000
+# Размер группы строк Parquet: компромисс между памятью и сжатием
+PARQUET_ROW_GROUP_SIZE = 10000
+
+# Колонки выгрузки в порядке полей BotActivityLog
+LOG_EXPORT_FIELDS = [
+    "id", "timestamp", "account_id", "chat_id", "chat_type", "user_id", "username",
+    "first_name", "message_text", "rule_id", "action_taken", "success", "error_message",
+]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+async def iter_ndjson(store: ActivityLogStore, **filters) -> AsyncIterator[bytes]:
+    """Выгрузка в NDJSON: одна запись на строку"""
+    async for batch in store.iter_batches(EXPORT_BATCH_SIZE, **filters):
+        yield "".join(
+            json.dumps(doc, default=_json_default, ensure_ascii=False) + "\n" for doc in batch
+        ).encode()
+
+
+async def iter_csv(store: ActivityLogStore, **filters) -> AsyncIterator[bytes]:
+    """Выгрузка в CSV с заголовком"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=LOG_EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    async for batch in store.iter_batches(EXPORT_BATCH_SIZE, **filters):
+        for doc in batch:
+            writer.writerow({
+                key: value.isoformat() if isinstance(value, datetime) else value
+                for key, value in doc.items()
+            })
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # Пустая выгрузка: только заголовок
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def log_parquet_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.string()),
+        ("timestamp", pa.timestamp("ms")),
+        ("account_id", pa.string()),
+        ("chat_id", pa.int64()),
+        ("chat_type", pa.string()),
+        ("user_id", pa.int64()),
+        ("username", pa.string()),
+        ("first_name", pa.string()),
+        ("message_text", pa.string()),
+        ("rule_id", pa.string()),
+        ("action_taken", pa.string()),
+        ("success", pa.bool_()),
+        ("error_message", pa.string()),
+    ])
+
+
+class ParquetLogWriter:
+    """Запись логов в Parquet по группам строк (методы блокирующие)"""
+
+    def __init__(self, path: str, compression: str = "zstd"):
+        self.path = path
+        self.compression = compression
+        self.rows = 0
+        self._schema = log_parquet_schema()
+        self._writer = None
+
+    def write_batch(self, docs: List[dict]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+        table = pa.Table.from_pylist(docs, schema=self._schema)
+        self._writer.write_table(table)
+        self.rows += len(docs)
+
+    def close(self):
+        if self._writer is None:
+            # Пустая выгрузка: файл только со схемой
+            self.write_batch([])
+        self._writer.close()
+
+
+async def export_parquet(store: ActivityLogStore, path: str, compression: str = "zstd", **filters) -> int:
+    """Выгрузка в Parquet-файл; кодирование и сжатие выполняются вне event loop"""
+    loop = asyncio.get_running_loop()
+    writer = ParquetLogWriter(path, compression)
+    try:
+        async for batch in store.iter_batches(PARQUET_ROW_GROUP_SIZE, **filters):
+            await loop.run_in_executor(None, writer.write_batch, batch)
+    finally:
+        await loop.run_in_executor(None, writer.close)
+    return writer.rows
+
+
+def export_filename(export_format: str, since: Optional[datetime] = None,
+                    until: Optional[datetime] = None) -> str:
+    """Имя файла выгрузки по формату и интервалу"""
+    parts = ["activity_logs"]
+    if since:
+        parts.append(since.strftime("%Y%m%d"))
+    if until:
+        parts.append(until.strftime("%Y%m%d"))
+    return "_".join(parts) + f".{export_format}"
@@ -0,0 +1,169 @@
+"""Обнаружение циклов автоответов (наш аккаунт и другой бот отвечают друг другу).
+
+По каждой тройке (аккаунт, чат, собеседник) ведутся счетчики входящих
+сообщений собеседника и наших ответов ему в скользящем окне из нескольких
+корзин. Если за окно набирается max_exchanges обменов в обе стороны (для
+ботов - вдвое меньше), срабатывает предохранитель: аккаунт замолкает в этом
+чате на mute_seconds, а в системные уведомления уходит предупреждение.
+
+Ответ проверяется перед отправкой (allow_reply), а учитывается только после
+того, как он действительно ушел (record_reply): ответы, пропущенные из-за
+кулдауна или дневного лимита, цикл не образуют.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from models import SystemNotification
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeCounter:
+    """Счетчики входящих и ответов в скользящем окне из buckets корзин"""
+
+    __slots__ = ("bucket", "incoming", "replies", "last_seen")
+
+    def __init__(self, buckets: int):
+        self.bucket = 0
+        self.incoming = [0] * buckets
+        self.replies = [0] * buckets
+        self.last_seen = 0.0
+
+    def _advance(self, bucket: int):
+        """Сдвиг окна: корзины, из которых вышло время, обнуляются"""
+        size = len(self.incoming)
+        for index in range(self.bucket + 1, min(bucket, self.bucket + size) + 1):
+            self.incoming[index % size] = 0
+            self.replies[index % size] = 0
+        self.bucket = max(self.bucket, bucket)
+
+    def add(self, bucket: int, now: float, incoming: int = 0, replies: int = 0):
+        self._advance(bucket)
+        index = bucket % len(self.incoming)
+        self.incoming[index] += incoming
+        self.replies[index] += replies
+        self.last_seen = now
+
+    def exchanges(self, extra_replies: int = 0) -> int:
+        """Число обменов за окно: меньшее из входящих и ответов"""
+        return min(sum(self.incoming), sum(self.replies) + extra_replies)
+
+
+class LoopGuard:
+    """Счетчики обменов по чатам и предохранитель, заглушающий аккаунт в чате"""
+
+    def __init__(self, db, window_seconds: int = 120, buckets: int = 12,
+                 max_exchanges: int = 8, mute_seconds: int = 1800):
+        self.db = db
+        self.bucket_seconds = window_seconds / buckets
+        self.buckets = buckets
+        self.window_seconds = window_seconds
+        self.max_exchanges = max_exchanges
+        self.mute_seconds = mute_seconds
+        self._counters: Dict[Tuple[str, int, int], ExchangeCounter] = {}
+        self._mutes: Dict[Tuple[str, int], float] = {}
+        self._next_purge = 0.0
+
+    def is_muted(self, account_id: str, chat_id: int) -> bool:
+        until = self._mutes.get((account_id, chat_id))
+        if until is None:
+            return False
+        if time.monotonic() >= until:
+            del self._mutes[(account_id, chat_id)]
+            logger.info(f"Account {account_id} unmuted in chat {chat_id}")
+            return False
+        return True
+
+    def _counter(self, account_id: str, chat_id: int, user_id: int, now: float) -> ExchangeCounter:
+        self._purge(now)
+        key = (account_id, chat_id, user_id)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = ExchangeCounter(self.buckets)
+            counter.bucket = int(now / self.bucket_seconds)
+        return counter
+
+    def _purge(self, now: float):
+        """Удаление счетчиков собеседников, молчащих дольше окна"""
+        if now < self._next_purge:
+            return
+        self._counters = {
+            key: counter for key, counter in self._counters.items()
+            if now - counter.last_seen < self.window_seconds
+        }
+        self._next_purge = now + self.window_seconds
+
+    def record_incoming(self, account_id: str, message):
+        if message.from_user is None:
+            return
+        now = time.monotonic()
+        counter = self._counter(account_id, message.chat.id, message.from_user.id, now)
+        counter.add(int(now / self.bucket_seconds), now, incoming=1)
+
+    async def allow_reply(self, account_id: str, message, rule_id: str) -> bool:
+        """Проверка перед ответом; False, если аккаунт заглушен или ответ замкнет цикл"""
+        if self.is_muted(account_id, message.chat.id):
+            return False
+        if message.from_user is None:
+            return True
+        now = time.monotonic()
+        counter = self._counter(account_id, message.chat.id, message.from_user.id, now)
+        counter.add(int(now / self.bucket_seconds), now)
+
+        limit = self.max_exchanges // 2 if message.from_user.is_bot else self.max_exchanges
+        exchanges = counter.exchanges(extra_replies=1)
+        if exchanges < limit:
+            return True
+
+        await self._trip(account_id, message, rule_id, exchanges)
+        return False
+
+    def record_reply(self, account_id: str, message):
+        """Учет отправленного ответа"""
+        if message.from_user is None:
+            return
+        now = time.monotonic()
+        counter = self._counter(account_id, message.chat.id, message.from_user.id, now)
+        counter.add(int(now / self.bucket_seconds), now, replies=1)
+
+    async def _trip(self, account_id: str, message, rule_id: str, exchanges: int):
+        chat_id = message.chat.id
+        self._mutes[(account_id, chat_id)] = time.monotonic() + self.mute_seconds
+        self._counters.pop((account_id, chat_id, message.from_user.id), None)
+
+        counterpart = message.from_user.username or message.from_user.id
+        logger.warning(f"Reply loop detected: account {account_id}, chat {chat_id}, "
+                       f"counterpart {counterpart}, rule {rule_id}; muted for {self.mute_seconds}s")
+        notification = SystemNotification(
+            type="warning",
+            title="Обнаружен цикл автоответов",
+            message=(
+                f"Аккаунт {account_id} и {'бот' if message.from_user.is_bot else 'пользователь'} "
+                f"{counterpart} обменялись {exchanges} сообщениями за {self.window_seconds} с "
+                f"(правило {rule_id}). Ответы в чате {chat_id} приостановлены на "
+                f"{self.mute_seconds // 60} мин."
+            ),
+            expires_at=datetime.utcnow() + timedelta(seconds=self.mute_seconds)
+        )
+        try:
+            await self.db.system_notifications.insert_one(notification.dict())
+        except Exception as e:
+            logger.error(f"Failed to store loop notification: {e}")
+
+    def active_mutes(self) -> List[Dict]:
+        """Действующие заглушения"""
+        now = time.monotonic()
+        return [
+            {"account_id": account_id, "chat_id": chat_id, "remaining_seconds": round(until - now)}
+            for (account_id, chat_id), until in self._mutes.items()
+            if until > now
+        ]
+
+    def unmute(self, account_id: str, chat_id: Optional[int] = None):
+        """Снятие заглушения (всех чатов аккаунта, если chat_id не указан)"""
+        self._mutes = {
+            key: until for key, until in self._mutes.items()
+            if not (key[0] == account_id and (chat_id is None or key[1] == chat_id))
+        }
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from models import MediaFile
+
+logger = logging.getLogger(__name__)
+
+# Коллекции, из которых собирается каталог
+BOT_IMAGES = "bot_images"
+MEDIA_FILES = "media_files"
+
+
+def _normalize_path(file_path: str) -> str:
+    return os.path.normpath(file_path)
+
+
+class MediaCatalog:
+    """Единый каталог медиа из bot_images и media_files с индексом в памяти"""
+
+    def __init__(self, db, refresh_seconds: int = 300, miss_reload_seconds: int = 10):
+        self.db = db
+        self._by_id: Dict[str, MediaFile] = {}
+        self._by_path: Dict[str, MediaFile] = {}
+        self._sources: Dict[str, str] = {}
+        self._refresh_seconds = refresh_seconds
+        self._expires_at = datetime.min
+        # Промах по ID перечитывает каталог не чаще раза в miss_reload_seconds
+        # (файлы могли быть загружены через другой процесс)
+        self._miss_reload_seconds = miss_reload_seconds
+        self._loaded_at = datetime.min
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """Полная загрузка каталога из обеих коллекций"""
+        by_id: Dict[str, MediaFile] = {}
+        by_path: Dict[str, MediaFile] = {}
+        sources: Dict[str, str] = {}
+
+        # Записи media_files загружаются последними и имеют приоритет
+        for source in (BOT_IMAGES, MEDIA_FILES):
+            async for doc in self.db[source].find():
+                entry = self._to_entry(doc, source)
+                by_id[entry.id] = entry
+                by_path[_normalize_path(entry.file_path)] = entry
+                sources[entry.id] = source
+
+        self._by_id, self._by_path, self._sources = by_id, by_path, sources
+        self._loaded_at = datetime.utcnow()
+        self._expires_at = self._loaded_at + timedelta(seconds=self._refresh_seconds)
+        logger.info(f"Media catalog loaded: {len(by_id)} files")
+
+    async def ensure_loaded(self):
+        """Загрузка каталога при первом обращении и периодическое обновление"""
+        if datetime.utcnow() < self._expires_at:
+            return
+        async with self._load_lock:
+            if datetime.utcnow() >= self._expires_at:
+                await self.load()
+
+    async def _reload_on_miss(self):
+        if datetime.utcnow() - self._loaded_at < timedelta(seconds=self._miss_reload_seconds):
+            return
+        async with self._load_lock:
+            if datetime.utcnow() - self._loaded_at >= timedelta(seconds=self._miss_reload_seconds):
+                await self.load()
+
+    def add(self, entry: MediaFile, source: str = MEDIA_FILES):
+        """Добавление или обновление записи после загрузки файла"""
+        previous = self._by_id.get(entry.id)
+        if previous is not None:
+            self._by_path.pop(_normalize_path(previous.file_path), None)
+        self._by_id[entry.id] = entry
+        self._by_path[_normalize_path(entry.file_path)] = entry
+        self._sources[entry.id] = source
+
+    def remove(self, file_id: str) -> Optional[MediaFile]:
+        """Удаление записи из каталога"""
+        entry = self._by_id.pop(file_id, None)
+        self._sources.pop(file_id, None)
+        if entry is not None:
+            path_key = _normalize_path(entry.file_path)
+            if self._by_path.get(path_key) is entry:
+                del self._by_path[path_key]
+                # Повторные загрузки того же файла ссылаются на тот же путь
+                for other in self._by_id.values():
+                    if _normalize_path(other.file_path) == path_key:
+                        self._by_path[path_key] = other
+                        break
+        return entry
+
+    async def remember_telegram_file_id(self, entry: MediaFile, account_id: str, telegram_file_id: str):
+        """Сохранение file_id, полученного от Telegram, для повторных отправок"""
+        entry.telegram_file_ids[account_id] = telegram_file_id
+        source = self._sources.get(entry.id)
+        if source:
+            await self.db[source].update_one(
+                {"id": entry.id},
+                {"$set": {f"telegram_file_ids.{account_id}": telegram_file_id}}
+            )
+
+    async def forget_telegram_file_id(self, entry: MediaFile, account_id: str):
+        """Удаление устаревшего file_id"""
+        if entry.telegram_file_ids.pop(account_id, None) is None:
+            return
+        source = self._sources.get(entry.id)
+        if source:
+            await self.db[source].update_one(
+                {"id": entry.id},
+                {"$unset": {f"telegram_file_ids.{account_id}": ""}}
+            )
+
+    def source_of(self, file_id: str) -> Optional[str]:
+        """Коллекция, в которой хранится запись"""
+        return self._sources.get(file_id)
+
+    async def get(self, file_id: str) -> Optional[MediaFile]:
+        """Получение записи по ID"""
+        await self.ensure_loaded()
+        if file_id not in self._by_id:
+            await self._reload_on_miss()
+        return self._by_id.get(file_id)
+
+    async def get_by_path(self, file_path: str) -> Optional[MediaFile]:
+        """Получение записи по пути к файлу"""
+        await self.ensure_loaded()
+        return self._by_path.get(_normalize_path(file_path))
+
+    async def get_many(self, file_ids: Iterable[str]) -> List[MediaFile]:
+        """Пакетное получение записей по ID (порядок сохраняется, отсутствующие пропускаются)"""
+        await self.ensure_loaded()
+        file_ids = list(file_ids)
+        if any(file_id not in self._by_id for file_id in file_ids):
+            await self._reload_on_miss()
+        return [self._by_id[file_id] for file_id in file_ids if file_id in self._by_id]
+
+    async def list(self, file_type: Optional[str] = None, tags: Optional[List[str]] = None,
+                   active_only: bool = True) -> List[MediaFile]:
+        """Список записей каталога с фильтрами"""
+        await self.ensure_loaded()
+        entries = []
+        for entry in self._by_id.values():
+            if active_only and not entry.is_active:
+                continue
+            if file_type and entry.file_type != file_type:
+                continue
+            if tags and not set(tags) & set(entry.tags):
+                continue
+            entries.append(entry)
+        entries.sort(key=lambda entry: entry.uploaded_at, reverse=True)
+        return entries
+
+    @staticmethod
+    def _to_entry(doc: dict, source: str) -> MediaFile:
+        doc = {key: value for key, value in doc.items() if key != "_id"}
+        if source == BOT_IMAGES:
+            # В bot_images хранятся только картинки
+            doc.setdefault("file_type", "image")
+        return MediaFile(**doc)
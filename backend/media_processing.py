@@ -0,0 +1,175 @@
+"""Обработка изображений в отдельных процессах.
+
+Функции этого модуля выполняются в ProcessPoolExecutor, поэтому принимают и
+возвращают только простые типы и не зависят от состояния сервера.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Telegram сжимает фото до 2560px по большей стороне, больше хранить нет смысла
+TELEGRAM_PHOTO_MAX_SIDE = 2560
+# Лимит Telegram на размер фото
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+# Защита от "декомпрессионных бомб"
+MAX_IMAGE_PIXELS = 80_000_000
+
+THUMBNAIL_SIDE = 320
+JPEG_QUALITY = 87
+
+# Расширения и MIME-типы для форматов, в которых сохраняется результат
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+FORMAT_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+class ImageProcessingError(ValueError):
+    """Файл не является корректным изображением"""
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Пул процессов для обработки изображений (создается при первом обращении)"""
+    global _pool
+    if _pool is None:
+        workers = int(os.environ.get("MEDIA_PROCESS_WORKERS", "2"))
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def shutdown_pool():
+    """Остановка пула процессов"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def run_in_pool(func, *args):
+    """Выполнение функции в пуле процессов без блокировки event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), func, *args)
+
+
+def _atomic_save(image, target_path: str, image_format: str, **save_kwargs):
+    """Запись изображения во временный файл и атомарная замена целевого"""
+    directory = os.path.dirname(target_path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.splitext(target_path)[1])
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            image.save(tmp_file, format=image_format, **save_kwargs)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _save_kwargs(image_format: str) -> Dict:
+    if image_format == "JPEG":
+        return {"quality": JPEG_QUALITY, "optimize": True, "progressive": True}
+    if image_format == "WEBP":
+        return {"quality": JPEG_QUALITY, "method": 4}
+    if image_format == "PNG":
+        return {"optimize": True}
+    return {}
+
+
+def process_image(source_path: str, target_stem: str, thumbnail_path: str) -> Dict:
+    """Проверка, очистка метаданных, уменьшение и создание миниатюры.
+
+    Результат записывается атомарно в target_stem + расширение формата, исходный
+    файл не изменяется. Для анимированных изображений создается только миниатюра,
+    а в результате возвращается path=None.
+    """
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    try:
+        with Image.open(source_path) as probe:
+            probe.verify()
+    except Exception as e:
+        raise ImageProcessingError(f"Invalid image file: {e}")
+
+    with Image.open(source_path) as original:
+        image_format = original.format
+        is_animated = getattr(original, "is_animated", False)
+
+        # Учитываем ориентацию из EXIF до удаления метаданных
+        image = ImageOps.exif_transpose(original) if not is_animated else original
+
+        target_path = None
+        if not is_animated:
+            if image_format not in FORMAT_EXTENSIONS:
+                image_format = "JPEG"
+
+            if max(image.size) > TELEGRAM_PHOTO_MAX_SIDE:
+                image = image.copy()
+                image.thumbnail((TELEGRAM_PHOTO_MAX_SIDE, TELEGRAM_PHOTO_MAX_SIDE), Image.LANCZOS)
+
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            # EXIF, XMP и текстовые блоки не передаются в save и не попадают в результат;
+            # цветовой профиль сохраняем, чтобы не исказить цвета
+            icc_profile = original.info.get("icc_profile")
+            clean = image.copy()
+            clean.info = {}
+            save_kwargs = _save_kwargs(image_format)
+            if icc_profile:
+                save_kwargs["icc_profile"] = icc_profile
+            target_path = target_stem + FORMAT_EXTENSIONS[image_format]
+            _atomic_save(clean, target_path, image_format, **save_kwargs)
+
+            # Слишком тяжелый PNG перекодируем в JPEG
+            if image_format == "PNG" and os.path.getsize(target_path) > TELEGRAM_PHOTO_MAX_BYTES:
+                os.unlink(target_path)
+                image_format = "JPEG"
+                target_path = target_stem + FORMAT_EXTENSIONS[image_format]
+                save_kwargs = {**_save_kwargs(image_format), **({"icc_profile": icc_profile} if icc_profile else {})}
+                _atomic_save(clean.convert("RGB"), target_path, image_format, **save_kwargs)
+
+        width, height = image.size
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.LANCZOS)
+        if thumbnail.mode not in ("RGB", "L"):
+            thumbnail = thumbnail.convert("RGB")
+        _atomic_save(thumbnail, thumbnail_path, "JPEG", **_save_kwargs("JPEG"))
+
+    return {
+        "path": target_path,
+        "mime_type": FORMAT_MIME_TYPES.get(image_format),
+        "width": width,
+        "height": height,
+        "file_size": os.path.getsize(target_path or source_path),
+    }
+
+
+def make_image_variant(source_path: str, target_path: str, width: int) -> Dict:
+    """Создание уменьшенной копии изображения заданной ширины (JPEG)"""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    try:
+        with Image.open(source_path) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), Image.LANCZOS)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.info = {}
+            _atomic_save(image, target_path, "JPEG", **_save_kwargs("JPEG"))
+            return {"width": image.width, "height": image.height}
+    except OSError as e:
+        raise ImageProcessingError(f"Invalid image file: {e}")
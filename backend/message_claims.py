@@ -0,0 +1,113 @@
+"""Дедупликация ответов, когда одно сообщение видят несколько наших аккаунтов.
+
+Аккаунт, собравшийся ответить, сначала "берет" сообщение. Заявки хранятся
+локально (все аккаунты одного процесса) и в коллекции message_claims с
+уникальным ключом и TTL-индексом (рабочие процессы и другие узлы).
+Побеждает первая вставка; повторная заявка того же аккаунта тоже успешна.
+
+Ключ - (chat_id, message_id) для супергрупп. В обычных группах у каждого
+участника своя нумерация сообщений, поэтому ключ строится из отправителя,
+времени и текста сообщения. Заявка берется на сообщение, а не на правило:
+правила у каждого аккаунта свои, и ключ с ID правила никогда бы не совпал.
+Аккаунт, взявший сообщение, отвечает на него всеми своими правилами.
+
+Правило с политикой DESIGNATED отвечает только на назначенном аккаунте и
+забирает сообщение у аккаунтов с политикой FIRST, которые еще не ответили.
+Правило назначенного аккаунта заводится на нем самом, политика правил других
+аккаунтов в общем чате - FIRST или DESIGNATED с тем же аккаунтом.
+
+Правила, сохраненные до появления политики, читаются с политикой ALL (как
+раньше, отвечают все аккаунты); новые правила по умолчанию создаются с FIRST.
+"""
+import hashlib
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from models import AutoReplyRule, DedupPolicy
+from rule_compiler import message_chat_type
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CLAIMS = "message_claims"
+
+
+def message_claim_key(message) -> Optional[str]:
+    """Ключ сообщения, общий для всех аккаунтов в чате (None - общего чата нет)"""
+    chat_type = message_chat_type(message)
+    if chat_type in ("supergroup", "channel"):
+        return f"{message.chat.id}:{message.id}"
+    if chat_type == "group":
+        sender = message.from_user.id if message.from_user else 0
+        text = message.text or message.caption or ""
+        digest = hashlib.sha1(text.encode()).hexdigest()[:16]
+        return f"{message.chat.id}:{sender}:{int(message.date.timestamp())}:{digest}"
+    # Личные чаты у каждого аккаунта свои
+    return None
+
+
+class MessageClaims:
+    """Заявки аккаунтов на ответ: локальный индекс + общая коллекция Mongo"""
+
+    def __init__(self, db, ttl_seconds: int = 600):
+        self.collection = db[MESSAGE_CLAIMS]
+        self.ttl_seconds = ttl_seconds
+        self._local: Dict[str, Tuple[str, float]] = {}
+        self._next_purge = 0.0
+
+    async def initialize(self):
+        await self.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+
+    def _purge(self, now: float):
+        if now < self._next_purge:
+            return
+        self._local = {key: claim for key, claim in self._local.items() if claim[1] > now}
+        self._next_purge = now + self.ttl_seconds / 10
+
+    async def claim(self, key: str, account_id: str, force: bool = False) -> bool:
+        """True, если сообщение за этим аккаунтом (force - забрать у другого аккаунта)"""
+        now = time.monotonic()
+        self._purge(now)
+        if force:
+            self._local[key] = (account_id, now + self.ttl_seconds)
+            await self.collection.update_one(
+                {"_id": key},
+                {"$set": {"account_id": account_id, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+            return True
+
+        local = self._local.get(key)
+        if local and local[1] > now:
+            return local[0] == account_id
+
+        try:
+            await self.collection.insert_one(
+                {"_id": key, "account_id": account_id, "created_at": datetime.utcnow()}
+            )
+            owner = account_id
+        except DuplicateKeyError:
+            claim = await self.collection.find_one({"_id": key}, {"account_id": 1})
+            # Заявка могла истечь между вставкой и чтением
+            owner = claim["account_id"] if claim else account_id
+        self._local[key] = (owner, now + self.ttl_seconds)
+        return owner == account_id
+
+    async def should_reply(self, message, rule: AutoReplyRule, account_id: str) -> bool:
+        """Решение по политике правила, отвечает ли этот аккаунт на сообщение"""
+        if rule.dedup_policy == DedupPolicy.ALL:
+            return True
+        key = message_claim_key(message)
+        if key is None:
+            return True
+        if rule.dedup_policy == DedupPolicy.DESIGNATED and rule.designated_account_id:
+            if account_id != rule.designated_account_id:
+                return False
+            return await self.claim(key, account_id, force=True)
+        won = await self.claim(key, account_id)
+        if not won:
+            logger.debug(f"Message {key} already claimed by another account, {account_id} skips")
+        return won
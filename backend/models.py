@@ -1,7 +1,8 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 import uuid
+from bson import ObjectId
 from enum import Enum
 
 
@@ -19,6 +20,13 @@ class BotStatus(str, Enum):
     ERROR = "error"
 
 
+class DedupPolicy(str, Enum):
+    """Кто отвечает, если сообщение в общем чате видят несколько наших аккаунтов"""
+    FIRST = "first"  # первый аккаунт, взявший сообщение
+    DESIGNATED = "designated"  # только designated_account_id
+    ALL = "all"  # все аккаунты
+
+
 # Telegram Account Models
 class TelegramAccount(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -62,6 +70,13 @@ class ChatFilter(BaseModel):
     max_members: Optional[int] = None  # максимум участников
 
 
+# Telegram ограничивает callback_data 64 байтами, а кнопка правила отправляет
+# "<id правила>:<callback_data>": на данные пользователя остается 27 байт
+MAX_CALLBACK_DATA_BYTES = 64
+RULE_ID_LENGTH = 36
+MAX_BUTTON_CALLBACK_BYTES = MAX_CALLBACK_DATA_BYTES - RULE_ID_LENGTH - 1
+
+
 class InlineButton(BaseModel):
     """Инлайн кнопка"""
     text: str  # текст кнопки
@@ -129,6 +144,27 @@ class ConditionalRule(BaseModel):
     else_action: Optional[ReplyAction] = None
 
 
+def check_button_callbacks(actions: Optional[List[ReplyAction]]) -> Optional[List[ReplyAction]]:
+    """Проверка длины callback_data кнопок действий (для создания и изменения правил)"""
+    for action in actions or []:
+        for row in action.inline_buttons:
+            for button in row:
+                if button.callback_data and len(button.callback_data.encode("utf-8")) > MAX_BUTTON_CALLBACK_BYTES:
+                    raise ValueError(
+                        f"callback_data of button '{button.text}' exceeds {MAX_BUTTON_CALLBACK_BYTES} bytes"
+                    )
+    return actions
+
+
+def check_conditional_callbacks(
+        conditional_rules: Optional[List[ConditionalRule]]) -> Optional[List[ConditionalRule]]:
+    for conditional in conditional_rules or []:
+        check_button_callbacks([conditional.if_action])
+        if conditional.else_action:
+            check_button_callbacks([conditional.else_action])
+    return conditional_rules
+
+
 class AutoReplyRule(BaseModel):
     """Расширенное правило автоответа"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -154,6 +190,11 @@ class AutoReplyRule(BaseModel):
     # Привязка
     account_id: Optional[str] = None
     
+    # Ответ в чатах, общих для нескольких аккаунтов. Сохраненные раньше правила
+    # отвечают как прежде (ALL); новые создаются с FIRST (AutoReplyRuleCreate)
+    dedup_policy: DedupPolicy = DedupPolicy.ALL
+    designated_account_id: Optional[str] = None
+    
     # Метаданные
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -177,6 +218,11 @@ class AutoReplyRuleCreate(BaseModel):
     max_triggers_per_day: Optional[int] = None
     cooldown_seconds: int = 0
     account_id: Optional[str] = None
+    dedup_policy: DedupPolicy = DedupPolicy.FIRST
+    designated_account_id: Optional[str] = None
+
+    _check_actions = field_validator("actions")(check_button_callbacks)
+    _check_conditional_rules = field_validator("conditional_rules")(check_conditional_callbacks)
 
 
 class AutoReplyRuleUpdate(BaseModel):
@@ -190,8 +236,13 @@ class AutoReplyRuleUpdate(BaseModel):
     priority: Optional[int] = None
     max_triggers_per_day: Optional[int] = None
     cooldown_seconds: Optional[int] = None
+    dedup_policy: Optional[DedupPolicy] = None
+    designated_account_id: Optional[str] = None
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+    _check_actions = field_validator("actions")(check_button_callbacks)
+    _check_conditional_rules = field_validator("conditional_rules")(check_conditional_callbacks)
+
 
 # Image Models
 class BotImage(BaseModel):
@@ -233,6 +284,7 @@ class BotSettings(BaseModel):
     allowed_chat_types: List[str] = ["private", "group", "supergroup"]  # типы чатов для ответов
     blacklisted_users: List[str] = []  # ID заблокированных пользователей
     whitelisted_users: List[str] = []  # ID разрешенных пользователей (если не пустой, то только им отвечаем)
+    log_retention_days: int = 0  # срок хранения логов активности в базе (0 - хранить всегда)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -247,12 +299,13 @@ class BotSettingsUpdate(BaseModel):
     allowed_chat_types: Optional[List[str]] = None
     blacklisted_users: Optional[List[str]] = None
     whitelisted_users: Optional[List[str]] = None
+    log_retention_days: Optional[int] = Field(default=None, ge=0)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 
 # Bot Activity Log Models
 class BotActivityLog(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: str(ObjectId()))  # ObjectId: время создания + уникальный хвост
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     account_id: str
     chat_id: int
@@ -323,6 +376,9 @@ class MediaFile(BaseModel):
     width: Optional[int] = None
     height: Optional[int] = None
     duration: Optional[int] = None  # для аудио/видео
+    thumbnail_path: Optional[str] = None  # миниатюра для галереи
+    content_hash: Optional[str] = None  # SHA-256 исходного файла (общий файл повторных загрузок)
+    telegram_file_ids: Dict[str, str] = {}  # file_id в Telegram по ID аккаунта
     uploaded_at: datetime = Field(default_factory=datetime.utcnow)
     uploaded_by: Optional[str] = None  # ID пользователя
     tags: List[str] = []
@@ -0,0 +1,143 @@
+"""Хранилища сессий pyrogram с сохранением кэша пиров (см. session_storage).
+
+Модуль импортирует pyrogram, поэтому SessionStorageFactory загружает его
+только при создании первого клиента.
+"""
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pyrogram.storage import FileStorage, MemoryStorage
+from pyrogram.storage.sqlite_storage import SQLiteStorage
+
+from session_storage import PEER_SAVE_DELAY_SECONDS, SESSION_FIELDS, SESSION_FILE_MODE
+
+logger = logging.getLogger(__name__)
+
+
+async def read_session_string(session_string: str) -> Dict:
+    """Поля сессии из session_string (разбор средствами pyrogram)"""
+    source = MemoryStorage("import", session_string)
+    await source.open()
+    try:
+        return {field: await getattr(source, field)() for field in SESSION_FIELDS}
+    finally:
+        await source.close()
+
+
+class _DeferredSave:
+    """Отложенное сохранение пиров: pyrogram сам вызывает save() только при остановке"""
+
+    _save_task: Optional[asyncio.Task] = None
+
+    def _schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(PEER_SAVE_DELAY_SECONDS)
+        try:
+            await self.save()
+        except Exception as e:
+            logger.warning(f"Failed to save peers for session {self.name}: {e}")
+
+    def _cancel_save(self):
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+
+
+class SQLiteSessionStorage(_DeferredSave, FileStorage):
+    """Файл сессии pyrogram, авторизация которого берется из session_string.
+
+    Файл содержит auth_key в открытом виде, поэтому доступен только владельцу.
+    """
+
+    def __init__(self, name: str, workdir: Path, session_string: str):
+        super().__init__(name, workdir)
+        self.session_string = session_string
+
+    async def open(self):
+        await super().open()
+        self.database.chmod(SESSION_FILE_MODE)
+        session = await read_session_string(self.session_string)
+        if await self.auth_key() == session["auth_key"]:
+            return
+        # Новый файл или аккаунт авторизован заново
+        if await self.user_id() not in (None, session["user_id"]):
+            with self.conn:
+                self.conn.execute("DELETE FROM peers")
+        for field, value in session.items():
+            await getattr(self, field)(value)
+        await self.date(0)
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str, str]]):
+        await super().update_peers(peers)
+        self._schedule_save()
+
+    async def close(self):
+        self._cancel_save()
+        await super().close()
+
+
+class MongoSessionStorage(_DeferredSave, MemoryStorage):
+    """Сессия в памяти, кэш пиров которой загружается из Mongo и сохраняется в Mongo"""
+
+    def __init__(self, name: str, session_string: str, collection, account_id: str):
+        super().__init__(name, session_string)
+        self.collection = collection
+        self.account_id = account_id
+        self._pending: Dict[int, Tuple[int, int, str, str, str]] = {}
+
+    async def open(self):
+        await super().open()
+        docs = await self.collection.find(
+            {"account_id": self.account_id}, {"_id": 0, "account_id": 0}
+        ).to_list(None)
+        if not docs:
+            return
+        # Загрузка без пометки на сохранение
+        await SQLiteStorage.update_peers(self, [
+            (doc["id"], doc["access_hash"], doc["type"], doc.get("username"), doc.get("phone_number"))
+            for doc in docs
+        ])
+        # Возраст username сохраняется, чтобы не выдавать устаревшие (USERNAME_TTL)
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE peers SET last_update_on = ? WHERE id = ?",
+                [(doc.get("last_update_on", 0), doc["id"]) for doc in docs]
+            )
+        logger.debug(f"Loaded {len(docs)} peers for account {self.account_id}")
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str, str]]):
+        await super().update_peers(peers)
+        for peer in peers:
+            self._pending[peer[0]] = peer
+        self._schedule_save()
+
+    async def save(self):
+        await super().save()
+        if not self._pending:
+            return
+        peers, self._pending = self._pending, {}
+        now = int(time.time())
+        await self.collection.bulk_write([
+            UpdateOne(
+                {"account_id": self.account_id, "id": peer_id},
+                {"$set": {
+                    "access_hash": access_hash,
+                    "type": peer_type,
+                    "username": username,
+                    "phone_number": phone_number,
+                    "last_update_on": now,
+                }},
+                upsert=True
+            )
+            for peer_id, access_hash, peer_type, username, phone_number in peers.values()
+        ], ordered=False)
+
+    async def close(self):
+        self._cancel_save()
+        await super().close()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Iterable, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Ограниченный LRU+TTL кэш ответов API.
+
+    Одновременные промахи по одному ключу выполняют загрузку один раз
+    (single-flight), записи сбрасываются по тегам из эндпоинтов записи.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        # ключ -> (момент истечения, значение, теги)
+        self._entries: "OrderedDict[str, Tuple[float, Any, Tuple[str, ...]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tag_keys: Dict[str, Set[str]] = {}
+        # Версии тегов: результат загрузки, начатой до сброса тега, не кэшируется
+        self._tag_versions: Dict[str, int] = {}
+        self._metrics = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def cached(self, ttl_seconds: int, tags: Iterable[str] = ()):
+        """Декоратор для кэширования ответа эндпоинта"""
+        tags = tuple(tags)
+
+        def decorator(func: Callable[..., Awaitable[Any]]):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                key = self.make_key(func.__qualname__, args, kwargs)
+                return await self.get_or_load(key, lambda: func(*args, **kwargs), ttl_seconds, tags)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def make_key(name: str, args: tuple, kwargs: dict) -> str:
+        return f"{name}:{args!r}:{sorted(kwargs.items())!r}"
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]],
+                          ttl_seconds: int, tags: Tuple[str, ...] = ()) -> Any:
+        """Значение из кэша или результат загрузки"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._metrics["hits"] += 1
+                return entry[1]
+            self._drop(key)
+            self._metrics["expirations"] += 1
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._metrics["coalesced"] += 1
+            return await asyncio.shield(inflight)
+
+        self._metrics["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        versions = {tag: self._tag_versions.get(tag, 0) for tag in tags}
+        try:
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение получают ожидающие; если их нет, не засоряем лог
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if all(self._tag_versions.get(tag, 0) == version for tag, version in versions.items()):
+                self._store(key, value, ttl_seconds, tags)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, *tags: str) -> int:
+        """Сброс всех записей с указанными тегами"""
+        removed = 0
+        for tag in tags:
+            self._tag_versions[tag] = self._tag_versions.get(tag, 0) + 1
+            for key in list(self._tag_keys.get(tag, ())):
+                if key in self._entries:
+                    self._drop(key)
+                    removed += 1
+        self._metrics["invalidations"] += removed
+        return removed
+
+    def purge_expired(self) -> int:
+        """Удаление истекших записей"""
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry[0] <= now]
+        for key in expired:
+            self._drop(key)
+        self._metrics["expirations"] += len(expired)
+        return len(expired)
+
+    def clear(self):
+        self._entries.clear()
+        self._tag_keys.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики кэша"""
+        lookups = self._metrics["hits"] + self._metrics["misses"] + self._metrics["coalesced"]
+        return {
+            **self._metrics,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "inflight": len(self._inflight),
+            "hit_rate": self._metrics["hits"] / lookups * 100 if lookups else 0,
+        }
+
+    def _store(self, key: str, value: Any, ttl_seconds: int, tags: Tuple[str, ...]):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + ttl_seconds, value, tags)
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._drop(oldest_key)
+            self._metrics["evictions"] += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_keys[tag]
@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import logging
+import re
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+from models import (
+    MAX_CALLBACK_DATA_BYTES, AutoReplyRule, ConditionalRule, InlineButton, MediaContent, ReplyAction,
+    RuleTemplate
+)
+
+if TYPE_CHECKING:
+    from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Типы контента, которые отправляются сообщением в чат
+SEND_CONTENT_TYPES = ("text", "image", "sticker", "emoji")
+
+class RuleCompilationError(ValueError):
+    """Правило содержит ошибку, из-за которой его нельзя выполнить"""
+
+
+# Переменная шаблона: {user_name}, {chat_title}, ...
+TEMPLATE_VARIABLE_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+# Встроенные переменные шаблонов: имя -> функция (message, now) -> str
+BUILTIN_VARIABLES = {
+    "user_name": lambda message, now: message.from_user.first_name or "Пользователь",
+    "user_id": lambda message, now: str(message.from_user.id),
+    "username": lambda message, now: (
+        f"@{message.from_user.username}" if message.from_user.username else "без username"
+    ),
+    "chat_title": lambda message, now: getattr(message.chat, 'title', '') or 'Личные сообщения',
+    "chat_id": lambda message, now: str(message.chat.id),
+    "time": lambda message, now: now.strftime("%H:%M"),
+    "date": lambda message, now: now.strftime("%d.%m.%Y"),
+    "message_text": lambda message, now: message.text or message.caption or "",
+}
+
+# Переменные, которым нужно текущее время
+TIME_VARIABLES = {"time", "date"}
+
+
+class CompiledTemplate:
+    """Шаблон, разобранный на литералы и переменные"""
+
+    def __init__(self, text: str, custom_variables: Optional[Dict[str, str]] = None):
+        custom_variables = custom_variables or {}
+        self.text = text
+        self.segments: List[Union[str, tuple]] = []
+        self.needs_time = False
+
+        literal = []
+        position = 0
+        for match in TEMPLATE_VARIABLE_PATTERN.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            name = match.group(1)
+
+            if name in BUILTIN_VARIABLES:
+                prefix = "".join(literal)
+                if prefix:
+                    self.segments.append(prefix)
+                literal = []
+                # Переменная хранится кортежем, чтобы отличать ее от литерала
+                self.segments.append((name,))
+                self.needs_time = self.needs_time or name in TIME_VARIABLES
+            elif name in custom_variables:
+                # Пользовательские переменные известны заранее и подставляются при компиляции
+                literal.append(custom_variables[name])
+            else:
+                # Неизвестные переменные остаются в тексте как есть
+                literal.append(match.group(0))
+        literal.append(text[position:])
+
+        if self.segments:
+            tail = "".join(literal)
+            if tail:
+                self.segments.append(tail)
+            self.is_static = False
+        else:
+            self.text = "".join(literal)
+            self.is_static = True
+
+    def render(self, message) -> str:
+        """Подстановка значений переменных для сообщения"""
+        if self.is_static:
+            return self.text
+
+        now = datetime.utcnow() if self.needs_time else None
+        return "".join(
+            segment if isinstance(segment, str) else BUILTIN_VARIABLES[segment[0]](message, now)
+            for segment in self.segments
+        )
+
+
+def collect_template_variables(templates) -> Dict[str, str]:
+    """Сбор пользовательских переменных из шаблонов правила"""
+    variables = {}
+    for template in templates:
+        for name, value in template.variables.items():
+            variables[name.strip("{}")] = value
+    return variables
+
+
+class CompiledSend:
+    """Отправка одного элемента контента"""
+
+    def __init__(self, content: MediaContent, custom_variables: Dict[str, str]):
+        self.content = content
+        self.template: Optional[CompiledTemplate] = None
+        if content.content_type == "text":
+            self.template = CompiledTemplate(content.text_content or "", custom_variables)
+        elif content.content_type == "image":
+            self.template = CompiledTemplate(content.caption or "", custom_variables)
+
+
+def build_callback_data(rule_id: str, callback_data: str) -> str:
+    """Формирование callback_data кнопки с привязкой к правилу"""
+    return f"{rule_id}:{callback_data}"
+
+
+def build_inline_button(button: InlineButton, rule_id: str, location: str) -> InlineKeyboardButton:
+    """Создание инлайн кнопки с проверкой ограничений Telegram"""
+    from pyrogram.types import InlineKeyboardButton
+
+    if not button.text:
+        raise RuleCompilationError(f"{location}: button text is empty")
+
+    if button.button_type == "url":
+        if not button.url:
+            raise RuleCompilationError(f"{location}: url button '{button.text}' has no url")
+        return InlineKeyboardButton(button.text, url=button.url)
+
+    if button.button_type == "callback":
+        if not button.callback_data:
+            raise RuleCompilationError(f"{location}: callback button '{button.text}' has no callback_data")
+        callback_data = build_callback_data(rule_id, button.callback_data)
+        if len(callback_data.encode("utf-8")) > MAX_CALLBACK_DATA_BYTES:
+            raise RuleCompilationError(
+                f"{location}: callback_data of button '{button.text}' exceeds "
+                f"{MAX_CALLBACK_DATA_BYTES} bytes together with the rule id"
+            )
+        return InlineKeyboardButton(button.text, callback_data=callback_data)
+
+    raise RuleCompilationError(f"{location}: unknown button type '{button.button_type}'")
+
+
+def build_inline_keyboard(button_rows: List[List[InlineButton]], rule_id: str,
+                          key: str, strict: bool = True) -> Optional[InlineKeyboardMarkup]:
+    """Создание инлайн клавиатуры действия.
+
+    strict=False - для уже сохраненных правил: кнопка с ошибкой пропускается с
+    предупреждением, а не выключает все правило.
+    """
+    if not button_rows:
+        return None
+
+    from pyrogram.types import InlineKeyboardMarkup
+
+    keyboard_rows = []
+    for row_index, row in enumerate(button_rows):
+        keyboard_row = []
+        for column, button in enumerate(row):
+            try:
+                keyboard_row.append(
+                    build_inline_button(button, rule_id, f"{key}.inline_buttons[{row_index}][{column}]")
+                )
+            except RuleCompilationError as e:
+                if strict:
+                    raise
+                logger.warning(f"Rule {rule_id}: skipping invalid button: {e}")
+        if keyboard_row:
+            keyboard_rows.append(keyboard_row)
+    return InlineKeyboardMarkup(keyboard_rows) if keyboard_rows else None
+
+
+class CompiledAction:
+    """Действие правила, разобранное на шаги плана выполнения"""
+
+    def __init__(self, rule_id: str, key: str, action: ReplyAction, custom_variables: Dict[str, str],
+                 strict: bool = True):
+        self.key = key
+        self.action = action
+        self.delay_seconds = max(action.delay_seconds, 0)
+
+        # Клавиатура собирается один раз и переиспользуется для всех отправок
+        self.keyboard = build_inline_keyboard(action.inline_buttons, rule_id, key, strict)
+
+        # Отправки уходят в чат сообщения и выполняются строго по порядку
+        self.sends: List[CompiledSend] = [
+            CompiledSend(content, custom_variables) for content in action.media_contents
+            if content.content_type in SEND_CONTENT_TYPES
+        ]
+
+        # Реакции не зависят ни от отправок, ни друг от друга
+        self.reactions: List[str] = list(action.reactions)
+
+
+class CompiledConditional:
+    """Условное правило с заранее подготовленными ветками"""
+
+    def __init__(self, rule: AutoReplyRule, index: int, conditional: ConditionalRule,
+                 custom_variables: Dict[str, str], strict: bool = True):
+        # Условие проверяется тем же кодом, что и условия правила
+        self.condition_rule = AutoReplyRule(
+            id=f"{rule.id}:conditional:{index}",
+            name=f"{rule.name} (conditional {index})",
+            conditions=[conditional.condition]
+        )
+        self.if_action = CompiledAction(
+            rule.id, f"conditional.{index}.if", conditional.if_action, custom_variables, strict
+        )
+        self.else_action: Optional[CompiledAction] = (
+            CompiledAction(rule.id, f"conditional.{index}.else", conditional.else_action, custom_variables,
+                           strict)
+            if conditional.else_action else None
+        )
+
+
+class CompiledRule:
+    """Правило автоответа, подготовленное к многократному выполнению"""
+
+    def __init__(self, rule: AutoReplyRule, custom_variables: Dict[str, str], templates_version: int = 0,
+                 strict: bool = True):
+        self.rule = rule
+        self.version: datetime = rule.updated_at
+        self.templates_version = templates_version
+        self.conditionals: List[CompiledConditional] = [
+            CompiledConditional(rule, index, conditional, custom_variables, strict)
+            for index, conditional in enumerate(rule.conditional_rules)
+        ]
+        self.actions: List[CompiledAction] = [
+            CompiledAction(rule.id, f"actions.{index}", action, custom_variables, strict)
+            for index, action in enumerate(rule.actions)
+        ]
+
+
+def compile_rule(rule: AutoReplyRule, templates: Optional[Dict[str, RuleTemplate]] = None,
+                 templates_version: int = 0, strict: bool = True) -> CompiledRule:
+    """Компиляция правила в план выполнения (RuleCompilationError при ошибках).
+
+    Сохраненные раньше правила компилируются с strict=False: они могли пройти
+    старую, менее строгую проверку.
+    """
+    templates = templates or {}
+    custom_variables = collect_template_variables(
+        templates[template_id] for template_id in rule.templates if template_id in templates
+    )
+    compiled = CompiledRule(rule, custom_variables, templates_version, strict)
+    logger.debug(f"Compiled rule {rule.id} ({len(compiled.actions)} actions, "
+                 f"{len(compiled.conditionals)} conditionals)")
+    return compiled
+
+
+CHAT_TYPE_NAMES = {
+    "PRIVATE": "private",
+    "GROUP": "group",
+    "SUPERGROUP": "supergroup",
+    "CHANNEL": "channel"
+}
+
+
+def message_chat_type(message) -> str:
+    """Тип чата сообщения в терминах ChatFilter.chat_types"""
+    return CHAT_TYPE_NAMES.get(message.chat.type.name, "unknown")
+
+
+def message_content_type(message) -> str:
+    """Тип сообщения в терминах ReplyCondition.message_types"""
+    for content_type in ("text", "photo", "video", "document", "audio", "voice", "sticker", "animation"):
+        if getattr(message, content_type):
+            return content_type
+    return "other"
+
+
+class RuleGate:
+    """Статическая часть условий правила, проверяемая до запуска обработчика.
+
+    Учитываются только условия, которые не зависят от времени и состояния чата
+    (тип и ID чата, пользователь, тип и текст сообщения). Если ворота
+    пропускают сообщение, правило все равно проверяется полностью.
+    """
+
+    def __init__(self, rule: AutoReplyRule):
+        self.chat_types: List[frozenset] = []
+        self.whitelist_chats: List[frozenset] = []
+        self.blacklist_chats = frozenset()
+        self.user_ids: List[frozenset] = []
+        self.usernames: List[frozenset] = []
+        self.keywords: List[List[str]] = []
+        self.message_types: List[frozenset] = []
+
+        blacklist = set()
+        for condition in rule.conditions:
+            if not condition.is_active:
+                continue
+            if condition.condition_type == "chat_filter" and condition.chat_filter:
+                chat_filter = condition.chat_filter
+                if chat_filter.chat_types:
+                    self.chat_types.append(frozenset(chat_filter.chat_types))
+                if chat_filter.whitelist_chats:
+                    self.whitelist_chats.append(frozenset(chat_filter.whitelist_chats))
+                blacklist.update(chat_filter.blacklist_chats)
+            elif condition.condition_type == "user_filter":
+                if condition.user_ids:
+                    self.user_ids.append(frozenset(condition.user_ids))
+                if condition.usernames:
+                    self.usernames.append(frozenset(condition.usernames))
+            elif condition.condition_type == "message_filter":
+                if condition.keywords:
+                    self.keywords.append([keyword.lower() for keyword in condition.keywords])
+                if condition.message_types:
+                    self.message_types.append(frozenset(condition.message_types))
+        self.blacklist_chats = frozenset(blacklist)
+
+    def allows(self, message) -> bool:
+        chat_id = str(message.chat.id)
+        if chat_id in self.blacklist_chats:
+            return False
+        if self.whitelist_chats and not all(chat_id in chats for chats in self.whitelist_chats):
+            return False
+        if self.chat_types:
+            chat_type = message_chat_type(message)
+            if not all(chat_type in types for types in self.chat_types):
+                return False
+        if self.user_ids:
+            user_id = str(message.from_user.id)
+            if not all(user_id in user_ids for user_ids in self.user_ids):
+                return False
+        if self.usernames:
+            username = message.from_user.username or ""
+            if not all(username in usernames for usernames in self.usernames):
+                return False
+        if self.message_types:
+            content_type = message_content_type(message)
+            if not all(content_type in types for types in self.message_types):
+                return False
+        if self.keywords:
+            text = (message.text or message.caption or "").lower()
+            if not all(any(keyword in text for keyword in keywords) for keywords in self.keywords):
+                return False
+        return True
+
+
+class RuleIndex:
+    """Индекс активных правил аккаунта для отсева сообщений до обработчика"""
+
+    def __init__(self, rules: List[AutoReplyRule]):
+        self.rules = rules
+        self.gates = [RuleGate(rule) for rule in rules]
+
+    def could_match(self, message) -> bool:
+        """False, если сообщение заведомо не подходит ни одному правилу"""
+        # Без отправителя (каналы, анонимные админы) обработка невозможна
+        if message.from_user is None:
+            return False
+        return any(gate.allows(message) for gate in self.gates)
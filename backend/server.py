@@ -1,7 +1,15 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
+import time
+
+# Отсчет времени запуска: импорт модулей входит в разбивку /api/ready
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Header, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
@@ -9,52 +17,57 @@ import logging
 from pathlib import Path
 from typing import List, Optional
 import uuid
+import hashlib
+import json
+import tempfile
 from datetime import datetime, timedelta
 import aiofiles
-from PIL import Image as PILImage
 import asyncio
 from functools import wraps
 
 from models import (
     TelegramAccount, TelegramAccountCreate, TelegramAccountUpdate,
     AutoReplyRule, AutoReplyRuleCreate, AutoReplyRuleUpdate,
-    BotImage, BotImageCreate, BotSettings, BotSettingsUpdate,
+    BotSettings, BotSettingsUpdate,
     BotActivityLog, PhoneVerification, PhoneVerificationCode,
     TwoFactorAuth, APIResponse, StatusCheck, StatusCheckCreate,
-    AccountStatus, BotStatus, MediaFile, MediaFileCreate,
-    CallbackQuery, RuleTemplate, RuleStatistics, SystemNotification,
-    ReplyCondition, ReplyAction, ChatFilter, InlineButton, MediaContent,
-    ConditionalRule
+    AccountStatus, MediaFile,
+    CallbackQuery, RuleTemplate, RuleStatistics, SystemNotification
 )
 from userbot_manager import UserbotManager
+from verification_pool import VerificationPoolFull
+from worker_pool import ShardedUserbotManager
+from account_leases import LeaseManager, default_node_id
+from rule_compiler import RuleCompilationError, compile_rule
+from media_catalog import MEDIA_FILES
+from response_cache import ResponseCache
+from bson import ObjectId
+from activity_logs import (
+    MIN_LOG_ID, ROLLUP_INDEXES, decode_log_cursor, encode_log_cursor,
+    RollupBackfill, read_activity_series, read_activity_stats
+)
+from activity_hub import LOG_EVENT, STATS_EVENT, STATUS_EVENT
+from log_export import (
+    EXPORT_FORMATS, EXPORT_MEDIA_TYPES, export_filename, export_parquet, iter_csv, iter_ndjson
+)
+from log_archive import LogArchiver
+from fast_json import ServerTiming, fast_json_response, fill_model_defaults, projection_for, select_fields
+from media_processing import (
+    ImageProcessingError, make_image_variant, process_image, run_in_pool, shutdown_pool
+)
+
+# pyrogram и PIL загружаются при первом использовании (запуск клиента, обработка
+# изображения), а не при импорте сервера
+startup_timing = ServerTiming()
+startup_timing.metrics.append(("imports", (time.perf_counter() - IMPORT_STARTED) * 1000))
+startup_state = {"ready": False, "indexes": "pending", "userbots": "pending"}
+_startup_tasks: List[asyncio.Task] = []
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Global cache for frequently accessed data
-_cache = {}
-_cache_ttl = {}
-
-def cache_response(ttl_seconds=300):
-    """Decorator for caching API responses"""
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            # Create cache key from function name and args
-            cache_key = f"{func.__name__}_{hash(str(args) + str(kwargs))}"
-            
-            # Check if cached and not expired
-            if cache_key in _cache and datetime.utcnow() < _cache_ttl.get(cache_key, datetime.min):
-                return _cache[cache_key]
-            
-            # Execute function and cache result
-            result = await func(*args, **kwargs)
-            _cache[cache_key] = result
-            _cache_ttl[cache_key] = datetime.utcnow() + timedelta(seconds=ttl_seconds)
-            
-            return result
-        return wrapper
-    return decorator
+# Cache for frequently requested API responses
+response_cache = ResponseCache(max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")))
 
 def handle_errors(func):
     """Centralized error handling decorator"""
@@ -62,6 +75,8 @@ def handle_errors(func):
     async def wrapper(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
+        except HTTPException:
+            raise
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
         except FileNotFoundError as e:
@@ -81,9 +96,44 @@ db = client[os.environ['DB_NAME']]
 # Create uploads directory
 UPLOADS_DIR = ROOT_DIR / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
+INCOMING_DIR = UPLOADS_DIR / ".incoming"
+INCOMING_DIR.mkdir(exist_ok=True)
+THUMBNAILS_DIR = UPLOADS_DIR / "thumbnails"
+THUMBNAILS_DIR.mkdir(exist_ok=True)
+VARIANTS_DIR = UPLOADS_DIR / "variants"
+VARIANTS_DIR.mkdir(exist_ok=True)
+
+# Ширины, для которых строятся уменьшенные копии (ограничивает размер кэша)
+VARIANT_WIDTHS = (64, 128, 256, 320, 480, 640, 960, 1280)
+VARIANT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_variant_tasks = {}
+
+# Архив логов активности старше срока хранения (единственная копия удаленных
+# из Mongo записей: каталог должен быть на постоянном томе)
+LOG_ARCHIVE_DIR = Path(os.environ.get("LOG_ARCHIVE_DIR", str(ROOT_DIR / "archive" / "activity_logs")))
+LOG_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+LOG_RETENTION_INTERVAL_SECONDS = 3600
+
+# Поток активности (SSE)
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_REPLAY_BATCH = 200
 
 # Initialize userbot manager
-userbot_manager = UserbotManager(db)
+# USERBOT_WORKERS > 0: клиенты Telegram работают в отдельных процессах
+USERBOT_WORKERS = int(os.environ.get("USERBOT_WORKERS", "0"))
+if USERBOT_WORKERS > 0:
+    userbot_manager = ShardedUserbotManager(db, USERBOT_WORKERS, mongo_url, os.environ['DB_NAME'])
+else:
+    userbot_manager = UserbotManager(db)
+activity_logs = userbot_manager.activity_logs
+NODE_ID = default_node_id()
+rollup_backfill = RollupBackfill(db, activity_logs, owner=NODE_ID)
+
+# ACCOUNT_LEASE_SECONDS > 0: несколько узлов делят аккаунты через аренды в Mongo
+ACCOUNT_LEASE_SECONDS = int(os.environ.get("ACCOUNT_LEASE_SECONDS", "0"))
+if ACCOUNT_LEASE_SECONDS > 0:
+    userbot_manager.leases = LeaseManager(db, userbot_manager, lease_seconds=ACCOUNT_LEASE_SECONDS)
+log_archiver = LogArchiver(db, activity_logs, str(LOG_ARCHIVE_DIR))
 
 # Create the main app without a prefix
 app = FastAPI(title="Telegram Userbot Manager", version="1.0.0")
@@ -97,29 +147,65 @@ api_router = APIRouter(prefix="/api")
 # Serve static files
 app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 
+async def create_media_hash_index():
+    """Индекс по содержимому файлов (у повторных загрузок свои записи с общим файлом)"""
+    keys = [("content_hash", 1), ("file_type", 1)]
+    legacy = (await db.media_files.index_information()).get("content_hash_1_file_type_1")
+    if legacy and legacy.get("unique"):
+        # Раньше на содержимое была одна запись со счетчиком ссылок
+        await db.media_files.drop_index("content_hash_1_file_type_1")
+    await db.media_files.create_index(keys)
+
 async def create_database_indexes():
-    """Create database indexes for better performance"""
-    try:
-        # Indexes for frequently queried collections
-        await db.telegram_accounts.create_index("phone")
-        await db.telegram_accounts.create_index("status")
-        await db.auto_reply_rules.create_index([("is_active", 1), ("priority", -1)])
-        await db.auto_reply_rules.create_index("account_id")
-        await db.media_files.create_index([("is_active", 1), ("file_type", 1)])
-        await db.media_files.create_index("tags")
-        await db.bot_activity_logs.create_index([("timestamp", -1), ("rule_id", 1)])
-        await db.phone_verifications.create_index("expires_at", expireAfterSeconds=0)
-        await db.rule_statistics.create_index([("rule_id", 1), ("date", -1)])
-        await db.system_notifications.create_index([("is_read", 1), ("created_at", -1)])
+    """Create database indexes for better performance.
+
+    Индексы строятся одновременно: каждый create_index - отдельный запрос к
+    Mongo, и последовательное ожидание складывает их задержки.
+    """
+    builds = [
+        db.telegram_accounts.create_index("phone"),
+        db.telegram_accounts.create_index("status"),
+        db.telegram_accounts.create_index("id"),
+        userbot_manager.session_storage.initialize(),
+        userbot_manager.message_claims.initialize(),
+        activity_logs.create_indexes(),
+        db.auto_reply_rules.create_index([("is_active", 1), ("priority", -1)]),
+        db.auto_reply_rules.create_index("account_id"),
+        db.media_files.create_index([("is_active", 1), ("file_type", 1)]),
+        db.media_files.create_index("tags"),
+        create_media_hash_index(),
+        db.phone_verifications.create_index("expires_at", expireAfterSeconds=0),
+        db.rule_statistics.create_index([("rule_id", 1), ("date", -1)]),
+        db.system_notifications.create_index([("is_read", 1), ("created_at", -1)]),
+    ]
+    builds.extend(
+        db.activity_rollups.create_index(index_keys, **index_options)
+        for index_keys, index_options in ROLLUP_INDEXES
+    )
+    if userbot_manager.leases:
+        builds.append(userbot_manager.leases.initialize())
+
+    results = await asyncio.gather(*builds, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        logger.warning(f"Could not create database index: {error}")
+    if not errors:
         logger.info("Database indexes created successfully")
-    except Exception as e:
-        logger.warning(f"Could not create some database indexes: {e}")
+    return not errors
 
 # Original endpoints
 @api_router.get("/")
 async def root():
     return {"message": "Telegram Userbot Manager API"}
 
+@api_router.get("/ready")
+async def get_readiness():
+    """Готовность API и состояние фоновой части запуска (индексы, автостарт)"""
+    return {
+        **startup_state,
+        "timings_ms": {name: round(duration, 1) for name, duration in startup_timing.metrics},
+    }
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
@@ -145,6 +231,8 @@ async def send_verification_code(account_data: TelegramAccountCreate):
             message="Verification code sent successfully. Please check your Telegram app.",
             data={"verification_id": verification_id}
         )
+    except VerificationPoolFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         error_message = str(e)
         # Улучшенная обработка ошибок
@@ -250,8 +338,17 @@ async def verify_2fa(tfa_data: TwoFactorAuth):
         raise HTTPException(status_code=400, detail=f"Ошибка 2FA верификации: {error_message}")
 
 @api_router.get("/accounts", response_model=List[TelegramAccount])
-async def get_accounts():
-    """Получение всех аккаунтов"""
+@handle_errors
+async def get_accounts(fast: bool = False, fields: Optional[str] = None):
+    """Получение всех аккаунтов (fast=1 - без pydantic-моделей, через orjson)"""
+    if fast:
+        timing = ServerTiming()
+        with timing.measure("db"):
+            selected = select_fields(fields, TelegramAccount)
+            accounts = await db.telegram_accounts.find({}, projection_for(selected)).to_list(1000)
+            fill_model_defaults(accounts, TelegramAccount, selected)
+        return fast_json_response(accounts, timing)
+    
     accounts = await db.telegram_accounts.find().to_list(1000)
     return [TelegramAccount(**account) for account in accounts]
 
@@ -285,13 +382,24 @@ async def delete_account(account_id: str):
     result = await db.telegram_accounts.delete_one({"id": account_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Account not found")
+    await userbot_manager.session_storage.delete(f"userbot_{account_id}", account_id)
     
     return APIResponse(success=True, message="Account deleted")
 
 # BOT CONTROL ENDPOINTS
 @api_router.post("/bot/start")
-async def start_bot():
-    """Запуск всех userbot"""
+async def start_bot(stream: bool = False):
+    """Запуск всех userbot (stream=1 - результаты по аккаунтам в NDJSON по мере подключения)"""
+    if stream:
+        async def results():
+            started = failed = 0
+            async for account_id, success in userbot_manager.stream_start_all_userbots():
+                started += success
+                failed += not success
+                yield json.dumps({"account_id": account_id, "success": success}) + "\n"
+            yield json.dumps({"done": True, "started": started, "failed": failed}) + "\n"
+        return StreamingResponse(results(), media_type="application/x-ndjson")
+    
     try:
         results = await userbot_manager.start_all_userbots()
         return APIResponse(
@@ -318,8 +426,16 @@ async def stop_bot():
 @api_router.post("/bot/start/{account_id}")
 async def start_account_bot(account_id: str):
     """Запуск userbot для конкретного аккаунта"""
+    leases = userbot_manager.leases
+    if leases:
+        await leases.resume([account_id])
+    if leases and not await leases.acquire(account_id):
+        owner = await leases.owner_of(account_id)
+        raise HTTPException(status_code=409, detail=f"Account is running on node {owner}")
     try:
         success = await userbot_manager.start_userbot(account_id)
+        if leases:
+            await leases.track_started({account_id: success})
         return APIResponse(
             success=success,
             message="Account bot started" if success else "Failed to start account bot"
@@ -331,6 +447,9 @@ async def start_account_bot(account_id: str):
 async def stop_account_bot(account_id: str):
     """Остановка userbot для конкретного аккаунта"""
     try:
+        if userbot_manager.leases:
+            # Аренда на паузе: аккаунт не подхватит ни этот, ни другой узел
+            await userbot_manager.leases.pause(account_id)
         success = await userbot_manager.stop_userbot(account_id)
         return APIResponse(
             success=success,
@@ -348,13 +467,32 @@ async def get_bot_status():
         settings = BotSettings()
         await db.bot_settings.insert_one(settings.dict())
     
-    return {
-        "status": settings.status,
-        "is_running": userbot_manager.is_running,
-        "active_accounts": len(userbot_manager.clients),
-        "daily_response_count": settings.daily_response_count,
-        "max_daily_responses": settings.max_daily_responses
-    }
+    return await userbot_manager.get_status_snapshot()
+
+@api_router.get("/bot/workers")
+@handle_errors
+async def get_bot_workers():
+    """Состояние рабочих процессов (режим USERBOT_WORKERS)"""
+    if not isinstance(userbot_manager, ShardedUserbotManager):
+        return []
+    return await userbot_manager.get_workers_status()
+
+@api_router.get("/bot/health")
+async def get_bot_health():
+    """Состояние подключений аккаунтов: простой, переподключения, карантин"""
+    return await userbot_manager.get_health_snapshot()
+
+@api_router.get("/cluster/placement")
+async def get_cluster_placement():
+    """Размещение аккаунтов по узлам (режим ACCOUNT_LEASE_SECONDS)"""
+    if not userbot_manager.leases:
+        # Один узел: все запущенные аккаунты на нем
+        return {
+            "node_id": None,
+            "lease_seconds": 0,
+            "nodes": [{"node_id": None, "alive": True, "accounts": sorted(userbot_manager.running_account_ids())}]
+        }
+    return await userbot_manager.leases.placement()
 
 # BOT SETTINGS ENDPOINTS
 @api_router.get("/settings", response_model=BotSettings)
@@ -376,21 +514,50 @@ async def update_bot_settings(settings_update: BotSettingsUpdate):
         upsert=True
     )
     
-    updated_settings = await db.bot_settings.find_one()
-    return BotSettings(**updated_settings)
+    updated_settings = BotSettings(**await db.bot_settings.find_one())
+    if settings_update.log_retention_days is not None:
+        # Новый срок вступает в силу после прохода архиватора
+        asyncio.create_task(apply_log_retention(updated_settings.log_retention_days))
+    return updated_settings
 
 # AUTO REPLY RULES ENDPOINTS
-@api_router.get("/rules", response_model=List[AutoReplyRule])
-async def get_rules():
-    """Получение всех правил автоответов"""
+async def load_rule_models() -> List[AutoReplyRule]:
     rules = await db.auto_reply_rules.find().to_list(1000)
     return [AutoReplyRule(**rule) for rule in rules]
 
+@api_router.get("/rules", response_model=List[AutoReplyRule])
+@handle_errors
+async def get_rules(fast: bool = False, fields: Optional[str] = None):
+    """Получение всех правил автоответов (fast=1 - без pydantic-моделей, через orjson)"""
+    if not fast:
+        return await response_cache.get_or_load("rules:models", load_rule_models, 60, ("rules",))
+    
+    selected = select_fields(fields, AutoReplyRule)
+    timing = ServerTiming()
+    
+    async def load_rule_docs() -> List[dict]:
+        docs = await db.auto_reply_rules.find({}, projection_for(selected)).to_list(1000)
+        # Правила старых версий без новых полей (dedup_policy, templates, ...)
+        return fill_model_defaults(docs, AutoReplyRule, selected)
+    
+    with timing.measure("db"):
+        rules = await response_cache.get_or_load(f"rules:docs:{selected}", load_rule_docs, 60, ("rules",))
+    return fast_json_response(rules, timing)
+
 @api_router.post("/rules", response_model=AutoReplyRule)
 async def create_rule(rule_data: AutoReplyRuleCreate):
     """Создание правила автоответа"""
     rule = AutoReplyRule(**rule_data.dict())
+    
+    # Некорректные кнопки отклоняются сразу, а не при отправке ответа
+    try:
+        compile_rule(rule)
+    except RuleCompilationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     await db.auto_reply_rules.insert_one(rule.dict())
+    response_cache.invalidate("rules")
+    await userbot_manager.clear_rules_cache(rule.account_id)
     return rule
 
 @api_router.get("/rules/{rule_id}", response_model=AutoReplyRule)
@@ -404,12 +571,31 @@ async def get_rule(rule_id: str):
 @api_router.put("/rules/{rule_id}")
 async def update_rule(rule_id: str, rule_update: AutoReplyRuleUpdate):
     """Обновление правила"""
+    existing_rule = await db.auto_reply_rules.find_one({"id": rule_id})
+    if not existing_rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    
+    update_data = rule_update.dict(exclude_unset=True)
+    # updated_at - версия скомпилированного правила на всех узлах и процессах
+    update_data["updated_at"] = datetime.utcnow()
+    try:
+        # Кнопки проверяются строго, только если их меняют: старое правило с
+        # невалидной кнопкой можно выключить или переименовать
+        compile_rule(
+            AutoReplyRule(**{**existing_rule, **update_data}),
+            strict="actions" in update_data or "conditional_rules" in update_data
+        )
+    except RuleCompilationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     result = await db.auto_reply_rules.update_one(
         {"id": rule_id},
-        {"$set": rule_update.dict(exclude_unset=True)}
+        {"$set": update_data}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Rule not found")
+    response_cache.invalidate("rules")
+    await userbot_manager.clear_rules_cache()
     
     updated_rule = await db.auto_reply_rules.find_one({"id": rule_id})
     return AutoReplyRule(**updated_rule)
@@ -420,41 +606,255 @@ async def delete_rule(rule_id: str):
     result = await db.auto_reply_rules.delete_one({"id": rule_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Rule not found")
+    response_cache.invalidate("rules")
+    await userbot_manager.clear_rules_cache()
     
     return APIResponse(success=True, message="Rule deleted")
 
 # ACTIVITY LOGS ENDPOINTS
 @api_router.get("/logs", response_model=List[BotActivityLog])
-@cache_response(ttl_seconds=60)  # Cache for 1 minute
 @handle_errors
-async def get_activity_logs(limit: int = 100, skip: int = 0):
-    """Получение логов активности"""
-    logs = await db.bot_activity_logs.find().sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
+async def get_activity_logs(
+    response: Response,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    skip: int = 0,
+    account_id: Optional[str] = None,
+    rule_id: Optional[str] = None,
+    chat_id: Optional[int] = None,
+    success: Optional[bool] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fast: bool = False,
+    fields: Optional[str] = None
+):
+    """Получение логов активности (keyset-пагинация по (timestamp, id); skip - для старых клиентов)"""
+    selected = select_fields(fields, BotActivityLog) if fast else None
+    timing = ServerTiming()
+    with timing.measure("db"):
+        logs, next_cursor = await activity_logs.fetch_page(
+            limit=limit, cursor=cursor, fields=selected, skip=skip,
+            account_id=account_id, rule_id=rule_id, chat_id=chat_id,
+            success=success, since=since, until=until
+        )
+    
+    # Курсор следующей страницы передается в заголовке, тело остается списком
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if fast:
+        return fast_json_response(logs, timing, headers)
+    response.headers.update(headers)
     return [BotActivityLog(**log) for log in logs]
 
+@api_router.get("/logs/export")
+@handle_errors
+async def export_activity_logs(
+    format: str = "ndjson",
+    account_id: Optional[str] = None,
+    rule_id: Optional[str] = None,
+    success: Optional[bool] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """Потоковая выгрузка логов активности в NDJSON, CSV или Parquet"""
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {format}")
+    
+    filters = dict(account_id=account_id, rule_id=rule_id, success=success, since=since, until=until)
+    headers = {"Content-Disposition": f'attachment; filename="{export_filename(format, since, until)}"'}
+    
+    if format == "parquet":
+        # Parquet нельзя отдавать по частям: собираем во временный файл по группам строк
+        fd, export_path = tempfile.mkstemp(prefix="logs_export_", suffix=".parquet")
+        os.close(fd)
+        try:
+            await export_parquet(activity_logs, export_path, **filters)
+        except BaseException:
+            os.unlink(export_path)
+            raise
+        return FileResponse(
+            export_path,
+            media_type=EXPORT_MEDIA_TYPES[format],
+            headers=headers,
+            background=BackgroundTask(os.unlink, export_path)
+        )
+    
+    rows = iter_ndjson if format == "ndjson" else iter_csv
+    return StreamingResponse(
+        rows(activity_logs, **filters),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers=headers
+    )
+
+@api_router.get("/logs/archive")
+@handle_errors
+async def get_log_archives(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Список архивных окон логов"""
+    return await log_archiver.list_archives(since, until)
+
+@api_router.get("/logs/archive/stats")
+@handle_errors
+async def get_archived_log_stats(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    account_id: Optional[str] = None,
+    rule_id: Optional[str] = None
+):
+    """Статистика по архивным логам (по дням)"""
+    return await log_archiver.read_archived_stats(since, until, account_id=account_id, rule_id=rule_id)
+
 @api_router.get("/logs/stats")
-@cache_response(ttl_seconds=300)  # Cache for 5 minutes
 @handle_errors
 async def get_activity_stats():
-    """Получение статистики активности"""
-    total_logs = await db.bot_activity_logs.count_documents({})
-    successful_responses = await db.bot_activity_logs.count_documents({"success": True})
-    failed_responses = await db.bot_activity_logs.count_documents({"success": False})
+    """Получение статистики активности (по агрегатам, с разбивкой по правилам и аккаунтам)"""
+    return await read_activity_stats(db.activity_rollups)
+
+@api_router.get("/logs/stats/series")
+@handle_errors
+async def get_activity_series(
+    granularity: str = "hour",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    account_id: Optional[str] = None,
+    rule_id: Optional[str] = None
+):
+    """Временной ряд активности по минутам, часам или дням"""
+    if since is None:
+        since = datetime.utcnow() - timedelta(days=1)
+    return await read_activity_series(
+        db.activity_rollups, granularity, since,
+        until=until, account_id=account_id, rule_id=rule_id
+    )
+
+def format_sse(event: str, data, event_id: Optional[str] = None) -> str:
+    """Одно событие в формате text/event-stream"""
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(jsonable_encoder(data), separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+@api_router.get("/logs/stream")
+@handle_errors
+async def stream_activity(
+    request: Request,
+    cursor: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """Поток новых логов, изменений счетчиков и статуса бота (Server-Sent Events).
+
+    При переподключении браузер передает Last-Event-ID, и пропущенные записи
+    дочитываются из базы; то же происходит, если клиент не успевал читать поток.
+    """
+    resume_from = last_event_id or cursor
+    if resume_from:
+        decode_log_cursor(resume_from)
     
-    # Статистика за последние 24 часа
-    yesterday = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    today_logs = await db.bot_activity_logs.count_documents({"timestamp": {"$gte": yesterday}})
+    hub = userbot_manager.activity_hub
     
-    return {
-        "total_responses": total_logs,
-        "successful_responses": successful_responses,
-        "failed_responses": failed_responses,
-        "success_rate": successful_responses / total_logs * 100 if total_logs > 0 else 0,
-        "responses_today": today_logs
-    }
+    async def events():
+        # Позиция последней отданной записи; без курсора начинаем с момента подключения
+        position = resume_from or encode_log_cursor(datetime.utcnow(), MIN_LOG_ID)
+        position_key = decode_log_cursor(position)
+        replayed_ids = set()
+        
+        def log_event(doc):
+            nonlocal position, position_key
+            log = BotActivityLog(**doc)
+            key = (log.timestamp, ObjectId(log.id))
+            if key > position_key:
+                position_key = key
+                position = encode_log_cursor(log.timestamp, log.id)
+            return format_sse(LOG_EVENT, log, encode_log_cursor(log.timestamp, log.id))
+        
+        async def replay():
+            replayed_ids.clear()
+            while True:
+                docs = await activity_logs.fetch_after(position, STREAM_REPLAY_BATCH)
+                for doc in docs:
+                    replayed_ids.add(doc["id"])
+                    yield log_event(doc)
+                if len(docs) < STREAM_REPLAY_BATCH:
+                    break
+        
+        subscription = hub.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            yield format_sse(STATUS_EVENT, await userbot_manager.get_status_snapshot())
+            yield format_sse(STATS_EVENT, await read_activity_stats(db.activity_rollups))
+            if resume_from:
+                async for chunk in replay():
+                    yield chunk
+            
+            stats_day = datetime.utcnow().date()
+            while not await request.is_disconnected():
+                if subscription.lagged:
+                    # Сначала снимаем флаг, чтобы новые события копились, пока догоняем
+                    subscription.resync()
+                    async for chunk in replay():
+                        yield chunk
+                    yield format_sse(STATS_EVENT, await read_activity_stats(db.activity_rollups))
+                    continue
+                
+                item = await subscription.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                if item is None:
+                    if datetime.utcnow().date() != stats_day:
+                        # Счетчики "за сегодня" начинаются заново
+                        stats_day = datetime.utcnow().date()
+                        yield format_sse(STATS_EVENT, await read_activity_stats(db.activity_rollups))
+                    else:
+                        yield ": keepalive\n\n"
+                    continue
+                
+                event, data = item
+                if event == LOG_EVENT:
+                    if data["id"] in replayed_ids:
+                        continue
+                    yield log_event(data)
+                else:
+                    yield format_sse(event, data)
+        finally:
+            hub.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            # GZipMiddleware буферизует поток; явная кодировка отключает сжатие
+            "Content-Encoding": "identity",
+        }
+    )
 
 
 # ENHANCED MEDIA FILES ENDPOINTS
+async def register_duplicate_upload(content_hash: str, file_type: str, file_id: str,
+                                    original_filename: str, tags: List[str]) -> Optional[MediaFile]:
+    """Запись повторной загрузки: своя запись, файл на диске общий с первой загрузкой"""
+    doc = await db.media_files.find_one({"content_hash": content_hash, "file_type": file_type})
+    if not doc:
+        return None
+    
+    media_file = MediaFile(**{
+        **doc,
+        "id": file_id,
+        "original_filename": original_filename,
+        "tags": tags,
+        "uploaded_at": datetime.utcnow(),
+        "usage_count": 0,
+    })
+    await db.media_files.insert_one(media_file.dict())
+    userbot_manager.media_catalog.add(media_file, MEDIA_FILES)
+    return media_file
+
+
+def duplicate_upload_response(media_file: MediaFile) -> APIResponse:
+    return APIResponse(
+        success=True,
+        message="File already uploaded",
+        data={**media_file.dict(), "duplicate": True}
+    )
+
+
 @api_router.post("/media/upload")
 @handle_errors
 async def upload_media_file(
@@ -476,49 +876,78 @@ async def upload_media_file(
         if file.content_type not in allowed_types.get(file_type, []):
             raise HTTPException(status_code=400, detail=f"Unsupported file type for {file_type}")
         
-        # Генерируем имя файла
+        tag_list = tags.split(",") if tags else []
+        file_id = str(uuid.uuid4())
         file_extension = Path(file.filename).suffix
-        new_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = UPLOADS_DIR / new_filename
+        incoming_path = INCOMING_DIR / f"{file_id}{file_extension}"
         
-        # Сохраняем файл чанками для больших файлов
+        # Сохраняем файл чанками во временный каталог, одновременно считая SHA-256
         file_size = 0
-        async with aiofiles.open(file_path, 'wb') as f:
-            chunk_size = 8192  # 8KB chunks
+        hasher = hashlib.sha256()
+        async with aiofiles.open(incoming_path, 'wb') as f:
+            chunk_size = 65536  # 64KB chunks
             while content := await file.read(chunk_size):
+                hasher.update(content)
                 await f.write(content)
                 file_size += len(content)
+        content_hash = hasher.hexdigest()
+        
+        # Такой файл уже есть - отвечаем сразу, без обработки и записи
+        existing = await register_duplicate_upload(content_hash, file_type, file_id, file.filename, tag_list)
+        if existing:
+            incoming_path.unlink()
+            return duplicate_upload_response(existing)
+        
+        # Имя файла определяется его содержимым
+        storage_stem = content_hash if file_type == "image" else f"{content_hash}.{file_type}"
         
-        # Получаем размеры для изображений
         width, height, duration = None, None, None
-        if file_type == "image":
-            try:
-                with PILImage.open(file_path) as img:
-                    width, height = img.size
-            except Exception as e:
-                logger.warning(f"Could not get image dimensions: {e}")
+        mime_type = file.content_type
+        thumbnail_path = None
+        file_path = UPLOADS_DIR / f"{storage_stem}{file_extension}"
+        
+        try:
+            if file_type == "image":
+                # Декодирование и пересжатие выполняются в пуле процессов,
+                # чтобы большие картинки не блокировали обработку сообщений
+                thumbnail_path = THUMBNAILS_DIR / f"{content_hash}.jpg"
+                result = await run_in_pool(
+                    process_image, str(incoming_path), str(UPLOADS_DIR / storage_stem), str(thumbnail_path)
+                )
+                width, height = result["width"], result["height"]
+                if result["path"]:
+                    file_path = Path(result["path"])
+                    file_size = result["file_size"]
+                    mime_type = result["mime_type"]
+            
+            if not file_path.exists():
+                os.replace(incoming_path, file_path)
+        except ImageProcessingError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if incoming_path.exists():
+                incoming_path.unlink()
         
         # Создаем запись в БД
         media_file = MediaFile(
-            filename=new_filename,
+            id=file_id,
+            filename=file_path.name,
             original_filename=file.filename,
             file_path=str(file_path),
             file_size=file_size,
-            mime_type=file.content_type,
+            mime_type=mime_type,
             file_type=file_type,
             width=width,
             height=height,
             duration=duration,
-            tags=tags.split(",") if tags else []
+            thumbnail_path=str(thumbnail_path) if thumbnail_path else None,
+            content_hash=content_hash,
+            tags=tag_list
         )
         
+        # Тот же файл, загруженный параллельно, получит свою запись с общим файлом
         await db.media_files.insert_one(media_file.dict())
-        
-        # Clear related cache entries
-        cache_keys_to_clear = [k for k in _cache.keys() if 'get_media_files' in k]
-        for key in cache_keys_to_clear:
-            _cache.pop(key, None)
-            _cache_ttl.pop(key, None)
+        userbot_manager.media_catalog.add(media_file, MEDIA_FILES)
         
         return APIResponse(
             success=True,
@@ -534,56 +963,148 @@ async def upload_media_file(
 
 
 @api_router.get("/media", response_model=List[MediaFile])
-@cache_response(ttl_seconds=120)  # Cache for 2 minutes
 @handle_errors
 async def get_media_files(
     file_type: Optional[str] = None,
     tags: Optional[str] = None,
-    limit: int = 50
+    limit: int = 50,
+    fast: bool = False,
+    fields: Optional[str] = None
 ):
-    """Получение списка медиафайлов с кэшированием"""
-    query = {"is_active": True}
+    """Получение списка медиафайлов из каталога"""
+    tag_list = tags.split(",") if tags else None
+    files = await userbot_manager.media_catalog.list(file_type=file_type, tags=tag_list)
+    if fast:
+        # Каталог уже в памяти: пропускаем только повторную проверку response_model
+        selected = select_fields(fields, MediaFile)
+        timing = ServerTiming()
+        with timing.measure("dump"):
+            items = [entry.model_dump(include=set(selected) if selected else None) for entry in files[:limit]]
+        return fast_json_response(items, timing)
+    return files[:limit]
+
+
+async def delete_catalog_file(file_id: str) -> bool:
+    """Удаление файла из каталога и коллекции.
+    
+    Файл на диске общий у повторных загрузок одного содержимого и удаляется
+    вместе с последней записью; возвращает True, если удален и файл.
+    """
+    media_catalog = userbot_manager.media_catalog
+    entry = await media_catalog.get(file_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="File not found")
     
-    if file_type:
-        query["file_type"] = file_type
+    source = media_catalog.source_of(file_id)
+    await db[source].delete_one({"id": file_id})
+    media_catalog.remove(file_id)
     
-    if tags:
-        tag_list = tags.split(",")
-        query["tags"] = {"$in": tag_list}
+    if (source == MEDIA_FILES and entry.content_hash and await db.media_files.find_one(
+            {"content_hash": entry.content_hash, "file_type": entry.file_type}, {"_id": 1})):
+        # Файл нужен другим загрузкам
+        return False
     
-    files = await db.media_files.find(query).limit(limit).to_list(limit)
-    return [MediaFile(**file) for file in files]
+    # Удалим файл, миниатюру и уменьшенные копии с диска
+    for path in (entry.file_path, entry.thumbnail_path):
+        if path and Path(path).exists():
+            Path(path).unlink()
+    version = entry.content_hash or f"{entry.id}-{entry.file_size}"
+    for variant_path in VARIANTS_DIR.glob(f"{version}_w*.jpg"):
+        variant_path.unlink(missing_ok=True)
+    return True
 
 
 @api_router.delete("/media/{file_id}")
 @handle_errors
 async def delete_media_file(file_id: str):
-    """Удаление медиафайла с очисткой кэша"""
-    # Найдем файл
-    file_doc = await db.media_files.find_one({"id": file_id})
-    if not file_doc:
-        raise HTTPException(status_code=404, detail="File not found")
+    """Удаление медиафайла"""
+    await delete_catalog_file(file_id)
+    return APIResponse(success=True, message="File deleted successfully")
+
+
+def snap_variant_width(width: int) -> int:
+    """Округление запрошенной ширины до ближайшей поддерживаемой"""
+    for allowed in VARIANT_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return VARIANT_WIDTHS[-1]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Проверка заголовка If-None-Match"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+async def ensure_image_variant(source_path: str, variant_path: Path, width: int):
+    """Создание копии в пуле процессов; параллельные запросы ждут одну задачу"""
+    key = str(variant_path)
+    task = _variant_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_in_pool(make_image_variant, source_path, key, width))
+        _variant_tasks[key] = task
+        task.add_done_callback(lambda _: _variant_tasks.pop(key, None))
+    await asyncio.shield(task)
+
+
+@api_router.get("/media/{file_id}/thumb")
+@handle_errors
+async def get_media_thumbnail(
+    file_id: str,
+    w: int = 320,
+    if_none_match: Optional[str] = Header(None)
+):
+    """Уменьшенная копия изображения для галереи"""
+    entry = await userbot_manager.media_catalog.get(file_id)
+    if not entry or not entry.mime_type.startswith("image/") or entry.mime_type == "image/svg+xml":
+        raise HTTPException(status_code=404, detail="Image not found")
     
-    # Удалим файл с диска
-    file_path = Path(file_doc["file_path"])
-    if file_path.exists():
-        file_path.unlink()
+    width = snap_variant_width(max(w, 1))
     
-    # Удалим из БД
-    await db.media_files.delete_one({"id": file_id})
+    # Содержимое файла не меняется, поэтому ETag однозначно определяется хэшем
+    version = entry.content_hash or f"{entry.id}-{entry.file_size}"
+    etag = f'"{version}-w{width}"'
+    headers = {"ETag": etag, "Cache-Control": VARIANT_CACHE_CONTROL}
     
-    # Clear related cache entries
-    cache_keys_to_clear = [k for k in _cache.keys() if 'get_media_files' in k]
-    for key in cache_keys_to_clear:
-        _cache.pop(key, None)
-        _cache_ttl.pop(key, None)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
     
-    return APIResponse(success=True, message="File deleted successfully")
+    variant_path = VARIANTS_DIR / f"{version}_w{width}.jpg"
+    if not variant_path.exists():
+        if not Path(entry.file_path).exists():
+            raise HTTPException(status_code=404, detail="Image file not found")
+        await ensure_image_variant(entry.file_path, variant_path, width)
+    
+    return FileResponse(variant_path, media_type="image/jpeg", headers=headers)
+
+
+# LEGACY IMAGES ENDPOINTS (served from the unified media catalog)
+@api_router.get("/images", response_model=List[MediaFile])
+@handle_errors
+async def get_images():
+    """Получение всех картинок из bot_images и media_files"""
+    return await userbot_manager.media_catalog.list(file_type="image")
+
+
+@api_router.post("/images/upload")
+async def upload_image(file: UploadFile = File(...), tags: str = Form("")):
+    """Загрузка картинки (сохраняется как медиафайл)"""
+    return await upload_media_file(file=file, tags=tags, file_type="image")
+
+
+@api_router.delete("/images/{image_id}")
+@handle_errors
+async def delete_image(image_id: str):
+    """Удаление картинки"""
+    await delete_catalog_file(image_id)
+    return APIResponse(success=True, message="Image deleted successfully")
 
 
 # RULE TEMPLATES ENDPOINTS
 @api_router.get("/templates", response_model=List[RuleTemplate])
-@cache_response(ttl_seconds=600)  # Cache for 10 minutes
+@response_cache.cached(ttl_seconds=600, tags=("templates",))
 @handle_errors
 async def get_rule_templates():
     """Получение шаблонов правил с кэшированием"""
@@ -601,6 +1122,10 @@ async def create_rule_template(template_data: dict):
         variables=template_data.get("variables", {})
     )
     await db.rule_templates.insert_one(template.dict())
+
+    response_cache.invalidate("templates")
+    await userbot_manager.clear_templates_cache()
+
     return template
 
 
@@ -660,6 +1185,33 @@ async def get_system_notifications():
     return [SystemNotification(**notif) for notif in notifications]
 
 
+@api_router.get("/system/cache")
+async def get_cache_stats():
+    """Метрики кэша ответов API"""
+    return response_cache.stats()
+
+@api_router.get("/system/stream")
+async def get_stream_stats():
+    """Метрики потока активности (подписчики, доставленные и отброшенные события)"""
+    return userbot_manager.activity_hub.stats()
+
+@api_router.get("/system/verifications")
+async def get_verification_stats():
+    """Метрики пула клиентов незавершенных входов в аккаунт"""
+    return userbot_manager.verification_pool.metrics()
+
+@api_router.get("/system/loop-mutes")
+async def get_loop_mutes():
+    """Чаты, в которых ответы приостановлены из-за цикла автоответов"""
+    return await userbot_manager.get_loop_mutes()
+
+@api_router.delete("/system/loop-mutes/{account_id}")
+async def delete_loop_mute(account_id: str, chat_id: Optional[int] = None):
+    """Возобновление ответов аккаунта в чате (во всех чатах, если chat_id не указан)"""
+    await userbot_manager.unmute_chat(account_id, chat_id)
+    return APIResponse(success=True, message="Replies resumed")
+
+
 @api_router.put("/system/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str):
     """Отметить уведомление как прочитанное"""
@@ -682,6 +1234,8 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Фронтенд обращается к API с другого origin (REACT_APP_BACKEND_URL)
+    expose_headers=["X-Next-Cursor", "Server-Timing"],
 )
 
 # Configure logging
@@ -693,46 +1247,112 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
-    """Инициализация при запуске сервера"""
+    """Инициализация при запуске сервера.
+
+    До готовности API выполняется только необходимое для обработки запросов:
+    коллекция логов (time-series нельзя создать после первой записи),
+    настройки и каталог медиа. Индексы и автостарт аккаунтов идут в фоне,
+    их состояние и разбивка времени запуска доступны в /api/ready.
+    """
     logger.info("Starting Telegram Userbot Manager")
+    started_at = datetime.utcnow()
+    
+    with startup_timing.measure("activity_logs"):
+        await activity_logs.initialize()
+    
+    # Настройки, состояние заполнения агрегатов и каталог медиа - независимые
+    # запросы. Наличие агрегатов проверяем до автостарта, пока писатель логов
+    # еще не создал первые
+    with startup_timing.measure("settings_catalog"):
+        settings, _, _ = await asyncio.gather(
+            ensure_bot_settings(),
+            init_rollup_backfill(started_at),
+            userbot_manager.media_catalog.load()
+        )
     
-    # Create database indexes for better performance
-    await create_database_indexes()
+    # Перенос логов старого формата и агрегаты для логов, записанных до их появления
+    asyncio.create_task(prepare_activity_logs())
     
-    # Создаем настройки бота если их нет
+    # Schedule periodic cache cleanup
+    asyncio.create_task(periodic_cache_cleanup())
+    asyncio.create_task(periodic_log_retention())
+    
+    _startup_tasks.append(asyncio.create_task(finish_startup(settings.auto_start)))
+    startup_state["ready"] = True
+    logger.info(f"API ready in {time.perf_counter() - IMPORT_STARTED:.2f}s "
+                f"({startup_timing.header()})")
+
+async def ensure_bot_settings() -> BotSettings:
+    """Настройки бота (создаются со значениями по умолчанию, если их нет)"""
     settings = await db.bot_settings.find_one()
-    if not settings:
-        default_settings = BotSettings()
-        await db.bot_settings.insert_one(default_settings.dict())
-        logger.info("Created default bot settings")
+    if settings:
+        return BotSettings(**settings)
+    default_settings = BotSettings()
+    await db.bot_settings.insert_one(default_settings.dict())
+    logger.info("Created default bot settings")
+    return default_settings
+
+async def init_rollup_backfill(until: datetime):
+    """Состояние заполнения агрегатов (при первом запуске - нужно ли оно вообще)"""
+    needed = await db.activity_rollups.find_one() is None
+    await rollup_backfill.initialize(until, needed)
+
+async def finish_startup(auto_start: bool):
+    """Фоновая часть запуска: индексы, затем автостарт аккаунтов и аренды"""
+    with startup_timing.measure("indexes"):
+        indexes_ok = await create_database_indexes()
+    startup_state["indexes"] = "ready" if indexes_ok else "partial"
     
     # Автостарт если включен
-    settings = await db.bot_settings.find_one()
-    if settings and settings.get("auto_start", False):
+    if auto_start:
         logger.info("Auto-starting userbot...")
+        startup_state["userbots"] = "starting"
         try:
-            await userbot_manager.start_all_userbots()
+            with startup_timing.measure("userbots"):
+                await userbot_manager.start_all_userbots()
+            startup_state["userbots"] = "started"
         except Exception as e:
+            startup_state["userbots"] = "failed"
             logger.error(f"Failed to auto-start userbot: {e}")
+    else:
+        startup_state["userbots"] = "skipped"
     
-    # Schedule periodic cache cleanup
-    asyncio.create_task(periodic_cache_cleanup())
+    # Продление аренд и перераспределение аккаунтов между узлами
+    if userbot_manager.leases:
+        userbot_manager.leases.start()
+    
+    logger.info(f"Startup finished in {time.perf_counter() - IMPORT_STARTED:.2f}s "
+                f"({startup_timing.header()})")
+
+async def prepare_activity_logs():
+    """Перенос логов старого формата и построение агрегатов по существующим логам.
+
+    Агрегаты строятся только по логам до первого запуска с агрегатами: более
+    новые записи агрегирует сам писатель логов. Заполнение продолжается с
+    сохраненного курсора после сбоя и идет только на одном узле.
+    """
+    try:
+        await activity_logs.migrate_legacy(owner=NODE_ID)
+        
+        # Блокировку может держать другой узел: ждем, пока он закончит или
+        # блокировка истечет после его сбоя
+        processed = 0
+        while await rollup_backfill.pending():
+            processed += await rollup_backfill.run()
+            if await rollup_backfill.pending():
+                await asyncio.sleep(rollup_backfill.lock_seconds)
+        if processed:
+            logger.info(f"Activity rollups built from {processed} logs")
+    except Exception as e:
+        logger.error(f"Activity log preparation error: {e}")
 
 async def periodic_cache_cleanup():
     """Периодическая очистка истекшего кэша"""
     while True:
         try:
-            current_time = datetime.utcnow()
-            expired_keys = [
-                key for key, expiry in _cache_ttl.items() 
-                if current_time > expiry
-            ]
-            for key in expired_keys:
-                _cache.pop(key, None)
-                _cache_ttl.pop(key, None)
-            
-            if expired_keys:
-                logger.debug(f"Cleaned up {len(expired_keys)} expired cache entries")
+            expired = response_cache.purge_expired()
+            if expired:
+                logger.debug(f"Cleaned up {expired} expired cache entries")
             
             # Run cleanup every 5 minutes
             await asyncio.sleep(300)
@@ -740,9 +1360,31 @@ async def periodic_cache_cleanup():
             logger.error(f"Cache cleanup error: {e}")
             await asyncio.sleep(300)
 
+async def apply_log_retention(retention_days: int):
+    """Архивирование логов старше срока хранения и настройка автоудаления"""
+    try:
+        archived = await log_archiver.apply_retention(retention_days)
+        if archived:
+            logger.info(f"Archived {archived} expired activity logs")
+    except Exception as e:
+        logger.error(f"Log retention error: {e}")
+
+async def periodic_log_retention():
+    """Архивирование и удаление логов старше срока хранения"""
+    while True:
+        try:
+            settings = BotSettings(**(await db.bot_settings.find_one() or {}))
+            await apply_log_retention(settings.log_retention_days)
+        except Exception as e:
+            logger.error(f"Log retention error: {e}")
+        await asyncio.sleep(LOG_RETENTION_INTERVAL_SECONDS)
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Очистка при завершении работы сервера"""
     logger.info("Shutting down Telegram Userbot Manager")
-    await userbot_manager.stop_all_userbots()
+    for task in _startup_tasks:
+        task.cancel()
+    await userbot_manager.shutdown()
+    shutdown_pool()
     client.close()
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""Постоянное хранилище сессий pyrogram.
+
+С in_memory=True кэш пиров (access_hash пользователей и чатов) теряется при
+каждом перезапуске, и первые ответы после деплоя тратят лишние запросы
+ResolvePeer. Здесь кэш пиров сохраняется по аккаунтам:
+
+- sqlite - файл сессии pyrogram на диске (по файлу на аккаунт);
+- mongo - пиры в коллекции session_peers (общая для всех узлов);
+- memory - прежнее поведение, без сохранения.
+
+Ключ авторизации берется из session_string аккаунта, но в режиме sqlite
+pyrogram записывает его в файл сессии вместе с dc_id и user_id в открытом
+виде: файл дает полный доступ к аккаунту, как и сама session_string. Поэтому
+каталог сессий создается с правами 0700, файлы - 0600, а в docker-compose
+каталог монтируется отдельным томом. В режимах mongo и memory на диск ничего
+не пишется. Режим задается переменной окружения SESSION_STORAGE.
+"""
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from pyrogram.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORAGE_MODES = ("memory", "sqlite", "mongo")
+SESSION_PEERS = "session_peers"
+SESSION_FIELDS = ("dc_id", "api_id", "test_mode", "auth_key", "user_id", "is_bot")
+# Новые пиры сохраняются пачкой через несколько секунд после первого изменения
+PEER_SAVE_DELAY_SECONDS = 5
+# Расширение файла сессии pyrogram (FileStorage.FILE_EXTENSION)
+SESSION_FILE_EXTENSION = ".session"
+# Права каталога и файлов сессий: только владелец процесса
+SESSION_DIR_MODE = 0o700
+SESSION_FILE_MODE = 0o600
+
+
+class SessionStorageFactory:
+    """Создание хранилища сессии для клиента аккаунта по выбранному режиму"""
+
+    def __init__(self, db, mode: str = "sqlite", workdir: Optional[str] = None):
+        if mode not in SESSION_STORAGE_MODES:
+            raise ValueError(f"Unknown session storage: {mode}")
+        self.mode = mode
+        self.peers = db[SESSION_PEERS]
+        self.workdir = Path(workdir or Path(__file__).parent / "sessions")
+        if mode == "sqlite":
+            self.workdir.mkdir(mode=SESSION_DIR_MODE, parents=True, exist_ok=True)
+            # Каталог мог быть создан раньше с правами по умолчанию
+            self.workdir.chmod(SESSION_DIR_MODE)
+
+    async def initialize(self):
+        if self.mode == "mongo":
+            await self.peers.create_index([("account_id", 1), ("id", 1)], unique=True)
+
+    def create(self, name: str, account_id: str, session_string: str) -> Optional[Storage]:
+        """Хранилище для Client(name=...); None - оставить хранилище pyrogram в памяти"""
+        if self.mode == "memory":
+            return None
+        from pyrogram_storage import MongoSessionStorage, SQLiteSessionStorage
+
+        if self.mode == "sqlite":
+            return SQLiteSessionStorage(name, self.workdir, session_string)
+        return MongoSessionStorage(name, session_string, self.peers, account_id)
+
+    async def delete(self, name: str, account_id: str):
+        """Удаление сохраненного кэша пиров аккаунта"""
+        if self.mode == "sqlite":
+            (self.workdir / f"{name}{SESSION_FILE_EXTENSION}").unlink(missing_ok=True)
+        elif self.mode == "mongo":
+            await self.peers.delete_many({"account_id": account_id})
@@ -1,21 +1,37 @@
+from __future__ import annotations
+
 import asyncio
 import os
 import logging
 import uuid
-from typing import Dict, Optional, List
-from pyrogram import Client, filters
-from pyrogram.types import Message
-from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid, PhoneNumberInvalid
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Optional, List, Tuple
 import random
 from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
 from models import (
-    TelegramAccount, AutoReplyRule, BotImage, BotSettings, BotActivityLog,
+    TelegramAccount, AutoReplyRule, BotSettings, BotActivityLog,
     AccountStatus, BotStatus, PhoneVerification, TwoFactorAuth,
     MediaContent, InlineButton, ReplyAction, ReplyCondition, ChatFilter,
-    RuleStatistics, CallbackQuery
+    RuleStatistics, CallbackQuery, RuleTemplate, MediaFile
+)
+from media_catalog import MediaCatalog
+from session_storage import SessionStorageFactory
+from account_health import AccountHealthMonitor
+from message_claims import MessageClaims
+from loop_guard import LoopGuard
+from verification_pool import VerificationPool
+from activity_hub import STATUS_EVENT, ActivityHub
+from activity_logs import ActivityLogStore, count_rule_triggers, update_rollups
+from rule_compiler import (
+    CompiledAction, CompiledRule, CompiledSend, RuleIndex, compile_rule,
+    message_chat_type, message_content_type
 )
 
+# pyrogram импортируется при первом запуске клиента, а не при старте API
+if TYPE_CHECKING:
+    from pyrogram import Client
+    from pyrogram.types import Message
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,18 +42,70 @@ class UserbotManager:
         self.is_running = False
         self.tasks: List[asyncio.Task] = []
         
-        # Connection and session management
-        self._verification_clients: Dict[str, Client] = {}
-        self._connection_pool_size = 10
+        # Клиенты незавершенных входов в аккаунт (ограниченный пул с фоновой очисткой)
+        self.verification_pool = VerificationPool(
+            max_pending=int(os.environ.get("MAX_PENDING_VERIFICATIONS", "20")),
+            on_reap=self._cleanup_old_verification_clients
+        )
+        # Сколько аккаунтов подключается одновременно и разброс моментов подключения
+        self._connection_pool_size = int(os.environ.get("USERBOT_START_CONCURRENCY", "10"))
+        self._start_jitter_seconds = float(os.environ.get("USERBOT_START_JITTER_SECONDS", "1.0"))
+        self._accounts_page_size = 100
         self._bulk_operation_batch_size = 100
         
+        # Хранилище сессий: кэш пиров переживает перезапуск (SESSION_STORAGE=memory|sqlite|mongo)
+        self.session_storage = SessionStorageFactory(
+            db,
+            mode=os.environ.get("SESSION_STORAGE", "sqlite"),
+            workdir=os.environ.get("SESSION_DIR")
+        )
+        
+        # Наблюдение за подключениями и пакетная запись статусов аккаунтов
+        self.health = AccountHealthMonitor(self)
+        
+        # Один ответ на сообщение в чатах, где несколько наших аккаунтов
+        self.message_claims = MessageClaims(db)
+        
+        # Предохранитель от циклов автоответов с ботами и другими userbot
+        self.loop_guard = LoopGuard(db)
+        
+        # Единый каталог медиа (bot_images + media_files)
+        self.media_catalog = MediaCatalog(db)
+        
+        # Логи активности (time-series коллекция в компактном формате)
+        self.activity_logs = ActivityLogStore(db)
+        
+        # Аренда аккаунтов при нескольких узлах (account_leases.LeaseManager)
+        self.leases = None
+        
+        # Уведомление о запуске и остановке клиента (account_id, running):
+        # рабочий процесс сообщает так процессу API о переподключениях монитора
+        self.on_client_change: Optional[Callable[[str, bool], None]] = None
+        
+        # Рассылка новых логов и изменений статуса подключенным клиентам
+        self.activity_hub = ActivityHub(queue_size=int(os.environ.get("ACTIVITY_STREAM_QUEUE_SIZE", "256")))
+        
         # Performance optimization caches
         self._rules_cache: Dict[str, List[AutoReplyRule]] = {}
         self._rules_cache_ttl: Dict[str, datetime] = {}
         self._cache_ttl_seconds = 300  # 5 minutes
+        self._compiled_rules: Dict[str, CompiledRule] = {}
+        # Ошибки компиляции по версии правила, чтобы не компилировать его на каждое сообщение
+        self._failed_rules: Dict[str, Tuple[tuple, Exception]] = {}
+        self._rule_indexes: Dict[str, RuleIndex] = {}
+        
+        # Таблица шаблонов правил (для пользовательских переменных)
+        self._templates_cache: Optional[Dict[str, RuleTemplate]] = None
+        self._templates_cache_time = datetime.min
+        self._templates_version = 0
+        
+        # Максимум одновременных шагов при выполнении одного правила
+        self._rule_concurrency_limit = 4
         
     async def start_userbot(self, account_id: str) -> bool:
         """Запуск userbot для конкретного аккаунта"""
+        from pyrogram import Client, filters
+        
         try:
             account = await self.get_account_by_id(account_id)
             if not account or not account.session_string:
@@ -48,18 +116,25 @@ class UserbotManager:
                 logger.info(f"Client for account {account_id} already running")
                 return True
                 
+            client_name = f"userbot_{account_id}"
             client = Client(
-                name=f"userbot_{account_id}",
+                name=client_name,
                 session_string=account.session_string,
                 in_memory=True
             )
+            storage = self.session_storage.create(client_name, account_id, account.session_string)
+            if storage:
+                client.storage = storage
+            
+            # Регистрируем обработчик сообщений (сообщения, которые не подходят
+            # ни одному правилу, отсеиваются фильтром без запуска обработчика)
+            rules_filter = self._rules_filter(account_id)
             
-            # Регистрируем обработчик сообщений
-            @client.on_message(filters.private & ~filters.me & ~filters.bot)
+            @client.on_message(filters.private & ~filters.me & ~filters.bot & rules_filter)
             async def handle_private_message(client: Client, message: Message):
                 await self.process_incoming_message(client, message, account_id)
             
-            @client.on_message(filters.group & ~filters.me)
+            @client.on_message(filters.group & ~filters.me & rules_filter)
             async def handle_group_message(client: Client, message: Message):
                 await self.process_incoming_message(client, message, account_id)
             
@@ -75,9 +150,13 @@ class UserbotManager:
                 
             await client.start()
             self.clients[account_id] = client
+            self.health.track(account_id)
+            if self.on_client_change:
+                self.on_client_change(account_id, True)
             
             # Обновляем статус аккаунта
             await self.update_account_status(account_id, AccountStatus.CONNECTED)
+            await self.publish_status()
             
             logger.info(f"Userbot started for account {account_id}")
             return True
@@ -85,15 +164,21 @@ class UserbotManager:
         except Exception as e:
             logger.error(f"Failed to start userbot for account {account_id}: {e}")
             await self.update_account_status(account_id, AccountStatus.ERROR, str(e))
+            # Монитор повторит запуск с задержкой (статус сменится на connecting)
+            self.health.record_start_failure(account_id, e)
             return False
     
     async def stop_userbot(self, account_id: str) -> bool:
         """Остановка userbot для конкретного аккаунта"""
         try:
+            self.health.untrack(account_id)
             if account_id in self.clients:
                 client = self.clients.pop(account_id)
+                if self.on_client_change:
+                    self.on_client_change(account_id, False)
                 await client.stop()
                 await self.update_account_status(account_id, AccountStatus.DISCONNECTED)
+                await self.publish_status()
                 logger.info(f"Userbot stopped for account {account_id}")
                 return True
             return False
@@ -103,35 +188,112 @@ class UserbotManager:
     
     async def start_all_userbots(self) -> Dict[str, bool]:
         """Запуск всех активных userbot"""
-        results = {}
-        accounts = await self.get_all_active_accounts()
+        return await self._start_all(lambda account_id, success: None)
+    
+    async def stream_start_all_userbots(self) -> AsyncIterator[Tuple[str, bool]]:
+        """Запуск всех активных userbot с выдачей результатов по мере подключения.
+        
+        Запуск идет в отдельной задаче и не прерывается, если читатель отключился.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        runner = asyncio.create_task(
+            self._start_all(lambda account_id, success: queue.put_nowait((account_id, success)))
+        )
+        self.tasks.append(runner)
+        
+        def on_done(task: asyncio.Task):
+            self.tasks.remove(task)
+            queue.put_nowait(None)
+        runner.add_done_callback(on_done)
         
-        for account in accounts:
-            results[account.id] = await self.start_userbot(account.id)
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield item
+        await runner
+    
+    async def _start_all(self, on_result: Callable[[str, bool], None]) -> Dict[str, bool]:
+        """Запуск всех активных аккаунтов и обновление общего статуса бота"""
+        account_ids = [account.id async for account in self.iter_active_accounts()]
+        if self.leases:
+            # Запуск всех снимает паузы (как и без аренд), затем запускаем
+            # только свою долю, остальные аккаунты берут другие узлы
+            await self.leases.resume()
+            account_ids = await self.leases.claim_share(account_ids)
+        results = await self.start_userbots(account_ids, on_result)
+        if self.leases:
+            await self.leases.track_started(results)
             
         # Обновляем общий статус бота
-        settings = await self.get_bot_settings()
-        if any(results.values()):
+        if any(results.values()) or (self.leases and not account_ids):
             await self.update_bot_status(BotStatus.RUNNING)
         else:
             await self.update_bot_status(BotStatus.ERROR)
             
         self.is_running = True
+        await self.publish_status()
         return results
     
-    async def stop_all_userbots(self) -> Dict[str, bool]:
-        """Остановка всех userbot"""
+    async def start_userbots(self, account_ids: List[str],
+                             on_result: Optional[Callable[[str, bool], None]] = None) -> Dict[str, bool]:
+        """Параллельный запуск аккаунтов под семафором со случайной задержкой"""
         results = {}
+        semaphore = asyncio.Semaphore(self._connection_pool_size)
         
-        for account_id in list(self.clients.keys()):
-            results[account_id] = await self.stop_userbot(account_id)
-            
+        async def start_one(account_id: str):
+            async with semaphore:
+                # Разносим подключения во времени, чтобы не приходить к Telegram толпой
+                if self._start_jitter_seconds > 0:
+                    await asyncio.sleep(random.uniform(0, self._start_jitter_seconds))
+                success = await self.start_userbot(account_id)
+            results[account_id] = success
+            if on_result:
+                on_result(account_id, success)
+        
+        await asyncio.gather(*(start_one(account_id) for account_id in account_ids))
+        return results
+    
+    async def stop_all_userbots(self) -> Dict[str, bool]:
+        """Остановка всех userbot (явная команда: статус бота - STOPPED на всех узлах)"""
+        results = await self.stop_clients()
         await self.update_bot_status(BotStatus.STOPPED)
         self.is_running = False
+        await self.publish_status()
         return results
     
+    async def stop_clients(self) -> Dict[str, bool]:
+        """Остановка клиентов этого процесса без изменения общего статуса бота"""
+        account_ids = list(self.clients.keys())
+        semaphore = asyncio.Semaphore(self._connection_pool_size)
+        
+        async def stop_one(account_id: str) -> bool:
+            async with semaphore:
+                return await self.stop_userbot(account_id)
+        
+        stopped = await asyncio.gather(*(stop_one(account_id) for account_id in account_ids))
+        # Аккаунты, не запустившиеся с первого раза, в clients не попадают, но
+        # монитор продолжил бы их перезапускать
+        self.health.untrack_all()
+        return dict(zip(account_ids, stopped))
+    
+    async def shutdown(self):
+        """Остановка всех клиентов при завершении сервера.
+
+        Статус бота в bot_settings не меняется: его задает только /bot/stop,
+        а после перезапуска узла (или на других узлах) бот продолжает работу.
+        """
+        if self.leases:
+            # Аккаунты узла отдаем другим узлам
+            await self.leases.stop()
+        else:
+            await self.stop_clients()
+        await self.health.stop()
+        await self.verification_pool.close()
+    
     async def process_incoming_message(self, client: Client, message: Message, account_id: str):
         """Обработка входящего сообщения с расширенным функционалом"""
+        self.loop_guard.record_incoming(account_id, message)
         try:
             # Проверяем общие настройки бота
             settings = await self.get_bot_settings()
@@ -152,11 +314,14 @@ class UserbotManager:
             # Находим подходящее правило с расширенной проверкой
             matching_rule = await self.find_matching_rule(message, rules, use_enhanced=True)
             
-            if matching_rule:
-                await self.execute_enhanced_rule_actions(client, message, matching_rule, account_id)
+            if not matching_rule:
+                return
+            
+            await self.execute_enhanced_rule_actions(client, message, matching_rule, account_id)
                 
         except Exception as e:
             logger.error(f"Error processing message: {e}")
+            self.health.record_error(account_id, e)
     
     async def find_matching_rule(self, message: Message, rules: List[AutoReplyRule], use_enhanced: bool = True) -> Optional[AutoReplyRule]:
         """Поиск подходящего правила с возможностью использования расширенных или базовых условий"""
@@ -212,7 +377,7 @@ class UserbotManager:
                     await asyncio.sleep(action.delay_seconds)
                 
                 if action.action_type == "send_image":
-                    await self.send_images(client, message, action.image_ids)
+                    await self.send_images(client, message, action.image_ids, account_id)
                     
                 elif action.action_type == "send_text":
                     if action.text_message:
@@ -221,7 +386,7 @@ class UserbotManager:
                 elif action.action_type == "send_both":
                     if action.text_message:
                         await client.send_message(message.chat.id, action.text_message)
-                    await self.send_images(client, message, action.image_ids)
+                    await self.send_images(client, message, action.image_ids, account_id)
             
             # Логируем активность
             await self.log_bot_activity(
@@ -257,15 +422,42 @@ class UserbotManager:
                 error_message=str(e)
             )
     
-    async def send_images(self, client: Client, message: Message, image_ids: List[str]):
+    async def send_images(self, client: Client, message: Message, image_ids: List[str], account_id: str):
         """Отправка картинок"""
-        for image_id in image_ids:
-            image = await self.get_image_by_id(image_id)
-            if image and image.is_active:
+        images = await self.media_catalog.get_many(image_ids)
+        for image in images:
+            if image.is_active:
                 try:
-                    await client.send_photo(message.chat.id, image.file_path)
+                    await self._send_photo(client, account_id, message.chat.id, image.file_path)
                 except Exception as e:
-                    logger.error(f"Failed to send image {image_id}: {e}")
+                    logger.error(f"Failed to send image {image.id}: {e}")
+    
+    async def _send_photo(self, client: Client, account_id: str, chat_id: int, file_path: str, **kwargs):
+        """Отправка фото с переиспользованием file_id, уже загруженного в Telegram"""
+        from pyrogram.errors import (
+            FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid,
+            MediaEmpty, MediaInvalid, PhotoInvalid
+        )
+        
+        entry = await self.media_catalog.get_by_path(file_path) if file_path else None
+        
+        # Повторные загрузки делят файл на диске, поэтому file_id ищется по пути
+        cached_file_id = entry.telegram_file_ids.get(account_id) if entry else None
+        if cached_file_id:
+            try:
+                return await client.send_photo(chat_id, cached_file_id, **kwargs)
+            except (FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid,
+                    MediaEmpty, MediaInvalid, PhotoInvalid) as e:
+                # Только устаревший file_id заменяется новой загрузкой; FloodWait и
+                # сетевые ошибки уходят вызывающему, а file_id остается
+                logger.warning(f"Cached file_id for {file_path} rejected, uploading again: {e}")
+                await self.media_catalog.forget_telegram_file_id(entry, account_id)
+        
+        sent_message = await client.send_photo(chat_id, file_path, **kwargs)
+        
+        if entry and getattr(sent_message, "photo", None):
+            await self.media_catalog.remember_telegram_file_id(entry, account_id, sent_message.photo.file_id)
+        return sent_message
     
     # Методы для работы с базой данных
     async def get_account_by_id(self, account_id: str) -> Optional[TelegramAccount]:
@@ -273,25 +465,27 @@ class UserbotManager:
         account_data = await self.db.telegram_accounts.find_one({"id": account_id})
         return TelegramAccount(**account_data) if account_data else None
     
+    async def iter_active_accounts(self) -> AsyncIterator[TelegramAccount]:
+        """Все активные аккаунты, постранично (keyset по id)"""
+        query = {"status": {"$ne": AccountStatus.ERROR}, "session_string": {"$ne": None}}
+        last_id = None
+        while True:
+            page_query = {**query, "id": {"$gt": last_id}} if last_id else query
+            page = await self.db.telegram_accounts.find(page_query).sort("id", 1) \
+                .limit(self._accounts_page_size).to_list(self._accounts_page_size)
+            for account in page:
+                yield TelegramAccount(**account)
+            if len(page) < self._accounts_page_size:
+                break
+            last_id = page[-1]["id"]
+    
     async def get_all_active_accounts(self) -> List[TelegramAccount]:
         """Получение всех активных аккаунтов"""
-        accounts_data = await self.db.telegram_accounts.find(
-            {"status": {"$ne": AccountStatus.ERROR}, "session_string": {"$ne": None}}
-        ).to_list(100)
-        return [TelegramAccount(**account) for account in accounts_data]
+        return [account async for account in self.iter_active_accounts()]
     
     async def update_account_status(self, account_id: str, status: AccountStatus, error_message: str = None):
-        """Обновление статуса аккаунта"""
-        update_data = {"status": status, "last_active": datetime.utcnow()}
-        if error_message:
-            update_data["error_message"] = error_message
-        elif status == AccountStatus.CONNECTED:
-            update_data["error_message"] = None
-            
-        await self.db.telegram_accounts.update_one(
-            {"id": account_id},
-            {"$set": update_data}
-        )
+        """Обновление статуса аккаунта (записывается пачкой монитором здоровья)"""
+        self.health.set_status(account_id, status, error_message)
     
 
     async def update_bot_status(self, status: BotStatus):
@@ -326,6 +520,33 @@ class UserbotManager:
         
         return rules
     
+    async def get_rule_index(self, account_id: str) -> RuleIndex:
+        """Индекс правил аккаунта; перестраивается при обновлении кэша правил"""
+        rules = await self.get_active_rules(account_id)
+        index = self._rule_indexes.get(account_id)
+        if index is None or index.rules is not rules:
+            index = RuleIndex(rules)
+            self._rule_indexes[account_id] = index
+        return index
+    
+    def _rules_filter(self, account_id: str):
+        """Фильтр pyrogram по индексу правил аккаунта"""
+        from pyrogram import filters
+        
+        async def could_match(_, __, message: Message) -> bool:
+            # Входящее сообщение - признак живого соединения, даже если оно отсеяно
+            self.health.record_update(account_id)
+            if self.loop_guard.is_muted(account_id, message.chat.id):
+                return False
+            try:
+                index = await self.get_rule_index(account_id)
+                return index.could_match(message)
+            except Exception as e:
+                # При ошибке не теряем сообщение: решение примет обработчик
+                logger.error(f"Rule filter error for account {account_id}: {e}")
+                return True
+        return filters.create(could_match, "RulesFilter")
+    
     async def clear_rules_cache(self, account_id: Optional[str] = None):
         """Очистка кэша правил"""
         if account_id:
@@ -336,6 +557,52 @@ class UserbotManager:
             # Очищаем весь кэш правил
             self._rules_cache.clear()
             self._rules_cache_ttl.clear()
+            self._compiled_rules.clear()
+            self._failed_rules.clear()
+    
+    async def get_rule_templates_table(self) -> Dict[str, RuleTemplate]:
+        """Получение таблицы шаблонов правил с кэшированием"""
+        if self._templates_cache is not None and datetime.utcnow() < self._templates_cache_time:
+            return self._templates_cache
+        
+        templates_docs = await self.db.rule_templates.find().to_list(1000)
+        templates = {doc["id"]: RuleTemplate(**doc) for doc in templates_docs}
+        
+        # Правила перекомпилируются, только если шаблоны действительно изменились
+        if templates != self._templates_cache:
+            self._templates_version += 1
+        self._templates_cache = templates
+        self._templates_cache_time = datetime.utcnow() + timedelta(seconds=self._cache_ttl_seconds)
+        
+        return templates
+    
+    async def clear_templates_cache(self):
+        """Очистка кэша шаблонов правил"""
+        self._templates_cache_time = datetime.min
+    
+    async def get_compiled_rule(self, rule: AutoReplyRule) -> CompiledRule:
+        """Получение скомпилированного правила (перекомпиляция при изменении)"""
+        templates = await self.get_rule_templates_table() if rule.templates else {}
+        templates_version = self._templates_version if rule.templates else 0
+        
+        compiled = self._compiled_rules.get(rule.id)
+        if (compiled is not None and compiled.version == rule.updated_at and
+                compiled.templates_version == templates_version):
+            return compiled
+        
+        version = (rule.updated_at, templates_version)
+        failed = self._failed_rules.get(rule.id)
+        if failed and failed[0] == version:
+            raise failed[1]
+        try:
+            compiled = compile_rule(rule, templates, templates_version, strict=False)
+        except Exception as e:
+            logger.error(f"Rule {rule.id} cannot be compiled: {e}")
+            self._failed_rules[rule.id] = (version, e)
+            raise
+        self._failed_rules.pop(rule.id, None)
+        self._compiled_rules[rule.id] = compiled
+        return compiled
     
     async def get_bot_settings(self) -> Optional[BotSettings]:
         """Получение настроек бота с кэшированием"""
@@ -366,16 +633,22 @@ class UserbotManager:
             batch = activities[i:i + self._bulk_operation_batch_size]
             batch_docs = [activity.dict() for activity in batch]
             
+            written = batch_docs
             try:
-                await self.db.bot_activity_logs.insert_many(batch_docs, ordered=False)
+                await self.activity_logs.insert_many(batch_docs)
             except Exception as e:
                 logger.error(f"Bulk activity logging error: {e}")
                 # Fallback to individual inserts
-                for activity in batch:
+                written = []
+                for doc in batch_docs:
                     try:
-                        await self.db.bot_activity_logs.insert_one(activity.dict())
+                        await self.activity_logs.insert_one(doc)
+                        written.append(doc)
                     except Exception as individual_error:
                         logger.error(f"Individual activity logging error: {individual_error}")
+            
+            await self._update_activity_rollups(written)
+            self.activity_hub.publish_logs(written)
     
     def _optimize_query_with_indexes(self, collection_name: str, query: dict) -> dict:
         """Оптимизация запросов для использования индексов"""
@@ -394,10 +667,9 @@ class UserbotManager:
         
         return optimized_query
     
-    async def get_image_by_id(self, image_id: str) -> Optional[BotImage]:
-        """Получение картинки по ID"""
-        image_data = await self.db.bot_images.find_one({"id": image_id})
-        return BotImage(**image_data) if image_data else None
+    async def get_image_by_id(self, image_id: str) -> Optional[MediaFile]:
+        """Получение картинки по ID из каталога медиа"""
+        return await self.media_catalog.get(image_id)
     
     async def check_daily_limits(self, settings: BotSettings) -> bool:
         """Проверка дневных лимитов"""
@@ -429,7 +701,17 @@ class UserbotManager:
     async def log_bot_activity(self, **kwargs):
         """Логирование активности бота"""
         log_entry = BotActivityLog(**kwargs)
-        await self.db.bot_activity_logs.insert_one(log_entry.dict())
+        doc = log_entry.dict()
+        await self.activity_logs.insert_one(doc)
+        await self._update_activity_rollups([doc])
+        self.activity_hub.publish_logs([doc])
+    
+    async def _update_activity_rollups(self, docs: List[dict]):
+        """Обновление агрегатов активности (ошибка не должна терять сам лог)"""
+        try:
+            await update_rollups(self.db.activity_rollups, docs)
+        except Exception as e:
+            logger.error(f"Activity rollup update error: {e}")
     
     async def increment_rule_usage(self, rule_id: str):
         """Увеличение счетчика использования правила"""
@@ -445,25 +727,65 @@ class UserbotManager:
             {"$inc": {"daily_response_count": 1}},
             upsert=True
         )
+        await self.publish_status()
+    
+    def running_account_ids(self) -> List[str]:
+        """Аккаунты, клиенты которых запущены"""
+        return list(self.clients.keys())
+    
+    async def get_health_snapshot(self) -> Dict[str, dict]:
+        """Состояние подключений запущенных аккаунтов"""
+        return self.health.snapshot()
+    
+    async def get_loop_mutes(self) -> List[Dict]:
+        """Чаты, в которых аккаунты заглушены предохранителем циклов"""
+        return self.loop_guard.active_mutes()
+    
+    async def unmute_chat(self, account_id: str, chat_id: Optional[int] = None):
+        """Снятие заглушения аккаунта (во всех чатах, если chat_id не указан)"""
+        self.loop_guard.unmute(account_id, chat_id)
+    
+    async def get_status_snapshot(self) -> dict:
+        """Текущий статус бота (формат /api/bot/status)"""
+        settings = await self.db.bot_settings.find_one() or {}
+        defaults = BotSettings()
+        return {
+            "status": settings.get("status", defaults.status),
+            "is_running": self.is_running,
+            "active_accounts": len(self.running_account_ids()),
+            "daily_response_count": settings.get("daily_response_count", defaults.daily_response_count),
+            "max_daily_responses": settings.get("max_daily_responses", defaults.max_daily_responses)
+        }
+    
+    async def publish_status(self):
+        """Рассылка статуса бота подписчикам (только если они есть)"""
+        if not self.activity_hub.subscriber_count:
+            return
+        try:
+            self.activity_hub.publish(STATUS_EVENT, await self.get_status_snapshot())
+        except Exception as e:
+            logger.error(f"Error publishing bot status: {e}")
 
     # Методы для аутентификации
-    # Dictionary to store temporary clients during verification process
-    _verification_clients = {}
     
     async def send_code_request(self, phone: str, api_id: int, api_hash: str) -> str:
         """Отправка запроса на код подтверждения"""
+        from pyrogram import Client
+        
+        verification_id = str(uuid.uuid4())
+        # Место в пуле занимается до подключения (VerificationPoolFull при переполнении)
+        await self.verification_pool.reserve(verification_id)
         try:
-            verification_id = str(uuid.uuid4())
             client_name = f"temp_{verification_id}"
             
             # Create client that we'll reuse for verification
             client = Client(client_name, api_id=api_id, api_hash=api_hash, in_memory=True)
             await client.connect()
             
-            sent_code = await client.send_code(phone)
+            # Клиент в пуле сразу после подключения, чтобы при ошибке он был отключен
+            self.verification_pool.add(verification_id, client)
             
-            # Store client for later use in verification
-            self._verification_clients[verification_id] = client
+            sent_code = await client.send_code(phone)
             
             # Сохраняем информацию о верификации
             verification = PhoneVerification(
@@ -477,24 +799,19 @@ class UserbotManager:
             
             await self.db.phone_verifications.insert_one(verification.dict())
             
-            # Clean up old verification clients (older than 15 minutes)
-            await self._cleanup_old_verification_clients()
-            
             return verification_id
             
         except Exception as e:
             logger.error(f"Failed to send code request: {e}")
             # Clean up client if something went wrong
-            if verification_id in self._verification_clients:
-                try:
-                    await self._verification_clients[verification_id].disconnect()
-                except:
-                    pass
-                del self._verification_clients[verification_id]
+            await self.verification_pool.release(verification_id)
             raise
     
     async def verify_phone_code(self, verification_id: str, code: str) -> str:
         """Верификация кода и получение session string"""
+        from pyrogram import Client
+        from pyrogram.errors import SessionPasswordNeeded
+        
         try:
             # Получаем данные верификации
             verification_data = await self.db.phone_verifications.find_one({"id": verification_id})
@@ -506,23 +823,19 @@ class UserbotManager:
             # Проверяем срок действия
             if datetime.utcnow() > verification.expires_at:
                 # Очищаем клиент если истек срок
-                if verification_id in self._verification_clients:
-                    try:
-                        await self._verification_clients[verification_id].disconnect()
-                    except:
-                        pass
-                    del self._verification_clients[verification_id]
+                await self.verification_pool.release(verification_id)
                 raise ValueError("Verification code expired. Please request a new code.")
             
             # Получаем существующий клиент или создаем новый
-            if verification_id in self._verification_clients:
-                client = self._verification_clients[verification_id]
+            client = self.verification_pool.get(verification_id)
+            if client is not None:
                 # Проверяем, что клиент еще подключен
                 if not client.is_connected:
                     await client.connect()
             else:
                 # Если клиент не найден, создаем новый (fallback)
                 logger.warning(f"Client not found for verification {verification_id}, creating new one")
+                await self.verification_pool.reserve(verification_id)
                 client = Client(
                     f"temp_{verification_id}",
                     api_id=verification.api_id,
@@ -530,7 +843,7 @@ class UserbotManager:
                     in_memory=True
                 )
                 await client.connect()
-                self._verification_clients[verification_id] = client
+                self.verification_pool.add(verification_id, client)
             
             try:
                 # Очищаем код от пробелов и лишних символов
@@ -572,9 +885,7 @@ class UserbotManager:
             session_string = await client.export_session_string()
             
             # Отключаем и очищаем клиент
-            await client.disconnect()
-            if verification_id in self._verification_clients:
-                del self._verification_clients[verification_id]
+            await self.verification_pool.release(verification_id, completed=True)
             
             # Помечаем верификацию как завершенную
             await self.db.phone_verifications.update_one(
@@ -586,12 +897,7 @@ class UserbotManager:
             
         except Exception as e:
             # Очистка при ошибке
-            if verification_id in self._verification_clients:
-                try:
-                    await self._verification_clients[verification_id].disconnect()
-                except:
-                    pass
-                del self._verification_clients[verification_id]
+            await self.verification_pool.release(verification_id)
             
             logger.error(f"Failed to verify phone code: {e}")
             raise
@@ -612,20 +918,14 @@ class UserbotManager:
             
             # Проверяем срок действия
             if datetime.utcnow() > verification.expires_at:
-                if verification_id in self._verification_clients:
-                    try:
-                        await self._verification_clients[verification_id].disconnect()
-                    except:
-                        pass
-                    del self._verification_clients[verification_id]
+                await self.verification_pool.release(verification_id)
                 raise ValueError("Verification session expired. Please start the verification process again.")
             
             # Получаем существующий клиент
-            if verification_id not in self._verification_clients:
+            client = self.verification_pool.get(verification_id)
+            if client is None:
                 raise ValueError("Verification session not found. Please start the verification process again.")
             
-            client = self._verification_clients[verification_id]
-            
             # Проверяем, что клиент еще подключен
             if not client.is_connected:
                 await client.connect()
@@ -650,9 +950,7 @@ class UserbotManager:
             session_string = await client.export_session_string()
             
             # Отключаем и очищаем клиент
-            await client.disconnect()
-            if verification_id in self._verification_clients:
-                del self._verification_clients[verification_id]
+            await self.verification_pool.release(verification_id, completed=True)
             
             # Помечаем верификацию как завершенную
             await self.db.phone_verifications.update_one(
@@ -664,12 +962,7 @@ class UserbotManager:
             
         except Exception as e:
             # Очистка при ошибке
-            if verification_id in self._verification_clients:
-                try:
-                    await self._verification_clients[verification_id].disconnect()
-                except:
-                    pass
-                del self._verification_clients[verification_id]
+            await self.verification_pool.release(verification_id)
             
             logger.error(f"Failed to verify 2FA password: {e}")
             raise
@@ -775,27 +1068,27 @@ class UserbotManager:
             
             # Проверка дневного лимита
             if rule.max_triggers_per_day:
-                today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-                today_triggers = await self.db.bot_activity_logs.count_documents({
-                    "rule_id": rule.id,
-                    "timestamp": {"$gte": today_start}
-                })
+                today_triggers = await count_rule_triggers(self.db.activity_rollups, rule.id)
                 if today_triggers >= rule.max_triggers_per_day:
                     return
             
-            # Обработка условных правил
-            for conditional_rule in rule.conditional_rules:
-                if await self.check_enhanced_rule_conditions(message, AutoReplyRule(
-                    id="temp", name="temp", conditions=[conditional_rule.condition]
-                )):
-                    await self._execute_single_action(client, message, conditional_rule.if_action, rule.id)
-                elif conditional_rule.else_action:
-                    await self._execute_single_action(client, message, conditional_rule.else_action, rule.id)
-                continue
+            # Ответ, замыкающий цикл, не отправляется: аккаунт заглушен в чате
+            if not await self.loop_guard.allow_reply(account_id, message, rule.id):
+                return
             
-            # Обработка обычных действий
-            for action in rule.actions:
-                await self._execute_single_action(client, message, action, rule.id)
+            # Сообщение берется последним, когда этот аккаунт точно готов ответить:
+            # иначе заявку мог взять аккаунт, которому затем не дал ответить кулдаун
+            if not await self.message_claims.should_reply(message, rule, account_id):
+                return
+            
+            # Выбираем действия и выполняем план правила
+            compiled = await self.get_compiled_rule(rule)
+            actions = await self._select_rule_actions(message, compiled)
+            await self._run_execution_plan(client, message, actions, account_id)
+            if any(compiled_action.sends for compiled_action in actions):
+                self.loop_guard.record_reply(account_id, message)
+            
+            await self._log_rule_execution(message, rule, account_id, True)
             
             # Обновляем статистику правила
             await self._update_rule_statistics(rule.id, account_id, True)
@@ -811,114 +1104,144 @@ class UserbotManager:
             
         except Exception as e:
             logger.error(f"Error executing enhanced rule actions: {e}")
+            await self._log_rule_execution(message, rule, account_id, False, str(e))
             await self._update_rule_statistics(rule.id, account_id, False)
             await self.db.auto_reply_rules.update_one(
                 {"id": rule.id},
                 {"$inc": {"error_count": 1}}
             )
     
-    async def _execute_single_action(self, client: Client, message: Message, action, rule_id: str):
-        """Выполнение одного действия"""
+    async def _log_rule_execution(self, message: Message, rule: AutoReplyRule, account_id: str,
+                                  success: bool, error_message: Optional[str] = None):
+        """Запись в лог активности о срабатывании правила"""
         try:
+            await self.log_bot_activity(
+                account_id=account_id,
+                chat_id=message.chat.id,
+                chat_type=message.chat.type.name.lower(),
+                user_id=message.from_user.id if message.from_user else 0,
+                username=message.from_user.username if message.from_user else None,
+                first_name=message.from_user.first_name if message.from_user else None,
+                message_text=message.text[:100] if message.text else None,
+                rule_id=rule.id,
+                action_taken=f"{'Executed' if success else 'Failed to execute'} rule: {rule.name}",
+                success=success,
+                error_message=error_message
+            )
+        except Exception as e:
+            logger.error(f"Error logging rule execution: {e}")
+    
+    async def _select_rule_actions(self, message: Message, compiled: CompiledRule) -> List[CompiledAction]:
+        """Выбор действий правила с учетом условных веток"""
+        actions = []
+        for conditional in compiled.conditionals:
+            if await self.check_enhanced_rule_conditions(message, conditional.condition_rule):
+                actions.append(conditional.if_action)
+            elif conditional.else_action:
+                actions.append(conditional.else_action)
+        actions.extend(compiled.actions)
+        return actions
+    
+    async def _run_execution_plan(self, client: Client, message: Message, actions: List[CompiledAction],
+                                  account_id: str):
+        """Выполнение плана правила: отправки в чат по порядку, реакции параллельно"""
+        semaphore = asyncio.Semaphore(self._rule_concurrency_limit)
+        
+        # Все отправки идут в чат сообщения, поэтому образуют одну упорядоченную очередь.
+        # Реакции от нее не зависят и не ждут загрузки картинок
+        steps = [self._run_send_lane(client, message, actions, account_id, semaphore)]
+        for compiled_action in actions:
+            for reaction in compiled_action.reactions:
+                steps.append(self._send_reaction(
+                    client, message, reaction, compiled_action.delay_seconds, semaphore
+                ))
+        
+        results = await asyncio.gather(*steps, return_exceptions=True)
+        
+        # Ошибка отправки считается ошибкой правила, ошибки реакций только логируются
+        if isinstance(results[0], BaseException):
+            raise results[0]
+    
+    async def _run_send_lane(self, client: Client, message: Message, actions: List[CompiledAction],
+                             account_id: str, semaphore: asyncio.Semaphore):
+        """Последовательная отправка контента действий в чат сообщения"""
+        for compiled_action in actions:
+            action = compiled_action.action
+            
             # Добавляем задержку
-            if action.delay_seconds > 0:
-                await asyncio.sleep(action.delay_seconds)
-            
-            # Отправляем медиа контент
-            keyboard = None
-            if action.inline_buttons:
-                keyboard = await self._create_inline_keyboard(action.inline_buttons, rule_id)
-            
-            for media_content in action.media_contents:
-                if media_content.content_type == "text":
-                    text = await self._process_template_text(media_content.text_content or "", message)
-                    sent_message = await client.send_message(
-                        message.chat.id, 
-                        text, 
-                        reply_markup=keyboard,
-                        reply_to_message_id=message.id if action.reply_to_message else None
-                    )
-                
-                elif media_content.content_type == "image":
-                    caption = await self._process_template_text(media_content.caption or "", message)
-                    sent_message = await client.send_photo(
-                        message.chat.id,
-                        media_content.file_path,
-                        caption=caption if caption else None,
-                        reply_markup=keyboard,
-                        reply_to_message_id=message.id if action.reply_to_message else None
-                    )
-                
-                elif media_content.content_type == "sticker":
-                    sent_message = await client.send_sticker(
-                        message.chat.id,
-                        media_content.file_id or media_content.file_path,
-                        reply_to_message_id=message.id if action.reply_to_message else None
-                    )
-                
-                elif media_content.content_type == "emoji":
-                    # Для эмодзи используем обычное текстовое сообщение
-                    sent_message = await client.send_message(
-                        message.chat.id,
-                        media_content.emoji,
-                        reply_to_message_id=message.id if action.reply_to_message else None
-                    )
+            if compiled_action.delay_seconds > 0:
+                await asyncio.sleep(compiled_action.delay_seconds)
+            
+            for compiled_send in compiled_action.sends:
+                try:
+                    async with semaphore:
+                        sent_message = await self._send_media_content(
+                            client, message, action, compiled_send, compiled_action.keyboard, account_id
+                        )
+                except Exception as e:
+                    logger.error(f"Error executing single action: {e}")
+                    raise
                 
                 # Автоудаление сообщения
                 if action.delete_after_seconds and hasattr(sent_message, 'id'):
                     asyncio.create_task(self._delete_message_after_delay(
                         client, message.chat.id, sent_message.id, action.delete_after_seconds
                     ))
-            
-            # Добавляем реакции
-            for reaction in action.reactions:
-                try:
-                    await client.send_reaction(message.chat.id, message.id, reaction)
-                except Exception as e:
-                    logger.warning(f"Failed to add reaction {reaction}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error executing single action: {e}")
-            raise
     
-    async def _create_inline_keyboard(self, button_rows, rule_id: str):
-        """Создание инлайн клавиатуры"""
-        from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    async def _send_media_content(self, client: Client, message: Message, action: ReplyAction,
+                                  compiled_send: CompiledSend, keyboard, account_id: str):
+        """Отправка одного элемента контента"""
+        media_content = compiled_send.content
+        reply_to_message_id = message.id if action.reply_to_message else None
         
-        keyboard_rows = []
-        for row in button_rows:
-            keyboard_row = []
-            for button in row:
-                if button.button_type == "url":
-                    keyboard_row.append(InlineKeyboardButton(button.text, url=button.url))
-                elif button.button_type == "callback":
-                    callback_data = f"{rule_id}:{button.callback_data}"
-                    keyboard_row.append(InlineKeyboardButton(button.text, callback_data=callback_data))
-            keyboard_rows.append(keyboard_row)
+        if media_content.content_type == "text":
+            text = compiled_send.template.render(message)
+            return await client.send_message(
+                message.chat.id, 
+                text, 
+                reply_markup=keyboard,
+                reply_to_message_id=reply_to_message_id
+            )
         
-        return InlineKeyboardMarkup(keyboard_rows)
-    
-    async def _process_template_text(self, template_text: str, message: Message) -> str:
-        """Обработка шаблонного текста с переменными"""
-        if not template_text:
-            return ""
+        elif media_content.content_type == "image":
+            caption = compiled_send.template.render(message)
+            return await self._send_photo(
+                client,
+                account_id,
+                message.chat.id,
+                media_content.file_path,
+                caption=caption if caption else None,
+                reply_markup=keyboard,
+                reply_to_message_id=reply_to_message_id
+            )
         
-        variables = {
-            "{user_name}": message.from_user.first_name or "Пользователь",
-            "{user_id}": str(message.from_user.id),
-            "{username}": f"@{message.from_user.username}" if message.from_user.username else "без username",
-            "{chat_title}": getattr(message.chat, 'title', '') or 'Личные сообщения',
-            "{chat_id}": str(message.chat.id),
-            "{time}": datetime.utcnow().strftime("%H:%M"),
-            "{date}": datetime.utcnow().strftime("%d.%m.%Y"),
-            "{message_text}": message.text or message.caption or ""
-        }
+        elif media_content.content_type == "sticker":
+            return await client.send_sticker(
+                message.chat.id,
+                media_content.file_id or media_content.file_path,
+                reply_to_message_id=reply_to_message_id
+            )
         
-        processed_text = template_text
-        for var, value in variables.items():
-            processed_text = processed_text.replace(var, value)
+        elif media_content.content_type == "emoji":
+            # Для эмодзи используем обычное текстовое сообщение
+            return await client.send_message(
+                message.chat.id,
+                media_content.emoji,
+                reply_to_message_id=reply_to_message_id
+            )
         
-        return processed_text
+        return None
+    
+    async def _send_reaction(self, client: Client, message: Message, reaction: str, delay: int,
+                             semaphore: asyncio.Semaphore):
+        """Добавление реакции независимо от отправки контента"""
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            async with semaphore:
+                await client.send_reaction(message.chat.id, message.id, reaction)
+        except Exception as e:
+            logger.warning(f"Failed to add reaction {reaction}: {e}")
     
     async def _delete_message_after_delay(self, client: Client, chat_id: int, message_id: int, delay: int):
         """Удаление сообщения через указанное время"""
@@ -957,34 +1280,11 @@ class UserbotManager:
     
     def _get_chat_type(self, message: Message) -> str:
         """Получение типа чата"""
-        chat_type_map = {
-            "PRIVATE": "private",
-            "GROUP": "group", 
-            "SUPERGROUP": "supergroup",
-            "CHANNEL": "channel"
-        }
-        return chat_type_map.get(message.chat.type.name, "unknown")
+        return message_chat_type(message)
     
     def _get_message_type(self, message: Message) -> str:
         """Определение типа сообщения"""
-        if message.text:
-            return "text"
-        elif message.photo:
-            return "photo"
-        elif message.video:
-            return "video"
-        elif message.document:
-            return "document"
-        elif message.audio:
-            return "audio"
-        elif message.voice:
-            return "voice"
-        elif message.sticker:
-            return "sticker"
-        elif message.animation:
-            return "animation"
-        else:
-            return "other"
+        return message_content_type(message)
     
     async def process_callback_query(self, callback_query_data: Dict):
         """Обработка callback запроса от инлайн кнопки"""
@@ -1061,12 +1361,7 @@ class UserbotManager:
             
             # Очистить клиенты для истекших верификаций
             for verification_id in expired_verifications:
-                if verification_id in self._verification_clients:
-                    try:
-                        await self._verification_clients[verification_id].disconnect()
-                    except:
-                        pass
-                    del self._verification_clients[verification_id]
+                await self.verification_pool.release(verification_id)
                     
             # Удалить истекшие записи из базы данных
             if expired_verifications:
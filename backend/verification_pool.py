@@ -0,0 +1,138 @@
+"""Пул клиентов pyrogram для незавершенных входов в аккаунт.
+
+Клиент создается при отправке кода и живет до ввода кода (и пароля 2FA).
+Пул ограничивает число одновременных верификаций, а фоновая задача
+закрывает клиенты, которые простаивают дольше idle_timeout, даже если новых
+запросов нет.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from pyrogram import Client
+
+logger = logging.getLogger(__name__)
+
+
+class VerificationPoolFull(Exception):
+    """Достигнут предел одновременных верификаций"""
+
+
+class PooledClient:
+    """Клиент верификации (None, пока подключается) и время его использования"""
+
+    __slots__ = ("client", "created_at", "last_used")
+
+    def __init__(self):
+        self.client: Optional[Client] = None
+        self.created_at = self.last_used = time.monotonic()
+
+
+class VerificationPool:
+    """Ограниченный пул клиентов верификации с фоновой очисткой"""
+
+    def __init__(self, max_pending: int = 20, idle_timeout: int = 900, reap_interval: int = 60,
+                 on_reap: Optional[Callable[[], Awaitable[None]]] = None):
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.on_reap = on_reap
+        self._entries: Dict[str, PooledClient] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._counters = {"created": 0, "completed": 0, "reaped": 0, "rejected": 0}
+
+    def __contains__(self, verification_id: str) -> bool:
+        entry = self._entries.get(verification_id)
+        return entry is not None and entry.client is not None
+
+    async def reserve(self, verification_id: str):
+        """Место в пуле до подключения клиента (VerificationPoolFull, если мест нет)"""
+        if len(self._entries) >= self.max_pending:
+            await self.reap()
+        if len(self._entries) >= self.max_pending:
+            self._counters["rejected"] += 1
+            raise VerificationPoolFull(
+                f"Too many pending verifications ({self.max_pending}). Please try again later."
+            )
+        self._entries[verification_id] = PooledClient()
+        self._ensure_reaper()
+
+    def add(self, verification_id: str, client: Client):
+        entry = self._entries.get(verification_id)
+        if entry is None:
+            entry = self._entries[verification_id] = PooledClient()
+            self._ensure_reaper()
+        entry.client = client
+        entry.last_used = time.monotonic()
+        self._counters["created"] += 1
+
+    def get(self, verification_id: str) -> Optional[Client]:
+        entry = self._entries.get(verification_id)
+        if entry is None or entry.client is None:
+            return None
+        entry.last_used = time.monotonic()
+        return entry.client
+
+    async def release(self, verification_id: str, completed: bool = False):
+        """Отключение клиента и освобождение места"""
+        entry = self._entries.pop(verification_id, None)
+        if entry is None:
+            return
+        if completed:
+            self._counters["completed"] += 1
+        if entry.client is not None:
+            try:
+                await entry.client.disconnect()
+            except Exception:
+                # Клиент мог быть уже отключен
+                pass
+
+    async def reap(self) -> int:
+        """Закрытие клиентов, простаивающих дольше idle_timeout"""
+        deadline = time.monotonic() - self.idle_timeout
+        idle = [
+            verification_id for verification_id, entry in self._entries.items()
+            if entry.last_used < deadline
+        ]
+        for verification_id in idle:
+            await self.release(verification_id)
+        if idle:
+            self._counters["reaped"] += len(idle)
+            logger.info(f"Reaped {len(idle)} idle verification clients")
+        return len(idle)
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+                if self.on_reap:
+                    await self.on_reap()
+            except Exception as e:
+                logger.error(f"Verification pool reaper error: {e}")
+
+    def metrics(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "pending": len(self._entries),
+            "max_pending": self.max_pending,
+            "idle_timeout_seconds": self.idle_timeout,
+            "oldest_seconds": round(max((now - entry.created_at for entry in self._entries.values()), default=0)),
+            **self._counters,
+        }
+
+    async def close(self):
+        """Остановка очистки и отключение всех клиентов"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for verification_id in list(self._entries):
+            await self.release(verification_id)
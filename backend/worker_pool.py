@@ -0,0 +1,453 @@
+"""Распределение аккаунтов по рабочим процессам.
+
+Супервизор (процесс API) запускает N рабочих процессов, в каждом свой event
+loop и свой UserbotManager с компилированными правилами и счетчиками.
+Аккаунты закрепляются за процессами консистентным хешированием, команды
+(запуск, остановка, статус) передаются по локальному каналу multiprocessing.
+Новые логи рабочие процессы пересылают в API для потока активности.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from activity_hub import ActivityHub
+from userbot_manager import UserbotManager
+
+logger = logging.getLogger(__name__)
+
+WORKER_MONITOR_INTERVAL_SECONDS = 5
+WORKER_SHUTDOWN_TIMEOUT_SECONDS = 30
+
+
+class HashRing:
+    """Консистентное хеширование: при изменении числа узлов переезжает ~1/N ключей"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 100):
+        self._ring: List[tuple] = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._keys = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class ForwardingHub(ActivityHub):
+    """Хаб рабочего процесса: новые логи уходят в процесс API"""
+
+    def __init__(self, send: Callable[[tuple], None]):
+        super().__init__()
+        self._send = send
+
+    def publish_logs(self, docs):
+        if docs:
+            self._send(("event", "logs", docs))
+
+
+# Команды, которые выполняет рабочий процесс
+async def _command_start_many(manager: UserbotManager, send, request_id: int, account_ids: List[str]):
+    return await manager.start_userbots(
+        account_ids,
+        lambda account_id, success: send(("progress", request_id, (account_id, success)))
+    )
+
+
+async def _command_start(manager: UserbotManager, send, request_id: int, account_id: str):
+    return await manager.start_userbot(account_id)
+
+
+async def _command_stop(manager: UserbotManager, send, request_id: int, account_id: str):
+    return await manager.stop_userbot(account_id)
+
+
+async def _command_stop_many(manager: UserbotManager, send, request_id: int):
+    return await manager.stop_clients()
+
+
+async def _command_status(manager: UserbotManager, send, request_id: int):
+    return {"pid": os.getpid(), "accounts": list(manager.clients.keys())}
+
+
+async def _command_health(manager: UserbotManager, send, request_id: int):
+    return await manager.get_health_snapshot()
+
+
+async def _command_loop_mutes(manager: UserbotManager, send, request_id: int):
+    return await manager.get_loop_mutes()
+
+
+async def _command_unmute(manager: UserbotManager, send, request_id: int, account_id: str,
+                          chat_id: Optional[int]):
+    await manager.unmute_chat(account_id, chat_id)
+
+
+async def _command_clear_templates_cache(manager: UserbotManager, send, request_id: int):
+    await manager.clear_templates_cache()
+
+
+async def _command_clear_rules_cache(manager: UserbotManager, send, request_id: int, account_id: Optional[str]):
+    await manager.clear_rules_cache(account_id)
+
+
+WORKER_COMMANDS = {
+    "start_many": _command_start_many,
+    "start": _command_start,
+    "stop": _command_stop,
+    "stop_many": _command_stop_many,
+    "status": _command_status,
+    "health": _command_health,
+    "loop_mutes": _command_loop_mutes,
+    "unmute": _command_unmute,
+    "clear_templates_cache": _command_clear_templates_cache,
+    "clear_rules_cache": _command_clear_rules_cache,
+}
+
+
+def run_worker(index: int, conn, mongo_url: str, db_name: str):
+    """Точка входа рабочего процесса"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_serve(index, conn, mongo_url, db_name))
+
+
+async def _serve(index: int, conn, mongo_url: str, db_name: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(mongo_url)
+    manager = UserbotManager(client[db_name])
+    manager.activity_hub = ForwardingHub(conn.send)
+    manager.on_client_change = lambda account_id, running: conn.send(("event", "client", (account_id, running)))
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+
+    async def handle(request_id: int, command: str, args: tuple):
+        try:
+            result = await WORKER_COMMANDS[command](manager, conn.send, request_id, *args)
+            reply = ("reply", request_id, True, result)
+        except Exception as e:
+            logger.error(f"Worker command {command} failed: {e}")
+            reply = ("reply", request_id, False, f"{type(e).__name__}: {e}")
+        conn.send(reply)
+
+    def on_readable():
+        try:
+            request_id, command, args = conn.recv()
+        except (EOFError, OSError):
+            # Процесс API завершился
+            loop.remove_reader(conn.fileno())
+            stopping.set()
+            return
+        if command == "shutdown":
+            stopping.set()
+            return
+        loop.create_task(handle(request_id, command, args))
+
+    loop.add_reader(conn.fileno(), on_readable)
+    logger.info(f"Userbot worker {index} started (pid {os.getpid()})")
+    await stopping.wait()
+
+    # Общий статус бота задает процесс API, рабочий процесс только останавливает свои клиенты
+    await manager.stop_clients()
+    await manager.health.stop()
+    client.close()
+    logger.info(f"Userbot worker {index} stopped")
+
+
+class WorkerHandle:
+    """Рабочий процесс со стороны API: отправка команд и прием ответов и событий"""
+
+    def __init__(self, index: int, mongo_url: str, db_name: str, on_event: Callable[[str, Any], None]):
+        self.index = index
+        self.name = f"worker-{index}"
+        self.mongo_url = mongo_url
+        self.db_name = db_name
+        self.on_event = on_event
+        # Аккаунты, которые должны работать в этом процессе (перезапускаются после сбоя)
+        self.accounts: Set[str] = set()
+        self.restarts = 0
+        self.process: Optional[multiprocessing.Process] = None
+        self._conn = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._progress: Dict[int, Callable[[Any], None]] = {}
+        self._request_ids = itertools.count(1)
+
+    def spawn(self):
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(self.index, child_conn, self.mongo_url, self.db_name),
+            name=f"userbot-{self.name}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self._on_readable)
+
+    @property
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    async def call(self, command: str, *args, on_progress: Optional[Callable[[Any], None]] = None):
+        """Выполнение команды в рабочем процессе"""
+        if not self.is_alive:
+            raise ConnectionError(f"Userbot {self.name} is not running")
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        if on_progress:
+            self._progress[request_id] = on_progress
+        try:
+            self._conn.send((request_id, command, args))
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+            self._progress.pop(request_id, None)
+
+    def _on_readable(self):
+        try:
+            message = self._conn.recv()
+        except (EOFError, OSError):
+            self._detach()
+            return
+
+        kind = message[0]
+        if kind == "reply":
+            _, request_id, ok, result = message
+            future = self._pending.get(request_id)
+            if future and not future.done():
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(result))
+        elif kind == "progress":
+            _, request_id, payload = message
+            callback = self._progress.get(request_id)
+            if callback:
+                callback(payload)
+        elif kind == "event":
+            _, event, data = message
+            self.on_event(event, data)
+
+    def _detach(self):
+        """Канал закрыт: процесс завершился, ожидающие команды завершаются ошибкой"""
+        if self._conn is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        self._conn.close()
+        self._conn = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Userbot {self.name} exited"))
+
+    async def stop(self):
+        """Мягкая остановка процесса (клиенты Telegram закрываются внутри)"""
+        if self._conn is not None:
+            try:
+                self._conn.send((0, "shutdown", ()))
+            except (BrokenPipeError, OSError):
+                pass
+        if self.process is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.process.join, WORKER_SHUTDOWN_TIMEOUT_SECONDS
+            )
+            if self.process.is_alive():
+                self.process.terminate()
+        self._detach()
+
+
+class ShardedUserbotManager(UserbotManager):
+    """UserbotManager, который запускает клиенты в рабочих процессах.
+
+    Остальные операции (верификация телефонов, настройки, callback-и, медиа)
+    выполняются в процессе API, как и в обычном режиме.
+    """
+
+    def __init__(self, db, workers: int, mongo_url: str, db_name: str):
+        super().__init__(db)
+        self.workers = [
+            WorkerHandle(index, mongo_url, db_name, self._on_worker_event) for index in range(workers)
+        ]
+        self._workers_by_name = {worker.name: worker for worker in self.workers}
+        self._ring = HashRing(self._workers_by_name)
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    def worker_for(self, account_id: str) -> WorkerHandle:
+        return self._workers_by_name[self._ring.node_for(account_id)]
+
+    def _ensure_workers(self):
+        if self._monitor_task is not None:
+            return
+        for worker in self.workers:
+            worker.spawn()
+        self._monitor_task = asyncio.create_task(self._monitor_workers())
+        logger.info(f"Started {len(self.workers)} userbot workers")
+
+    async def _monitor_workers(self):
+        """Перезапуск упавших процессов и их аккаунтов"""
+        while True:
+            await asyncio.sleep(WORKER_MONITOR_INTERVAL_SECONDS)
+            for worker in self.workers:
+                if worker.is_alive:
+                    continue
+                logger.error(f"Userbot {worker.name} exited (code {worker.process.exitcode}), restarting")
+                worker._detach()
+                worker.restarts += 1
+                worker.spawn()
+                if worker.accounts:
+                    try:
+                        await worker.call("start_many", sorted(worker.accounts))
+                    except Exception as e:
+                        logger.error(f"Failed to restore accounts on {worker.name}: {e}")
+
+    def _on_worker_event(self, event: str, data: Any):
+        if event == "logs":
+            self.activity_hub.publish_logs(data)
+        elif event == "client":
+            # Переподключение или карантин по решению монитора рабочего процесса
+            account_id, running = data
+            worker = self.worker_for(account_id)
+            if running:
+                worker.accounts.add(account_id)
+            else:
+                worker.accounts.discard(account_id)
+
+    async def start_userbot(self, account_id: str) -> bool:
+        self._ensure_workers()
+        worker = self.worker_for(account_id)
+        success = await worker.call("start", account_id)
+        if success:
+            worker.accounts.add(account_id)
+        await self.publish_status()
+        return success
+
+    async def stop_userbot(self, account_id: str) -> bool:
+        self._ensure_workers()
+        worker = self.worker_for(account_id)
+        worker.accounts.discard(account_id)
+        success = await worker.call("stop", account_id)
+        await self.publish_status()
+        return success
+
+    async def start_userbots(self, account_ids: List[str],
+                             on_result: Optional[Callable[[str, bool], None]] = None) -> Dict[str, bool]:
+        """Запуск аккаунтов: каждый процесс получает свою часть и запускает ее параллельно"""
+        self._ensure_workers()
+        shards: Dict[str, List[str]] = {}
+        for account_id in account_ids:
+            shards.setdefault(self._ring.node_for(account_id), []).append(account_id)
+
+        def progress(payload):
+            if on_result:
+                on_result(*payload)
+
+        async def start_shard(worker: WorkerHandle, shard: List[str]) -> Dict[str, bool]:
+            try:
+                results = await worker.call("start_many", shard, on_progress=progress)
+            except Exception as e:
+                logger.error(f"Failed to start accounts on {worker.name}: {e}")
+                results = {account_id: False for account_id in shard}
+            worker.accounts.update(account_id for account_id, success in results.items() if success)
+            return results
+
+        results = {}
+        for shard_results in await asyncio.gather(*(
+            start_shard(self._workers_by_name[name], shard) for name, shard in shards.items()
+        )):
+            results.update(shard_results)
+        return results
+
+    async def stop_clients(self) -> Dict[str, bool]:
+        results = {}
+        if self._monitor_task is not None:
+            for worker in self.workers:
+                worker.accounts.clear()
+            for shard_results in await asyncio.gather(
+                *(worker.call("stop_many") for worker in self.workers if worker.is_alive),
+                return_exceptions=True
+            ):
+                if isinstance(shard_results, dict):
+                    results.update(shard_results)
+        return results
+
+    async def clear_templates_cache(self):
+        await super().clear_templates_cache()
+        await self._broadcast("clear_templates_cache")
+
+    async def clear_rules_cache(self, account_id: Optional[str] = None):
+        await super().clear_rules_cache(account_id)
+        await self._broadcast("clear_rules_cache", account_id)
+
+    async def _broadcast(self, command: str, *args):
+        if self._monitor_task is None:
+            return
+        await asyncio.gather(
+            *(worker.call(command, *args) for worker in self.workers if worker.is_alive),
+            return_exceptions=True
+        )
+
+    async def get_workers_status(self) -> List[Dict[str, Any]]:
+        """Состояние рабочих процессов и закрепленных за ними аккаунтов"""
+        statuses = []
+        for worker in self.workers:
+            status = {
+                "name": worker.name,
+                "alive": worker.is_alive,
+                "restarts": worker.restarts,
+                "assigned_accounts": len(worker.accounts),
+            }
+            if worker.is_alive:
+                try:
+                    status.update(await worker.call("status"))
+                except Exception as e:
+                    status["error"] = str(e)
+            statuses.append(status)
+        return statuses
+
+    def running_account_ids(self) -> List[str]:
+        return [account_id for worker in self.workers for account_id in worker.accounts]
+
+    async def get_health_snapshot(self) -> Dict[str, dict]:
+        snapshot = {}
+        for worker_health in await asyncio.gather(
+            *(worker.call("health") for worker in self.workers if worker.is_alive),
+            return_exceptions=True
+        ):
+            if isinstance(worker_health, dict):
+                snapshot.update(worker_health)
+        return snapshot
+
+    async def get_loop_mutes(self) -> List[Dict]:
+        mutes = []
+        for worker_mutes in await asyncio.gather(
+            *(worker.call("loop_mutes") for worker in self.workers if worker.is_alive),
+            return_exceptions=True
+        ):
+            if isinstance(worker_mutes, list):
+                mutes.extend(worker_mutes)
+        return mutes
+
+    async def unmute_chat(self, account_id: str, chat_id: Optional[int] = None):
+        await self._broadcast("unmute", account_id, chat_id)
+
+    async def shutdown(self):
+        await super().shutdown()
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            await asyncio.gather(*(worker.stop() for worker in self.workers))
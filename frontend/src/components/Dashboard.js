@@ -22,6 +22,7 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from "./ui/
 import { Button } from "./ui/button";
 import { Progress } from "./ui/progress";
 import { Badge } from "./ui/badge";
+import { applyStatsDelta, useActivityStream } from "../hooks/use-activity-stream";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -54,13 +55,15 @@ const Dashboard = () => {
   useEffect(() => {
     fetchBotStatus();
     fetchStats();
-    const interval = setInterval(() => {
-      fetchBotStatus();
-      fetchStats();
-    }, 5000);
-    return () => clearInterval(interval);
   }, []);
 
+  // Status and counters are pushed by the server instead of polling
+  useActivityStream({
+    onStatus: setBotStatus,
+    onStats: setStats,
+    onStatsDelta: (delta) => setStats(prev => applyStatsDelta(prev, delta))
+  });
+
   const startBot = async () => {
     setLoading(true);
     try {
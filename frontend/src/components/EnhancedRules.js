@@ -59,7 +59,7 @@ const EnhancedRules = () => {
 
   const fetchRules = async () => {
     try {
-      const response = await axios.get(`${API}/rules`);
+      const response = await axios.get(`${API}/rules?fast=1`);
       setRules(response.data);
     } catch (error) {
       console.error("Failed to fetch rules:", error);
@@ -1035,6 +1035,7 @@ const EnhancedRules = () => {
                                         <Label>Callback данные</Label>
                                         <Input
                                           value={button.callback_data || ""}
+                                          maxLength={27}
                                           onChange={(e) => {
                                             const newActions = [...ruleForm.actions];
                                             newActions[actionIndex].inline_buttons[rowIndex][buttonIndex].callback_data = e.target.value;
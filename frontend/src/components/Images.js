@@ -208,7 +208,7 @@ const Images = () => {
                   </div>
                 ) : (
                   <img
-                    src={`${BACKEND_URL}/uploads/${image.filename}`}
+                    src={`${API}/media/${image.id}/thumb?w=320`}
                     alt={image.original_filename}
                     className="w-full h-full object-cover"
                     onError={(e) => {
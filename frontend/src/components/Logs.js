@@ -10,16 +10,19 @@ import {
   AlertTriangle,
   Filter,
   Search,
-  RefreshCw
+  RefreshCw,
+  Download
 } from "lucide-react";
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from "./ui/card";
 import { Button } from "./ui/button";
 import { Input } from "./ui/input";
 import { Badge } from "./ui/badge";
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "./ui/select";
+import { applyStatsDelta, useActivityStream } from "../hooks/use-activity-stream";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const LOGS_LIMIT = 50;
 
 const Logs = () => {
   const [logs, setLogs] = useState([]);
@@ -31,7 +34,7 @@ const Logs = () => {
   const fetchLogs = async () => {
     setLoading(true);
     try {
-      const response = await axios.get(`${API}/logs?limit=50`);
+      const response = await axios.get(`${API}/logs?limit=${LOGS_LIMIT}`);
       setLogs(response.data);
     } catch (error) {
       console.error("Failed to fetch logs:", error);
@@ -51,13 +54,17 @@ const Logs = () => {
   useEffect(() => {
     fetchLogs();
     fetchStats();
-    const interval = setInterval(() => {
-      fetchLogs();
-      fetchStats();
-    }, 10000); // Refresh every 10 seconds
-    return () => clearInterval(interval);
   }, []);
 
+  // New entries and counter changes are pushed by the server instead of polling
+  useActivityStream({
+    onLog: (log) => setLogs(prev =>
+      prev.some(item => item.id === log.id) ? prev : [log, ...prev].slice(0, LOGS_LIMIT)
+    ),
+    onStats: setStats,
+    onStatsDelta: (delta) => setStats(prev => applyStatsDelta(prev, delta))
+  });
+
   const filteredLogs = logs.filter(log => {
     const matchesSearch = searchTerm === "" || 
       log.message_text?.toLowerCase().includes(searchTerm.toLowerCase()) ||
@@ -102,10 +109,18 @@ const Logs = () => {
           </p>
         </div>
         
-        <Button onClick={fetchLogs} disabled={loading}>
-          <RefreshCw className={`w-4 h-4 mr-2 ${loading ? 'animate-spin' : ''}`} />
-          Обновить
-        </Button>
+        <div className="flex items-center gap-2">
+          <Button variant="outline" asChild>
+            <a href={`${API}/logs/export?format=csv`} download>
+              <Download className="w-4 h-4 mr-2" />
+              Экспорт CSV
+            </a>
+          </Button>
+          <Button onClick={fetchLogs} disabled={loading}>
+            <RefreshCw className={`w-4 h-4 mr-2 ${loading ? 'animate-spin' : ''}`} />
+            Обновить
+          </Button>
+        </div>
       </div>
 
       {/* Statistics Cards */}
@@ -295,7 +295,7 @@ const MediaManager = () => {
                 <div className="aspect-square bg-muted rounded-lg mb-3 relative overflow-hidden">
                   {file.file_type === "image" ? (
                     <img
-                      src={`${BACKEND_URL}/uploads/${file.filename}`}
+                      src={`${API}/media/${file.id}/thumb?w=320`}
                       alt={file.original_filename}
                       className="w-full h-full object-cover"
                       onError={(e) => {
@@ -385,7 +385,7 @@ const MediaManager = () => {
                   <div className="w-12 h-12 rounded-lg overflow-hidden bg-muted flex items-center justify-center">
                     {file.file_type === "image" ? (
                       <img
-                        src={`${BACKEND_URL}/uploads/${file.filename}`}
+                        src={`${API}/media/${file.id}/thumb?w=64`}
                         alt={file.original_filename}
                         className="w-full h-full object-cover"
                         onError={(e) => {
@@ -577,7 +577,7 @@ const MediaManager = () => {
               <div className="flex justify-center">
                 {previewFile.file_type === "image" ? (
                   <img
-                    src={`${BACKEND_URL}/uploads/${previewFile.filename}`}
+                    src={`${API}/media/${previewFile.id}/thumb?w=640`}
                     alt={previewFile.original_filename}
                     className="max-w-full max-h-80 object-contain rounded-lg"
                   />
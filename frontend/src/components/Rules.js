@@ -26,7 +26,7 @@ const Rules = () => {
 
   const fetchRules = async () => {
     try {
-      const response = await axios.get(`${API}/rules`);
+      const response = await axios.get(`${API}/rules?fast=1`);
       setRules(response.data);
     } catch (error) {
       console.error("Failed to fetch rules:", error);
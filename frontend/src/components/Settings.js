@@ -194,6 +194,20 @@ const Settings = () => {
                 onChange={(e) => updateSetting("max_daily_responses", parseInt(e.target.value) || 1000)}
               />
             </div>
+
+            <div className="space-y-2">
+              <Label htmlFor="log_retention">Хранить логи активности (дней)</Label>
+              <Input
+                id="log_retention"
+                type="number"
+                min="0"
+                value={settings.log_retention_days ?? 0}
+                onChange={(e) => updateSetting("log_retention_days", Math.max(0, parseInt(e.target.value) || 0))}
+              />
+              <p className="text-xs text-muted-foreground">
+                Старые логи переносятся в архив на диске. 0 — хранить всегда.
+              </p>
+            </div>
           </CardContent>
         </Card>
 
@@ -313,12 +313,9 @@ const UnifiedMediaManager = () => {
 
   const stats = getFileStats();
 
-  const getImageUrl = (file) => {
-    if (apiEndpoint === "media") {
-      return `${BACKEND_URL}/uploads/${file.filename}`;
-    } else {
-      return `${BACKEND_URL}/uploads/${file.filename}`;
-    }
+  const getImageUrl = (file, width = 320) => {
+    // Галерея загружает уменьшенные копии, а не оригиналы
+    return `${API}/media/${file.id}/thumb?w=${width}`;
   };
 
   return (
@@ -597,7 +594,7 @@ const UnifiedMediaManager = () => {
                   <div className="w-12 h-12 rounded-lg overflow-hidden bg-muted flex items-center justify-center">
                     {(file.file_type === "image" || !file.file_type) ? (
                       <img
-                        src={getImageUrl(file)}
+                        src={getImageUrl(file, 64)}
                         alt={file.original_filename}
                         className="w-full h-full object-cover"
                         onError={(e) => {
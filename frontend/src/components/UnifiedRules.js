@@ -56,6 +56,8 @@ const UnifiedRules = () => {
     is_active: true,
     max_triggers_per_day: null,
     cooldown_seconds: 0,
+    dedup_policy: "first",
+    designated_account_id: "",
     conditions: [],
     actions: [],
     conditional_rules: []
@@ -63,7 +65,7 @@ const UnifiedRules = () => {
 
   const fetchRules = async () => {
     try {
-      const response = await axios.get(`${API}/rules`);
+      const response = await axios.get(`${API}/rules?fast=1`);
       setRules(response.data);
     } catch (error) {
       console.error("Failed to fetch rules:", error);
@@ -128,6 +130,8 @@ const UnifiedRules = () => {
       is_active: rule.is_active,
       max_triggers_per_day: rule.max_triggers_per_day,
       cooldown_seconds: rule.cooldown_seconds,
+      dedup_policy: rule.dedup_policy || "all",
+      designated_account_id: rule.designated_account_id || "",
       conditions: rule.conditions || [],
       actions: rule.actions || [],
       conditional_rules: rule.conditional_rules || []
@@ -143,6 +147,8 @@ const UnifiedRules = () => {
       is_active: true,
       max_triggers_per_day: null,
       cooldown_seconds: 0,
+      dedup_policy: "first",
+      designated_account_id: "",
       conditions: [],
       actions: [],
       conditional_rules: []
@@ -672,6 +678,37 @@ const UnifiedRules = () => {
                 </div>
               </div>
 
+              <div className="grid grid-cols-2 gap-4">
+                <div className="space-y-2">
+                  <Label>Ответ в общих чатах аккаунтов</Label>
+                  <Select
+                    value={ruleForm.dedup_policy}
+                    onValueChange={(value) => setRuleForm({...ruleForm, dedup_policy: value})}
+                  >
+                    <SelectTrigger>
+                      <SelectValue />
+                    </SelectTrigger>
+                    <SelectContent>
+                      <SelectItem value="first">Отвечает первый аккаунт</SelectItem>
+                      <SelectItem value="designated">Только выбранный аккаунт</SelectItem>
+                      <SelectItem value="all">Отвечают все аккаунты</SelectItem>
+                    </SelectContent>
+                  </Select>
+                </div>
+
+                {ruleForm.dedup_policy === "designated" && (
+                  <div className="space-y-2">
+                    <Label htmlFor="rule-designated-account">ID аккаунта</Label>
+                    <Input
+                      id="rule-designated-account"
+                      value={ruleForm.designated_account_id}
+                      onChange={(e) => setRuleForm({...ruleForm, designated_account_id: e.target.value})}
+                      placeholder="ID аккаунта, который отвечает"
+                    />
+                  </div>
+                )}
+              </div>
+
               <div className="flex items-center space-x-2">
                 <Switch
                   id="rule-active"
@@ -1151,6 +1188,7 @@ const UnifiedRules = () => {
                                         <Label>Callback данные</Label>
                                         <Input
                                           value={button.callback_data || ""}
+                                          maxLength={27}
                                           onChange={(e) => {
                                             const newActions = [...ruleForm.actions];
                                             newActions[actionIndex].inline_buttons[rowIndex][buttonIndex].callback_data = e.target.value;
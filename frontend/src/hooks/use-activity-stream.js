@@ -0,0 +1,45 @@
+import { useEffect, useRef } from "react";
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const STREAM_URL = `${BACKEND_URL}/api/logs/stream`;
+
+const EVENT_HANDLERS = {
+  log: "onLog",
+  stats: "onStats",
+  stats_delta: "onStatsDelta",
+  status: "onStatus"
+};
+
+// Apply a counter delta from the stream to a /logs/stats snapshot
+export function applyStatsDelta(stats, delta) {
+  if (!stats) return stats;
+  const total = stats.total_responses + delta.total;
+  const successful = stats.successful_responses + delta.success;
+  return {
+    ...stats,
+    total_responses: total,
+    successful_responses: successful,
+    failed_responses: stats.failed_responses + delta.failed,
+    success_rate: total > 0 ? (successful / total) * 100 : 0,
+    responses_today: stats.responses_today + delta.total
+  };
+}
+
+// Subscribe to the server-sent activity stream. The browser reconnects on its
+// own and resumes from the last received log via Last-Event-ID; the server
+// sends fresh stats and status snapshots on every (re)connect.
+export function useActivityStream(handlers) {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    const source = new EventSource(STREAM_URL);
+    Object.entries(EVENT_HANDLERS).forEach(([event, handlerName]) => {
+      source.addEventListener(event, (e) => {
+        const handler = handlersRef.current[handlerName];
+        if (handler) handler(JSON.parse(e.data));
+      });
+    });
+    return () => source.close();
+  }, []);
+}
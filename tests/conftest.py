@@ -0,0 +1,36 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# Модули бэкенда импортируются как модули верхнего уровня (как в server.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+CONTENT_TYPES = ("text", "photo", "video", "document", "audio", "voice", "sticker", "animation")
+
+
+def make_message(chat_id=100, chat_type="PRIVATE", user_id=1, username="alice", text="hello",
+                 caption=None, content_type="text", title=None, message_id=1,
+                 date=datetime(2024, 1, 1, 12, 0), from_user=True):
+    """Сообщение pyrogram с полями, которые читают проверки правил"""
+    message = SimpleNamespace(
+        id=message_id,
+        date=date,
+        chat=SimpleNamespace(id=chat_id, type=SimpleNamespace(name=chat_type), title=title),
+        from_user=SimpleNamespace(id=user_id, username=username) if from_user else None,
+        caption=caption,
+    )
+    for name in CONTENT_TYPES:
+        setattr(message, name, None)
+    if content_type == "text":
+        message.text = text
+    elif content_type in CONTENT_TYPES:
+        setattr(message, content_type, object())
+    return message
+
+
+@pytest.fixture
+def message_factory():
+    return make_message
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+pytest.importorskip("pyrogram")
+
+from account_health import HEALTH_RECONNECTING, AccountHealthMonitor  # noqa: E402
+from models import BotStatus  # noqa: E402
+
+
+class FakeManager:
+    """Менеджер, у которого запуск аккаунта всегда падает"""
+
+    def __init__(self, db):
+        self.db = db
+        self.clients = {}
+        self.leases = None
+        self.starts = []
+        self.health = AccountHealthMonitor(self)
+
+    async def start_userbot(self, account_id):
+        self.starts.append(account_id)
+        self.health.record_start_failure(account_id, ConnectionError("Telegram unavailable"))
+        return False
+
+
+@pytest.fixture
+def manager():
+    return FakeManager(mongomock_motor.AsyncMongoMockClient()["test"])
+
+
+def run(manager, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await manager.health.stop()
+    return asyncio.run(main())
+
+
+def test_failed_first_start_is_retried_while_bot_runs(manager):
+    async def main():
+        await manager.db.bot_settings.insert_one({"status": BotStatus.RUNNING})
+        await manager.start_userbot("a")
+        health = manager.health.accounts["a"]
+        await manager.health._reconnect("a", health)
+        return health
+
+    health = run(manager, main())
+    assert manager.starts == ["a", "a"]
+    assert manager.health.accounts["a"] is health
+    assert health.state == HEALTH_RECONNECTING
+    assert health.failures == 2
+
+
+def test_stopped_bot_does_not_restart_failed_account(manager):
+    async def main():
+        await manager.db.bot_settings.insert_one({"status": BotStatus.STOPPED})
+        await manager.start_userbot("a")
+        await manager.health._reconnect("a", manager.health.accounts["a"])
+
+    run(manager, main())
+    assert manager.starts == ["a"]
+    assert "a" not in manager.health.accounts
+
+
+def test_untrack_all_drops_accounts_outside_clients(manager):
+    async def main():
+        await manager.start_userbot("a")
+        manager.health.untrack_all()
+
+    run(manager, main())
+    assert manager.health.accounts == {}
@@ -0,0 +1,199 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from account_leases import ACCOUNT_LEASES, LeaseManager  # noqa: E402
+from models import BotStatus  # noqa: E402
+
+
+class FakeManager:
+    """UserbotManager узла: запущенные клиенты без подключения к Telegram"""
+
+    def __init__(self, db, account_ids):
+        self.db = db
+        self.account_ids = account_ids
+        self.clients = set()
+        self.is_running = False
+        self.leases = None
+
+    async def iter_active_accounts(self):
+        for account_id in self.account_ids:
+            yield SimpleNamespace(id=account_id)
+
+    async def start_userbots(self, account_ids):
+        self.clients.update(account_ids)
+        return {account_id: True for account_id in account_ids}
+
+    async def stop_userbot(self, account_id):
+        self.clients.discard(account_id)
+        return True
+
+    async def publish_status(self):
+        pass
+
+
+@pytest.fixture
+def db():
+    # Одиночный mongod в памяти, общий для всех "узлов" теста
+    return mongomock_motor.AsyncMongoMockClient()["test"]
+
+
+def node(db, node_id, account_ids=()):
+    manager = FakeManager(db, list(account_ids))
+    manager.leases = LeaseManager(db, manager, node_id=node_id, lease_seconds=30)
+    return manager.leases
+
+
+async def expire(db, account_id):
+    await db[ACCOUNT_LEASES].update_one(
+        {"_id": account_id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+
+
+async def set_status(db, status):
+    await db.bot_settings.update_one({}, {"$set": {"status": status}}, upsert=True)
+
+
+def test_acquire_is_exclusive(db):
+    first, second = node(db, "n1"), node(db, "n2")
+
+    async def main():
+        return [
+            await first.acquire("a"),
+            await second.acquire("a"),
+            await first.acquire("a"),
+            await first.owner_of("a"),
+        ]
+
+    assert asyncio.run(main()) == [True, False, True, "n1"]
+
+
+def test_renew_extends_only_live_own_leases(db):
+    first, second = node(db, "n1"), node(db, "n2")
+
+    async def main():
+        await first.acquire("a")
+        await first.acquire("b")
+        await second.acquire("c")
+        before = (await db[ACCOUNT_LEASES].find_one({"_id": "a"}))["expires_at"]
+        await expire(db, "b")
+        owned = await first.renew()
+        after = (await db[ACCOUNT_LEASES].find_one({"_id": "a"}))["expires_at"]
+        return owned, after >= before
+
+    owned, extended = asyncio.run(main())
+    assert owned == {"a"}
+    assert extended
+
+
+def test_expired_lease_is_taken_over(db):
+    first, second = node(db, "n1"), node(db, "n2")
+
+    async def main():
+        await first.acquire("a")
+        taken_early = await second.acquire("a")
+        await expire(db, "a")
+        taken = await second.acquire("a")
+        return taken_early, taken, await second.owner_of("a"), await first.renew()
+
+    assert asyncio.run(main()) == (False, True, "n2", set())
+
+
+def test_claim_share_splits_accounts_between_live_nodes(db):
+    accounts = ["a", "b", "c", "d", "e"]
+    first, second = node(db, "n1"), node(db, "n2")
+
+    async def main():
+        await second.heartbeat()
+        mine = await first.claim_share(accounts)
+        theirs = await second.claim_share(accounts)
+        again = await first.claim_share(accounts)
+        return mine, theirs, again
+
+    mine, theirs, again = asyncio.run(main())
+    assert len(mine) == 3
+    assert sorted(mine + theirs) == accounts
+    assert again == mine
+
+
+def test_claim_share_without_other_nodes_takes_everything(db):
+    accounts = ["a", "b", "c"]
+    assert asyncio.run(node(db, "n1").claim_share(accounts)) == accounts
+
+
+def test_pause_blocks_every_node_until_resume(db):
+    first, second = node(db, "n1"), node(db, "n2")
+    first.held.add("a")
+
+    async def main():
+        await first.acquire("a")
+        await first.pause("a")
+        blocked = [await first.acquire("a"), await second.acquire("a")]
+        paused = (await first.placement())["paused"]
+        await first.resume(["a"])
+        return blocked, paused, await second.acquire("a")
+
+    blocked, paused, resumed = asyncio.run(main())
+    assert "a" not in first.held
+    assert blocked == [False, False]
+    assert paused == ["a"]
+    assert resumed
+
+
+def test_resume_without_ids_clears_all_pauses(db):
+    leases = node(db, "n1")
+
+    async def main():
+        await leases.pause("a")
+        await leases.pause("b")
+        await leases.resume()
+        return (await leases.placement())["paused"], await leases.acquire("b")
+
+    assert asyncio.run(main()) == ([], True)
+
+
+def test_node_shutdown_keeps_bot_running_on_other_nodes(db):
+    accounts = ["a", "b", "c", "d"]
+    first, second = node(db, "n1", accounts), node(db, "n2", accounts)
+
+    async def main():
+        await set_status(db, BotStatus.RUNNING)
+        await second.heartbeat()
+        await first.reconcile()
+        await second.reconcile()
+        split = (sorted(first.held), sorted(second.held))
+
+        # Перезапуск узла n1: аккаунты отпускаются, статус бота остается прежним
+        await first.stop()
+        status = (await db.bot_settings.find_one())["status"]
+        await second.reconcile()
+        return split, status, sorted(second.held)
+
+    split, status, taken = asyncio.run(main())
+    assert len(split[0]) == len(split[1]) == 2
+    assert status == BotStatus.RUNNING
+    assert taken == accounts
+    assert first.manager.clients == set()
+
+
+def test_explicit_stop_releases_accounts_on_every_node(db):
+    accounts = ["a", "b"]
+    leases = node(db, "n1", accounts)
+
+    async def main():
+        await set_status(db, BotStatus.RUNNING)
+        await leases.reconcile()
+        running = sorted(leases.held)
+        await set_status(db, BotStatus.STOPPED)
+        await leases.reconcile()
+        return running, await db[ACCOUNT_LEASES].count_documents({})
+
+    running, remaining = asyncio.run(main())
+    assert running == accounts
+    assert leases.held == set()
+    assert leases.manager.clients == set()
+    assert remaining == 0
@@ -0,0 +1,86 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from activity_logs import (
+    ACTIVITY_LOGS, LEGACY_ACTIVITY_LOGS, ActivityLogStore, apply_log_cursor, decode_log_cursor,
+    encode_log_cursor, legacy_log_id
+)
+
+
+def test_cursor_round_trip():
+    timestamp = datetime(2024, 5, 1, 10, 30, 15, 123000)
+    log_id = ObjectId()
+    cursor = encode_log_cursor(timestamp, str(log_id))
+    assert "=" not in cursor
+    assert decode_log_cursor(cursor) == (timestamp, log_id)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", encode_log_cursor(datetime(2024, 1, 1), "bad-id")])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_log_cursor(cursor)
+
+
+def test_apply_cursor_descending_and_ascending():
+    timestamp, log_id = datetime(2024, 1, 1), ObjectId()
+    cursor = encode_log_cursor(timestamp, str(log_id))
+
+    assert apply_log_cursor({}, cursor) == {"$or": [
+        {"t": {"$lt": timestamp}},
+        {"t": timestamp, "_id": {"$lt": log_id}},
+    ]}
+    query = apply_log_cursor({"ok": True}, cursor, ascending=True)
+    assert query["$and"][0] == {"ok": True}
+    assert query["$and"][1]["$or"][0] == {"t": {"$gt": timestamp}}
+
+
+def test_apply_without_cursor_keeps_query():
+    assert apply_log_cursor({"ok": True}, None) == {"ok": True}
+
+
+def legacy_logs(count):
+    return [
+        {"id": str(uuid.uuid4()), "timestamp": datetime(2024, 1, 1, 0, index), "account_id": "a",
+         "success": True}
+        for index in range(count)
+    ]
+
+
+def test_concurrent_legacy_migration_has_no_duplicates():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    first, second = ActivityLogStore(db), ActivityLogStore(db)
+
+    async def main():
+        await db[LEGACY_ACTIVITY_LOGS].insert_many(legacy_logs(25))
+        migrated = await asyncio.gather(
+            first.migrate_legacy("n1", batch_size=10, lock_seconds=1),
+            second.migrate_legacy("n2", batch_size=10, lock_seconds=1),
+        )
+        return migrated, await db[ACTIVITY_LOGS].count_documents({}), \
+            await db[LEGACY_ACTIVITY_LOGS].count_documents({})
+
+    migrated, stored, left = asyncio.run(main())
+    assert sorted(migrated) == [0, 25]
+    assert stored == 25
+    assert left == 0
+
+
+def test_legacy_batch_repeated_after_crash_is_skipped():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    store = ActivityLogStore(db)
+    logs = legacy_logs(5)
+
+    async def main():
+        await db[LEGACY_ACTIVITY_LOGS].insert_many(logs)
+        # Сбой после записи пачки, но до удаления из старой коллекции
+        await store.insert_many([{**log, "id": legacy_log_id(log)} for log in logs[:3]])
+        migrated = await store.migrate_legacy("n1")
+        return migrated, await db[ACTIVITY_LOGS].count_documents({})
+
+    assert asyncio.run(main()) == (5, 5)
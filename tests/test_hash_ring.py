@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("motor")
+
+from worker_pool import HashRing  # noqa: E402
+
+KEYS = [f"account-{index}" for index in range(2000)]
+
+
+def test_node_for_is_deterministic():
+    first = HashRing(["a", "b", "c"])
+    second = HashRing(["c", "b", "a"])
+    assert [first.node_for(key) for key in KEYS] == [second.node_for(key) for key in KEYS]
+
+
+def test_keys_are_spread_over_all_nodes():
+    ring = HashRing(["a", "b", "c", "d"])
+    counts = {}
+    for key in KEYS:
+        node = ring.node_for(key)
+        counts[node] = counts.get(node, 0) + 1
+    assert set(counts) == {"a", "b", "c", "d"}
+    assert min(counts.values()) > len(KEYS) / 4 * 0.6
+
+
+def test_removing_node_moves_only_its_keys():
+    before = HashRing(["a", "b", "c", "d"])
+    after = HashRing(["a", "b", "c"])
+    for key in KEYS:
+        if before.node_for(key) != "d":
+            assert after.node_for(key) == before.node_for(key)
+
+
+def test_adding_node_moves_about_one_nth_of_keys():
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == "d" for key in moved)
+    assert len(KEYS) * 0.1 < len(moved) < len(KEYS) * 0.4
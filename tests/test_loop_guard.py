@@ -0,0 +1,41 @@
+from loop_guard import ExchangeCounter
+
+
+def test_exchanges_count_pairs_in_window():
+    counter = ExchangeCounter(4)
+    counter.add(0, 0.0, incoming=1)
+    counter.add(1, 1.0, replies=1)
+    counter.add(3, 3.0, incoming=2, replies=1)
+    assert counter.exchanges() == 2
+    assert counter.exchanges(extra_replies=1) == 3
+    assert counter.last_seen == 3.0
+
+
+def test_window_rollover_drops_oldest_bucket():
+    counter = ExchangeCounter(4)
+    counter.add(0, 0.0, incoming=1, replies=1)
+    counter.add(3, 3.0, incoming=1, replies=1)
+    assert counter.exchanges() == 2
+
+    counter.add(4, 4.0, incoming=1)
+    assert counter.incoming == [1, 0, 0, 1]
+    assert counter.replies == [0, 0, 0, 1]
+    assert counter.exchanges() == 1
+
+
+def test_gap_longer_than_window_clears_all_buckets():
+    counter = ExchangeCounter(4)
+    for bucket in range(4):
+        counter.add(bucket, float(bucket), incoming=1, replies=1)
+    counter.add(20, 20.0, incoming=1)
+    assert sum(counter.incoming) == 1
+    assert sum(counter.replies) == 0
+    assert counter.exchanges() == 0
+
+
+def test_late_bucket_does_not_move_window_back():
+    counter = ExchangeCounter(4)
+    counter.add(5, 5.0, incoming=1)
+    counter.add(4, 4.0, replies=1)
+    assert counter.bucket == 5
+    assert counter.exchanges() == 1
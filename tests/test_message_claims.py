@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from message_claims import MessageClaims, message_claim_key
+from models import AutoReplyRule, DedupPolicy
+
+from tests.conftest import make_message
+
+
+def test_private_chat_has_no_shared_key():
+    assert message_claim_key(make_message(chat_type="PRIVATE")) is None
+
+
+def test_supergroup_key_uses_message_id():
+    message = make_message(chat_id=-1001, chat_type="SUPERGROUP", message_id=42)
+    assert message_claim_key(message) == "-1001:42"
+    assert message_claim_key(make_message(chat_id=-1001, chat_type="CHANNEL", message_id=42)) == "-1001:42"
+
+
+def test_group_key_is_shared_between_accounts():
+    # В обычных группах у каждого аккаунта свой ID сообщения
+    first = make_message(chat_id=-5, chat_type="GROUP", message_id=10, text="hi")
+    second = make_message(chat_id=-5, chat_type="GROUP", message_id=77, text="hi")
+    assert message_claim_key(first) == message_claim_key(second)
+    assert message_claim_key(first).startswith("-5:1:")
+
+
+def test_group_key_differs_by_text_and_sender():
+    base = message_claim_key(make_message(chat_id=-5, chat_type="GROUP", text="hi"))
+    assert message_claim_key(make_message(chat_id=-5, chat_type="GROUP", text="bye")) != base
+    assert message_claim_key(make_message(chat_id=-5, chat_type="GROUP", user_id=2, text="hi")) != base
+
+
+def test_group_key_without_sender():
+    message = make_message(chat_id=-5, chat_type="GROUP", from_user=False, text=None,
+                           content_type="photo", caption="pic")
+    assert message_claim_key(message).startswith("-5:0:")
+
+
+@pytest.fixture
+def db():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    return mongomock_motor.AsyncMongoMockClient()["test"]
+
+
+def account_rule(account_id, policy=DedupPolicy.FIRST, designated=None):
+    # Правила загружаются по аккаунту: у каждого аккаунта свое правило
+    return AutoReplyRule(name=f"rule {account_id}", account_id=account_id,
+                         dedup_policy=policy, designated_account_id=designated)
+
+
+def group_message(message_id):
+    # Одно сообщение группы глазами разных аккаунтов: ID у каждого свой
+    return make_message(chat_id=-5, chat_type="GROUP", message_id=message_id, text="hi")
+
+
+def test_first_policy_lets_one_account_reply(db):
+    claims = MessageClaims(db)
+
+    async def main():
+        return [
+            await claims.should_reply(group_message(10), account_rule("a"), "a"),
+            await claims.should_reply(group_message(77), account_rule("b"), "b"),
+        ]
+
+    assert asyncio.run(main()) == [True, False]
+
+
+def test_first_policy_across_processes(db):
+    # Разные процессы делят только коллекцию заявок
+    first, second = MessageClaims(db), MessageClaims(db)
+    message = make_message(chat_id=-1001, chat_type="SUPERGROUP", message_id=5)
+
+    async def main():
+        return [
+            await first.should_reply(message, account_rule("a"), "a"),
+            await second.should_reply(message, account_rule("b"), "b"),
+        ]
+
+    assert asyncio.run(main()) == [True, False]
+
+
+def test_claim_owner_replies_with_all_its_rules(db):
+    claims = MessageClaims(db)
+
+    async def main():
+        return [
+            await claims.should_reply(group_message(10), account_rule("a"), "a"),
+            await claims.should_reply(group_message(10), account_rule("a"), "a"),
+        ]
+
+    assert asyncio.run(main()) == [True, True]
+
+
+def test_all_policy_and_private_chats_always_reply(db):
+    claims = MessageClaims(db)
+
+    async def main():
+        return [
+            await claims.should_reply(group_message(10), account_rule("a", DedupPolicy.ALL), "a"),
+            await claims.should_reply(group_message(11), account_rule("b", DedupPolicy.ALL), "b"),
+            await claims.should_reply(make_message(), account_rule("a"), "a"),
+            await claims.should_reply(make_message(), account_rule("b"), "b"),
+        ]
+
+    assert asyncio.run(main()) == [True, True, True, True]
+
+
+def test_designated_account_takes_message_from_first_policy(db):
+    claims = MessageClaims(db)
+
+    async def main():
+        return [
+            await claims.should_reply(group_message(10), account_rule("a", DedupPolicy.DESIGNATED, "b"), "a"),
+            await claims.should_reply(group_message(11), account_rule("b", DedupPolicy.DESIGNATED, "b"), "b"),
+            await claims.should_reply(group_message(12), account_rule("c"), "c"),
+        ]
+
+    assert asyncio.run(main()) == [False, True, False]
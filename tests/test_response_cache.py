@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from response_cache import ResponseCache
+
+
+def test_concurrent_misses_load_once():
+    cache = ResponseCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load("key", loader, 60) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["value"] * 5
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["coalesced"] == 4
+    assert stats["inflight"] == 0
+
+
+def test_loader_error_reaches_waiters_and_is_not_cached():
+    cache = ResponseCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load("key", loader, 60) for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_ttl_hit_and_expiry():
+    cache = ResponseCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        fresh = [await cache.get_or_load("fresh", loader, 60) for _ in range(2)]
+        expired = [await cache.get_or_load("expired", loader, 0) for _ in range(2)]
+        return fresh, expired
+
+    fresh, expired = asyncio.run(main())
+    assert fresh == [1, 1]
+    assert expired == [2, 3]
+    assert cache.stats()["expirations"] == 1
+    assert cache.purge_expired() == 1
+
+
+def test_invalidation_during_load_skips_store():
+    cache = ResponseCache()
+
+    async def loader():
+        cache.invalidate("rules")
+        return "stale"
+
+    async def main():
+        return await cache.get_or_load("key", loader, 60, ("rules",))
+
+    assert asyncio.run(main()) == "stale"
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("max_entries", [1, 2])
+def test_lru_eviction(max_entries):
+    cache = ResponseCache(max_entries=max_entries)
+
+    async def main():
+        for key in ("a", "b", "c"):
+            await cache.get_or_load(key, lambda key=key: asyncio.sleep(0, key), 60)
+
+    asyncio.run(main())
+    assert cache.stats()["entries"] == max_entries
+    assert cache.stats()["evictions"] == 3 - max_entries
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from models import AutoReplyRule, ChatFilter, ReplyCondition
+from rule_compiler import RuleGate, RuleIndex
+
+from tests.conftest import make_message
+
+MESSAGES = [
+    make_message(),
+    make_message(chat_id=200, chat_type="GROUP", title="Sales chat"),
+    make_message(chat_id=300, chat_type="SUPERGROUP", user_id=2, username="bob", text="Price please"),
+    make_message(chat_id=-400, chat_type="CHANNEL", username=None, text=None),
+    make_message(content_type="photo", caption="Photo with PRICE"),
+    make_message(content_type="sticker", text=None),
+]
+
+# Условия, которые ворота проверяют так же, как полная проверка
+STATIC_CONDITIONS = {
+    "chat_types": ReplyCondition(condition_type="chat_filter",
+                                 chat_filter=ChatFilter(chat_types=["group", "supergroup"])),
+    "whitelist_chats": ReplyCondition(condition_type="chat_filter",
+                                      chat_filter=ChatFilter(whitelist_chats=["100", "300"])),
+    "blacklist_chats": ReplyCondition(condition_type="chat_filter",
+                                      chat_filter=ChatFilter(blacklist_chats=["200"])),
+    "user_ids": ReplyCondition(condition_type="user_filter", user_ids=["2"]),
+    "usernames": ReplyCondition(condition_type="user_filter", usernames=["alice"]),
+    "keywords": ReplyCondition(condition_type="message_filter", keywords=["price"]),
+    "message_types": ReplyCondition(condition_type="message_filter", message_types=["photo", "sticker"]),
+    "inactive": ReplyCondition(condition_type="user_filter", user_ids=["999"], is_active=False),
+}
+
+# Условия, которые ворота пропускают: проверяет только полная проверка
+DYNAMIC_CONDITIONS = {
+    "chat_title": ReplyCondition(condition_type="chat_filter",
+                                 chat_filter=ChatFilter(chat_title_contains="sales")),
+    "time_filter": ReplyCondition(condition_type="time_filter",
+                                  time_ranges=[{"start_hour": 25, "end_hour": 25}]),
+}
+
+
+@pytest.fixture
+def full_check():
+    """Полная проверка условий UserbotManager (модуль требует motor)"""
+    pytest.importorskip("motor")
+    from userbot_manager import UserbotManager
+
+    manager = UserbotManager.__new__(UserbotManager)
+
+    def check(message, rule):
+        return asyncio.run(manager.check_enhanced_rule_conditions(message, rule))
+    return check
+
+
+def make_rule(*conditions):
+    return AutoReplyRule(name="rule", conditions=list(conditions))
+
+
+@pytest.mark.parametrize("name", sorted(STATIC_CONDITIONS))
+def test_gate_matches_full_check(name, full_check):
+    rule = make_rule(STATIC_CONDITIONS[name])
+    gate = RuleGate(rule)
+    for message in MESSAGES:
+        assert gate.allows(message) == full_check(message, rule)
+
+
+@pytest.mark.parametrize("name", sorted(DYNAMIC_CONDITIONS))
+def test_gate_never_rejects_what_full_check_accepts(name, full_check):
+    rule = make_rule(DYNAMIC_CONDITIONS[name])
+    gate = RuleGate(rule)
+    assert all(gate.allows(message) for message in MESSAGES)
+    assert not all(full_check(message, rule) for message in MESSAGES)
+
+
+def test_gate_matches_full_check_for_combined_conditions(full_check):
+    rule = make_rule(
+        STATIC_CONDITIONS["chat_types"],
+        STATIC_CONDITIONS["blacklist_chats"],
+        STATIC_CONDITIONS["keywords"],
+        ReplyCondition(condition_type="chat_filter", chat_filter=ChatFilter(blacklist_chats=["100"])),
+    )
+    gate = RuleGate(rule)
+    assert [gate.allows(message) for message in MESSAGES] == \
+        [full_check(message, rule) for message in MESSAGES]
+    assert any(gate.allows(message) for message in MESSAGES)
+
+
+def test_gate_without_conditions_allows_everything():
+    gate = RuleGate(make_rule())
+    assert all(gate.allows(message) for message in MESSAGES)
+
+
+def test_index_matches_any_rule():
+    index = RuleIndex([
+        make_rule(STATIC_CONDITIONS["user_ids"]),
+        make_rule(STATIC_CONDITIONS["message_types"]),
+    ])
+    assert index.could_match(make_message(user_id=2))
+    assert index.could_match(make_message(content_type="photo"))
+    assert not index.could_match(make_message())
+
+
+def test_index_rejects_messages_without_sender():
+    index = RuleIndex([make_rule()])
+    assert index.could_match(make_message())
+    assert not index.could_match(make_message(from_user=False))
+
+
+def test_empty_index_matches_nothing():
+    assert not RuleIndex([]).could_match(make_message())